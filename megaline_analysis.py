@@ -1,15 +1,35 @@
 # Loading all the libraries
 import pandas as pd 
 import numpy as np 
-import matplotlib.pyplot as plt
+import os
 from scipy import stats as st
+from megaline_resampling import bootstrap_diff, permutation_test
+from megaline_cohorts import retention_matrix, churn_curve, cohort_adjusted_mean, usage_month_index
+from megaline_cube import save_cube, slice_stats, over_limit_rate, welch_test
+from megaline_charts import render_report, report_specs
+from megaline_profiling import StageProfiler
+from megaline_pipeline import Pipeline
+from megaline_billing import BILLS_DIR, save_bills
+from megaline_validate import write_report
 
 # Load the data files into different DataFrames
-calls = pd.read_csv('/datasets/megaline_calls.csv')
-internet = pd.read_csv('/datasets/megaline_internet.csv')
-messages = pd.read_csv('/datasets/megaline_messages.csv')
-plans = pd.read_csv('/datasets/megaline_plans.csv')
-users = pd.read_csv('/datasets/megaline_users.csv')
+#The pipeline is a graph of stages (load -> validate -> clean -> aggregate -> merge -> bill -> stats -> tests and plots). A stage only
+#runs when its result is asked for, and the result is stored in CACHE_DIR under a key made from the source files, the code
+#and the parameters it depends on, so a rerun (or a different alpha) only recomputes what actually changed.
+#Each table is cleaned as it is loaded (the fixes are explained in the sections below and live in megaline_io.py).
+CACHE_DIR = '.megaline_cache'
+#Every stage that runs is measured (wall and CPU time, memory, rows in and out) and the run log is saved at the end.
+#Set MEGALINE_PROFILE_STAGE to a stage name (e.g. bill) to also run that stage under cProfile.
+profiler = StageProfiler()
+pipeline = Pipeline('/datasets', cache_dir=os.path.join(CACHE_DIR, 'stages'), profiler=profiler)
+calls, internet, messages, plans, users = pipeline.get('clean')
+
+#Before cleaning, every raw table goes through the data-quality rules of megaline_validate.py (duplicate ids, unknown
+#users and plans, missing or negative values, events before registration or after churn); rows breaking a rule are
+#dropped, quarantined or only counted, by rule
+quality = pipeline.get('quality')
+print(quality.summary)
+print(quality.rules[quality.rules['rows'] > 0])
 
 # Print the general/summary information about the plans' DataFrame
 plans.info()
@@ -17,15 +37,9 @@ plans.info()
 # Print a sample of data for plans
 plans
 
-#converted MB to GB for easier calculation later
-plans['gb_per_month_included']=plans['mb_per_month_included']/1024
-
-plans
-#confirmed column name and data for GB was added.
-
+#converted MB to GB for easier calculation later (gb_per_month_included, added in clean_plans at load time)
 #In the plans table, the column is called plan_name. 
-#In the users table, the column is called plan. Renaming the column to prevent confusion later
-plans = plans.rename(columns={'plan_name': 'plan'})
+#In the users table, the column is called plan. Renamed the column at load time to prevent confusion later
 
 #confirm change
 print(plans.columns)
@@ -37,12 +51,8 @@ users.info()
 # Print a sample of data for users
 users
 
-#Fixing the d-type for reg_date
-users['reg_date'] = pd.to_datetime(users['reg_date'])
-
-#will also fix d-type of churn_date because currently Python treats this data like words/names.
-users['churn_date']=pd.to_datetime(users['churn_date'])
-
+#Fixing the d-type for reg_date and churn_date (done in clean_users at load time)
+#churn_date also needs it because otherwise Python treats this data like words/names.
 users.info()
 
 """
@@ -63,18 +73,17 @@ dtype, must be converted to datetime64. There are issues with duration dtype, mu
 up and converted to an integer since Megaline rounds up to the nearest minute for every call.
 """
 
-#Fix the data
+#Fix the data (done in clean_calls at load time)
 #Convert call_date to datetime
-calls['call_date'] = pd.to_datetime(calls['call_date'])
 
-#Check for 0-duration calls before rounding
-print(f"Number of 0-minute calls before: {(calls['duration'] == 0).sum()}")
+#Check for 0-duration calls before rounding: the zero_duration rule of the data-quality report counts
+#them in the raw calls, as read from the CSV file
+print(f"Number of 0-minute calls before: {quality.rules.loc[('calls', 'zero_duration'), 'rows']}")
 
 #Round up duration and convert to integer
 # his turns 8.52 into 9 and 0.37 into 1. np.ceil(0) remains 0.
-calls['duration'] = np.ceil(calls['duration']).astype(int)
 
-#Confirm they are still 0 after rounding
+#Confirm 0-duration calls are still 0 after rounding
 print(f"Number of 0-minute calls after: {(calls['duration'] == 0).sum()}")
 
 calls.info()
@@ -96,8 +105,7 @@ messages
 """
 There are no missing values. I will need to fix message_date dtype. Important to note that each row in the table represents a single message.
 """
-# Convert message_date to datetime
-messages['message_date']=pd.to_datetime(messages['message_date'])
+# Convert message_date to datetime (done in clean_messages at load time)
 messages.info()
 messages.head()
 
@@ -113,8 +121,7 @@ also noticed sessions with 0.0 MB usage; I've decided to keep them as they repre
 connection attempts.
 """
 
-#Change session_date to datetime dtype. 
-internet['session_date']=pd.to_datetime(internet['session_date'])
+#Change session_date to datetime dtype (done in clean_internet at load time).
 
 # Check for 0-MB sessions
 zero_sessions = internet[internet['mb_used'] == 0]
@@ -154,64 +161,17 @@ Clarification on Missed Calls & Rounding: As noted in the Data Preprocessing sec
 aligns with Megaline's policy that only connected calls are billed. When calculating monthly revenue, these zero-duration calls add 0 to the total minutes and therefore do not trigger
 overage charges or affect the final billing.
 """
-# Calculate the number of calls made by each user per month. Save the result.
-#create a month column 
-calls['month']=calls['call_date'].dt.month
-#Group by user, month and count the call IDs
-calls_per_month = calls.groupby(['user_id', 'month'])['id'].count().reset_index()
-#Rename columns
-calls_per_month.columns = ['user_id', 'month', 'calls_count']
-#see result
-calls_per_month.head()
-
-# Calculate the amount of minutes spent by each user per month. Save the result.
-#Groupby user and month, and add number of minutes(duration)
-minutes_per_month=calls.groupby(['user_id','month'])['duration'].sum().reset_index()
-#rename columns 
-minutes_per_month.columns=['user_id', 'month', 'minutes_sum']
-minutes_per_month.head()
-
-# Calculate the number of messages sent by each user per month. Save the result.
-#Create a month column 
-messages['month']=messages['message_date'].dt.month
-#Groupby user_id and month & count id. 
-messages_per_month=messages.groupby(['user_id','month'])['id'].count().reset_index()
-#rename columns
-messages_per_month.columns=['user_id','month','messages_count']
-messages_per_month.head()
-
-# Calculate the volume of internet traffic used by each user per month. Save the result.
-#Create a month column 
-internet['month']=internet['session_date'].dt.month
-#Groupby user_id & month and count mb_used
-internet_per_month=internet.groupby(['user_id','month'])['mb_used'].sum().reset_index()
-#Rename columnsn for clarity
-internet_per_month.columns=['user_id','month', 'mb_used_total']
-
-#Convert total MB to GB and round UP according to Megaline policy
-#Note: 1 GB = 1024 MB
-internet_per_month['gb_used_billed'] = np.ceil(internet_per_month['mb_used_total'] / 1024).astype(int)
-
-internet_per_month.head()
-internet_per_month.head()
-
-#Merge the data for calls, minutes, messages, internet based on user_id and month
-#Merge calls and minutes (since they have the same number of rows)
-df_usage = pd.merge(calls_per_month, minutes_per_month, on=['user_id', 'month'], how='outer')
-#Add the messages count
-df_usage = pd.merge(df_usage, messages_per_month, on=['user_id', 'month'], how='outer')
-#Add internet traffic 
-df_usage = pd.merge(df_usage, internet_per_month, on=['user_id', 'month'], how='outer')
-# Fill in NaN's. After an outer merge, if someone didn't use a service, it shows 'NaN'.
-df_usage = df_usage.fillna(0)
+# Calculate the number of calls, the minutes, the number of messages and the internet traffic of each user per month. Save the result.
+#All four totals are computed in one pass over each log: every (user_id, month) pair is encoded as a single integer key
+#and the totals are added up per key, so there are no separate groupbys and no outer merges to stitch them together.
+#User-months without calls, messages or sessions for a service get 0 for that service.
+#Internet traffic is also converted to GB and rounded UP according to Megaline policy (1 GB = 1024 MB) in gb_used_billed.
+df_usage = pipeline.get('aggregate')
 df_usage.head()
 
-# Add the plan information
-df_merged = df_usage.merge(users[['user_id', 'plan', 'city']], on='user_id', how='left')
-# add the plan details (costs and limits)
-df_merged = df_merged.merge(plans, on='plan', how='left')
-#Fill in any NaN's
-df_merged=df_merged.fillna(0)
+# Add the plan information and the plan details (costs and limits), then fill in any NaN's (merge_plans)
+#A copy, because columns are added to df_merged below and the stage result is shared
+df_merged = pipeline.get('merge').copy()
 df_merged
 
 #Calculate the monthly revenue for each user
@@ -239,24 +199,33 @@ def calculate_revenue(row):
         
     return total_bill
 
-#Apply the function
-df_merged['revenue'] = df_merged.apply(calculate_revenue, axis=1)
+#Bill every user-month at once with the vectorized billing engine (same rules as calculate_revenue;
+#tests/test_billing.py checks every user-month against it to the cent)
+bills = pipeline.get('bill')
+df_merged['revenue'] = bills['revenue']
+
+#Revenue breakdown by charge
+bills.head()
+
+#Summarize every metric once per plan, month, region and cohort (count, sum, sum of squares, min, max).
+#The means, variances and tests below come straight from this cube instead of re-filtering df_merged for every number.
+cube = pipeline.get('stats')
+save_cube(cube, CACHE_DIR)
+#The bills are saved to BILLS_DIR, with the data-quality report and the quarantined rows next to them
+save_bills(bills, BILLS_DIR)
+write_report(quality, BILLS_DIR)
 
 #Clean up display
 df_merged[['user_id', 'month', 'plan', 'revenue']].head()
 
-# Compare average duration of calls per each plan per each distinct month. Plot a bar plat to visualize it.
-# Group by plan and month, then calculate the average duration
-avg_calls = df_merged.groupby(['plan', 'month'])['minutes_sum'].mean()
+#Every chart of the analysis is reduced with NumPy to what is drawn (bins, box statistics, bar heights) and saved to
+#CHART_DIR by a process pool instead of blocking on plt.show(); each cell below names the file of its chart.
+CHART_DIR = 'charts'
+chart_files = render_report(report_specs(df_merged, cube, users), CHART_DIR)
+print(f'{len(chart_files)} charts saved to {CHART_DIR}/')
 
-# Plot as a bar chart
-avg_calls.plot(kind='bar', figsize=(12, 6), color='skyblue')
-
-# Add labels so the chart is readable
-plt.title('Average Call Duration per Plan and Month')
-plt.xlabel('Plan, Month')
-plt.ylabel('Average Duration (minutes)')
-plt.show()
+# Compare average duration of calls per each plan per each distinct month. Plot a bar plat to visualize it.
+#Bar chart of the average per plan and month from the cube: charts/avg_minutes_per_plan_month.png
 
 """
 Observations for Average Call Duration Per Plan and Month
@@ -269,21 +238,7 @@ between 400 and 500 minutes.
 primary revenue driver for that plan.
 """
 # Compare the number of minutes users of each plan require each month. Plot a histogram.
-# Filter the data into two groups
-surf_minutes = df_merged.query('plan == "surf"')['minutes_sum']
-ultimate_minutes = df_merged.query('plan == "ultimate"')['minutes_sum']
-
-# Plot both histograms
-plt.figure(figsize=(10, 6))
-plt.hist(surf_minutes, bins=30, alpha=0.5, label='Surf', color='green')
-plt.hist(ultimate_minutes, bins=30, alpha=0.5, label='Ultimate', color='red')
-
-# Add labels and a legend
-plt.title('Distribution of Monthly Minutes by Plan')
-plt.xlabel('Minutes')
-plt.ylabel('Number of Users')
-plt.legend(loc='upper right')
-plt.show()
+#Histograms of both plans: charts/minutes_distribution.png
 
 """
 Observations about Monthly Minutes by Plan
@@ -293,31 +248,17 @@ surpassing the 500-minute mark. These specific instances are what drive the over
 """
 # Calculate the mean, variance and std of the monthly call duration
 # Calculate for Surf
-surf_mean = df_merged[df_merged['plan'] == 'surf']['minutes_sum'].mean()
-surf_variance = df_merged[df_merged['plan'] == 'surf']['minutes_sum'].var()
-surf_std = df_merged[df_merged['plan'] == 'surf']['minutes_sum'].std()
+surf_stats = slice_stats(cube, 'minutes_sum', plan='surf')
+surf_mean, surf_variance, surf_std = surf_stats['mean'], surf_stats['var'], surf_stats['std']
 # Calculate for Ultimate
-ultimate_mean = df_merged[df_merged['plan'] == 'ultimate']['minutes_sum'].mean()
-ultimate_variance = df_merged[df_merged['plan'] == 'ultimate']['minutes_sum'].var()
-ultimate_std = df_merged[df_merged['plan'] == 'ultimate']['minutes_sum'].std()
+ultimate_stats = slice_stats(cube, 'minutes_sum', plan='ultimate')
+ultimate_mean, ultimate_variance, ultimate_std = ultimate_stats['mean'], ultimate_stats['var'], ultimate_stats['std']
 # Print the results clearly
 print(f"Surf Plan: Mean = {surf_mean:.2f}, Variance = {surf_variance:.2f},Std Dev = {surf_std:.2f}")
 print(f"Ultimate Plan: Mean = {ultimate_mean:.2f}, Variance = {ultimate_variance:.2f},Std Dev = {ultimate_std:.2f}")
 
 # Plot a boxplot to visualize the distribution of the monthly call duration
-# Prepare the data piles
-surf_minutes = df_merged[df_merged['plan'] == 'surf']['minutes_sum']
-ultimate_minutes = df_merged[df_merged['plan'] == 'ultimate']['minutes_sum']
-
-# Plot
-plt.figure(figsize=(10, 6))
-plt.boxplot([surf_minutes, ultimate_minutes], labels=['Surf', 'Ultimate'])
-
-# Add labels
-plt.title('Monthly Call Duration Distribution by Plan')
-plt.ylabel('Minutes')
-plt.grid(axis='y', linestyle='--', alpha=0.7)
-plt.show()
+#Box plot of both plans: charts/minutes_boxplot.png
 
 """
 Conclusion about users and calling (comparing plans)
@@ -327,26 +268,15 @@ In contrast, 0% of Ultimate user-months ever reach the 3,000-minute threshold.
 This confirms that Ultimate users are paying a premium for a massive volume of minutes they do not use, while Megaline's additional revenue is primarily driven by Surf users exceeding their much lower limits.
 """
 # Calculate the percentage of user-months that exceed the plan limits
-surf_over_limit = len(df_merged[(df_merged['plan'] == 'surf') & (df_merged['minutes_sum'] > 500)]) / len(df_merged[df_merged['plan'] == 'surf'])
-ultimate_over_limit = len(df_merged[(df_merged['plan'] == 'ultimate') & (df_merged['minutes_sum'] > 3000)]) / len(df_merged[df_merged['plan'] == 'ultimate'])
+#(minutes over the plan's minutes_included: 500 for Surf, 3000 for Ultimate)
+surf_over_limit = over_limit_rate(cube, 'over_minutes', plan='surf')
+ultimate_over_limit = over_limit_rate(cube, 'over_minutes', plan='ultimate')
 
 print(f"Percentage of Surf user-months exceeding 500 min: {surf_over_limit:.2%}")
 print(f"Percentage of Ultimate user-months exceeding 3000 min: {ultimate_over_limit:.2%}")
 
 # Compare the number of messages users of each plan tend to send each month. Plot a bar plat to visualize it
-avg_messages = df_merged.groupby(['plan', 'month'])['messages_count'].mean()
-
-# 2. Plot as a bar chart
-avg_messages.plot(kind='bar', figsize=(12, 6), color='lightgreen')
-
-# Add labels for clarity
-plt.title('Average Monthly Messages per Plan')
-plt.xlabel('Plan and Month (1=Jan, 12=Dec)')
-plt.ylabel('Average Number of Messages')
-
-# Rotate the x-labels so they don't overlap
-plt.xticks(rotation=45)
-plt.show()
+#Bar chart of the average per plan and month from the cube: charts/avg_messages_per_plan_month.png
 
 """
 Observations for Average Monthly Messages per Plan
@@ -357,21 +287,7 @@ Observations for Average Monthly Messages per Plan
 
 # Compare the amount of internet traffic consumed by users per plan. Plot a histogram.
 #Creating a histogram to compare message usage 
-# Separate the message counts for each plan
-surf_messages = df_merged[df_merged['plan'] == 'surf']['messages_count']
-ultimate_messages = df_merged[df_merged['plan'] == 'ultimate']['messages_count']
-
-# Plot the histograms
-plt.figure(figsize=(10, 6))
-plt.hist(surf_messages, bins=30, alpha=0.5, label='Surf', color='lightgreen')
-plt.hist(ultimate_messages, bins=30, alpha=0.5, label='Ultimate', color='blue')
-
-# Add details
-plt.title('Distribution of Monthly Messages by Plan')
-plt.xlabel('Number of Messages')
-plt.ylabel('Number of Users')
-plt.legend()
-plt.show()
+#Histograms of both plans: charts/messages_distribution.png
 
 """
 Observations for Monthly Messages by Plan
@@ -380,38 +296,23 @@ Observations for Monthly Messages by Plan
 3. For messages, Ultimate users are essentially paying for an "infinite" resource they barely touch.
 """
 #calculate mean and variance for messages
-surf_msg_mean = df_merged[df_merged['plan'] == 'surf']['messages_count'].mean()
-surf_msg_var = df_merged[df_merged['plan'] == 'surf']['messages_count'].var()
+surf_msg = slice_stats(cube, 'messages_count', plan='surf')
+surf_msg_mean, surf_msg_var = surf_msg['mean'], surf_msg['var']
 
-ultimate_msg_mean = df_merged[df_merged['plan'] == 'ultimate']['messages_count'].mean()
-ultimate_msg_var = df_merged[df_merged['plan'] == 'ultimate']['messages_count'].var()
+ultimate_msg = slice_stats(cube, 'messages_count', plan='ultimate')
+ultimate_msg_mean, ultimate_msg_var = ultimate_msg['mean'], ultimate_msg['var']
 
 print(f"Surf Messages: Mean = {surf_msg_mean:.2f}, Variance = {surf_msg_var:.2f}")
 print(f"Ultimate Messages: Mean = {ultimate_msg_mean:.2f}, Variance = {ultimate_msg_var:.2f}")
 
 #Plot a boxplot
-plt.figure(figsize=(10, 6))
-plt.boxplot([df_merged[df_merged['plan'] == 'surf']['messages_count'], 
-             df_merged[df_merged['plan'] == 'ultimate']['messages_count']], 
-            labels=['Surf', 'Ultimate'])
-
-plt.title('Distribution of Monthly Messages')
-plt.ylabel('Number of Messages')
-plt.show()
+#Box plot of both plans: charts/messages_boxplot.png
 
 """
 Conclusion on how users behave in terms of messaging: Users do not change their texting habits based on their plan.
 The Surf plan is more likely to generate extra revenue from "extreme texters", while the Ultimate plan provides a massive surplus of messages that the average user never touches.
 """
-# Create the billed GB column in the main dataframe
-df_merged['gb_used_billing'] = np.ceil(df_merged['mb_used_total'] / 1024).astype(int)
-avg_internet = df_merged.groupby(['plan', 'month'])['gb_used_billing'].mean()
-# Plot
-avg_internet.plot(kind='bar', figsize=(12, 6), color='orange')
-plt.title('Average Monthly GB Used per Plan')
-plt.ylabel('Average GB')
-plt.xticks(rotation=45)
-plt.show()
+#Bar chart of the average billed GB (monthly MB total rounded up to whole GB) per plan and month: charts/avg_gb_per_plan_month.png
 
 """
 Observations for Avg Monthly GB used per plan
@@ -421,17 +322,7 @@ the service the total volume of data on the network increases.
 as the price gap suggests. Users on both plans seem to follow the same seasonal usage patterns.
 """
 #plot histogram 
-surf_net = df_merged[df_merged['plan'] == 'surf']['gb_used_billing']
-ultimate_net = df_merged[df_merged['plan'] == 'ultimate']['gb_used_billing']
-
-plt.figure(figsize=(10, 6))
-plt.hist(surf_net, bins=30, alpha=0.5, label='Surf', color='orange')
-plt.hist(ultimate_net, bins=30, alpha=0.5, label='Ultimate', color='blue')
-plt.title('Distribution of Internet Usage')
-plt.xlabel('GB')
-plt.ylabel('Number of Users')
-plt.legend()
-plt.show()
+#Histograms of both plans: charts/internet_distribution.png
 
 """
 Observation for histogram
@@ -441,15 +332,13 @@ Even though Ultimate users have double the data of Surf users, they do not drama
 Most Ultimate users are paying for data they never touch.
 """
 #calculate variance and mean 
-print(f"Surf Internet: Mean = {surf_net.mean():.2f}, Variance = {surf_net.var():.2f}")
-print(f"Ultimate Internet: Mean = {ultimate_net.mean():.2f}, Variance = {ultimate_net.var():.2f}")
+surf_net_stats = slice_stats(cube, 'gb_used_billed', plan='surf')
+ultimate_net_stats = slice_stats(cube, 'gb_used_billed', plan='ultimate')
+print(f"Surf Internet: Mean = {surf_net_stats['mean']:.2f}, Variance = {surf_net_stats['var']:.2f}")
+print(f"Ultimate Internet: Mean = {ultimate_net_stats['mean']:.2f}, Variance = {ultimate_net_stats['var']:.2f}")
 
 #create a boxplot
-plt.figure(figsize=(10, 6))
-plt.boxplot([surf_net, ultimate_net], labels=['Surf', 'Ultimate'])
-plt.title('Internet Usage Distribution (GB)')
-plt.ylabel('GB Used')
-plt.show()
+#Box plot of both plans: charts/internet_boxplot.png
 
 """
 Conclusion on Internet Usage Distribution
@@ -459,17 +348,7 @@ few months out of the year. Also, Surf users are high-value for Megaline because
 are high-value because they pay a 70 dollar flat fee for a 30 GB allowance that the histogram shows they almost never fully use.
 """
 #Bar plot Average Revenue per Month
-#Group by plan and month to see the trend
-avg_revenue = df_merged.groupby(['plan', 'month'])['revenue'].mean().unstack(level=0)
-
-# Plotting
-avg_revenue.plot(kind='bar', figsize=(12, 6), color=['orange', 'red'])
-plt.title('Average Monthly Revenue: Surf vs. Ultimate')
-plt.xlabel('Month')
-plt.ylabel('Average Revenue ($)')
-plt.legend(['Surf', 'Ultimate'])
-plt.xticks(rotation=0)
-plt.show()
+#Both plans side by side for every month, from the cube: charts/avg_revenue_per_month.png
 
 """
 Observations
@@ -477,19 +356,27 @@ Observations
 2. Ultimates revenue is consistent over the year.
 3. Surfs most consistent month is December.
 """
-#Histogram Revenue Distribution
-surf_rev = df_merged[df_merged['plan'] == 'surf']['revenue']
-ultimate_rev = df_merged[df_merged['plan'] == 'ultimate']['revenue']
+"""
+Cohort view: the monthly averages mix long-time customers with users who only joined that month (and paid for part of it),
+and more users join as the year goes on. To separate behavior from the growing user base, I group users by registration month.
+"""
+#Last month with usage in the data
+last_month = usage_month_index(df_merged).max()
+
+#Share of each registration cohort still active in every month (heat map: charts/retention.png)
+retention = retention_matrix(users, last_month, rates=True)
+retention
+
+#Share of users who churned within k months of registering, per plan (charts/churn_curve.png)
+churn_curve(users, last_month)
 
-plt.figure(figsize=(10, 6))
-plt.hist(surf_rev, bins=30, alpha=0.5, label='Surf', color='orange')
-plt.hist(ultimate_rev, bins=30, alpha=0.5, label='Ultimate', color='skyblue')
+#Average monthly revenue with every month standardized to the same tenure mix (charts/adjusted_revenue_per_month.png)
+adjusted_revenue = cohort_adjusted_mean(df_merged, users)
+adjusted_revenue[['surf', 'ultimate']]
 
-plt.title('Distribution of Monthly Revenue per User')
-plt.xlabel('Revenue ($)')
-plt.ylabel('Number of Users')
-plt.legend()
-plt.show()
+#Histogram Revenue Distribution (charts/revenue_distribution.png)
+surf_rev = df_merged[df_merged['plan'] == 'surf']['revenue']
+ultimate_rev = df_merged[df_merged['plan'] == 'ultimate']['revenue']
 
 """
 Observations
@@ -497,20 +384,14 @@ Observations
 2. Surf plan data is wider comapred to Ultimate because users have very different bills.
 3. Surf plan data aslo has a positive skew which implies most Surf users are clustered on the left side. These are the people who manage to stay close to their limits.
 """
-surf_rev = df_merged[df_merged['plan'] == 'surf']['revenue']
-ultimate_rev = df_merged[df_merged['plan'] == 'ultimate']['revenue']
+surf_rev_stats = slice_stats(cube, 'revenue', plan='surf')
+ultimate_rev_stats = slice_stats(cube, 'revenue', plan='ultimate')
 
 # Now the print statements will work
-print(f"Surf Revenue: Mean = {surf_rev.mean():.2f}, Variance = {surf_rev.var():.2f}, Std Dev = {surf_rev.std():.2f}")
-print(f"Ultimate Revenue: Mean = {ultimate_rev.mean():.2f}, Variance = {ultimate_rev.var():.2f}, Std Dev = {ultimate_rev.std():.2f}")
+print(f"Surf Revenue: Mean = {surf_rev_stats['mean']:.2f}, Variance = {surf_rev_stats['var']:.2f}, Std Dev = {surf_rev_stats['std']:.2f}")
+print(f"Ultimate Revenue: Mean = {ultimate_rev_stats['mean']:.2f}, Variance = {ultimate_rev_stats['var']:.2f}, Std Dev = {ultimate_rev_stats['std']:.2f}")
 
-#Box Plot to visualize the "Profit Zone"
-plt.figure(figsize=(10, 6))
-plt.boxplot([surf_rev, ultimate_rev], labels=['Surf', 'Ultimate'])
-plt.title('Revenue Range and Outliers by Plan')
-plt.ylabel('Revenue ($)')
-plt.grid(axis='y', linestyle='--', alpha=0.7)
-plt.show()
+#Box Plot to visualize the "Profit Zone" (charts/revenue_boxplot.png)
 
 """
 Conclusion: While the Ultimate plan provides a higher guaranteed monthly income of $70 per
@@ -538,8 +419,8 @@ have unequal variances and different sample sizes, Welch's T-test is the appropr
 #Set the alpha
 alpha = 0.05
 
-#Perform the test
-results = st.ttest_ind(surf_rev, ultimate_rev, equal_var=False)
+#Perform the test (Welch's t-test from the per-plan count, mean and variance in the cube)
+results = welch_test(cube, 'revenue', {'plan': 'surf'}, {'plan': 'ultimate'})
 
 print('p-value:', results.pvalue)
 
@@ -549,6 +430,15 @@ if results.pvalue < alpha:
 else:
     print("We cannot reject the null hypothesis: There is no significant difference in revenue.")
 
+"""
+Resampling check: the Surf revenue distribution is heavily right-skewed, so the normal approximation behind the t-test
+may not hold well. As a check that does not rely on it, I also compute a bootstrap confidence interval for the difference
+in average revenue and a permutation test of equal averages (100,000 resamples each, fixed seed).
+"""
+with profiler.stage('resampling_plans', rows_in=len(surf_rev) + len(ultimate_rev)):
+    print(bootstrap_diff(surf_rev, ultimate_rev))
+    print(permutation_test(surf_rev, ultimate_rev))
+
 """
 Hypothesis Testing: NY-NJ Area vs. Other Regions
 
@@ -565,14 +455,18 @@ Justification for Welch’s T-test: I have used equal_var=False because the samp
  """
 #Test the hypothesis to see if revenue in NY-NJ is different from other regions.
 #Filter the two groups
-nynj_revenue = df_merged[df_merged['city'].str.contains('NY-NJ', case=False)]['revenue']
-other_revenue = df_merged[~df_merged['city'].str.contains('NY-NJ', case=False)]['revenue']
+#city was split into categorical metro and states columns when loading, so the text search only runs over the distinct metros
+nynj_metros = users.loc[users['states'].str.contains('NY-NJ', case=False), 'metro'].unique()
+other_metros = users.loc[~users['metro'].isin(nynj_metros), 'metro'].unique()
+in_nynj = df_merged['user_id'].isin(users.loc[users['metro'].isin(nynj_metros), 'user_id'])
+nynj_revenue = df_merged[in_nynj]['revenue']
+other_revenue = df_merged[~in_nynj]['revenue']
 
 #Set the alpha
 alpha = 0.05
 
-#Perform the test
-results = st.ttest_ind(nynj_revenue, other_revenue, equal_var=False)
+#Perform the test (Welch's t-test from the cube: NY-NJ metros vs. every other metro)
+results = welch_test(cube, 'revenue', {'region': nynj_metros}, {'region': other_metros})
 
 print('p-value:', results.pvalue)
 
@@ -582,6 +476,23 @@ if results.pvalue < alpha:
 else:
     print("We cannot reject the null hypothesis: There is no significant difference in revenue.")
 
+#Same resampling check for the regional comparison
+with profiler.stage('resampling_regions', rows_in=len(nynj_revenue) + len(other_revenue)):
+    print(bootstrap_diff(nynj_revenue, other_revenue))
+    print(permutation_test(nynj_revenue, other_revenue))
+
+"""
+All metro areas at once: NY-NJ is only one region. Here every metro area is compared with the rest of the country
+(Welch's t-test from the per-metro count, sum and M2 pooled from the cube), the metros are ranked by average revenue,
+and the p-values are corrected for the false discovery rate because many regions are tested at the same time.
+"""
+region_ranking = pipeline.get('region_test', alpha=alpha)
+print(region_ranking)
+
+#Time, CPU time, memory and rows of every stage of this run; the records are appended to the run log
+print(profiler.summary())
+profiler.save()
+
 """
 General Conclusion
 The analysis of the Surf and Ultimate plans reveals that data consumption, rather than call minutes or messages, is the primary driver of revenue. During the data preprocessing stage, all
@@ -0,0 +1,203 @@
+"""
+Scaled benchmark of the Megaline pipeline on synthetic data.
+
+For every user count, synthetic CSV files are generated once (megaline_synth.py, kept under
+BENCH_DIR and reused by later runs) and every stage of the analysis is timed on them:
+
+    load        typed CSV reading (with pyarrow the dates are parsed here)
+    validate    data-quality rules of every table (megaline_validate.py)
+    clean       date conversion and the other clean_* fixes
+    aggregate   monthly usage per user (df_usage)
+    merge       users and plans joined to df_usage
+    compact     df_usage in the compact layout (megaline_compact.py)
+    billing     revenue of every user-month, in integer cents on the compact layout
+    statistics  statistics cube (from the compact layout), per-plan statistics, Welch test and
+                regional tests
+    plotting    chart specs and headless rendering of the full chart set
+
+Above MAX_IN_MEMORY_USERS the event logs are not loaded at all: load, validate, clean and
+aggregate are replaced by one stream_aggregate stage (aggregate_usage_chunked straight from the
+CSV files, without validation).
+
+Like the pipeline's periods parameter, PERIODS ('calendar' or 'cycle', megaline_periods) bills
+the billing periods of that scheme with every user's first and last period prorated, on both
+paths; by default whole calendar months are billed.
+
+Every run is appended to HISTORY_FILE with the commit it ran on, and the latest run is compared
+with the best earlier time of the same stage, size and periods, so regressions show up as ratios
+above REGRESSION_RATIO.
+
+Usage:
+    python megaline_bench.py [PERIODS] [N_USERS ...]      (default: 1000 10000 100000)
+"""
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from datetime import datetime, timezone
+
+import pandas as pd
+
+from megaline_billing import merge_plans
+from megaline_charts import render_report, report_specs
+from megaline_compact import bill_dollars, compact_bills, compact_cube, compact_usage
+from megaline_cube import slice_stats, welch_test
+from megaline_io import CLEANERS, TABLE_FILES, read_csv_schema, read_table
+from megaline_periods import PERIOD_SCHEMES
+from megaline_profiling import StageProfiler
+from megaline_regions import batch_region_test
+from megaline_synth import write_synthetic_csv
+from megaline_usage import aggregate_usage, aggregate_usage_chunked
+from megaline_validate import validate_tables
+
+BENCH_DIR = '.megaline_bench'
+HISTORY_FILE = os.path.join(BENCH_DIR, 'history.csv')
+
+SIZES = [1_000, 10_000, 100_000]
+
+# Larger runs stream the event logs instead of loading them (about 635 events per user)
+MAX_IN_MEMORY_USERS = 100_000
+
+REGRESSION_RATIO = 1.2
+
+# Stages faster than this are too noisy to flag
+MIN_SECONDS = 0.05
+
+
+def synthetic_data(n_users, seed=0, bench_dir=BENCH_DIR):
+    """Directory with the synthetic CSV files for n_users, generated on first use."""
+    data_dir = os.path.join(bench_dir, 'data', f'users_{n_users}_seed_{seed}')
+    manifest_path = os.path.join(data_dir, 'rows.json')
+    if not os.path.exists(manifest_path):
+        rows = write_synthetic_csv(data_dir, n_users, seed)
+        #Written last, so an interrupted generation is redone
+        with open(manifest_path, 'w') as f:
+            json.dump(rows, f)
+    return data_dir
+
+
+def event_count(data_dir):
+    with open(os.path.join(data_dir, 'rows.json')) as f:
+        rows = json.load(f)
+    return rows['calls'] + rows['messages'] + rows['internet']
+
+
+def period_options(users, periods):
+    """Keyword arguments of aggregate_usage and aggregate_usage_chunked for periods (None: whole calendar months)."""
+    if periods is None:
+        return {}
+    return {'users': users, 'scheme': periods}
+
+
+def run_pipeline(data_dir, n_users, profiler=None, periods=None):
+    """Run every stage once on the files in data_dir; returns the StageProfiler with one record per stage."""
+    profiler = profiler or StageProfiler(trace_memory=False)
+    timed = profiler.run_stage
+    paths = {name: os.path.join(data_dir, file) for name, file in TABLE_FILES.items()}
+    plans = read_table('plans', data_dir)
+    if n_users <= MAX_IN_MEMORY_USERS:
+        raw = timed('load', lambda: {name: read_csv_schema(name, path) for name, path in paths.items()})
+        valid = timed('validate', lambda raw: validate_tables(raw).tables, raw)
+        tables = timed('clean', lambda valid: {name: CLEANERS[name](df) for name, df in valid.items()}, valid)
+        users = tables['users']
+        df_usage = timed('aggregate', aggregate_usage, tables['calls'], tables['messages'], tables['internet'],
+                         **period_options(users, periods))
+    else:
+        users = read_table('users', data_dir)
+        df_usage = timed('stream_aggregate', aggregate_usage_chunked, paths['calls'], paths['messages'],
+                         paths['internet'], **period_options(users, periods))
+
+    df_merged = timed('merge', merge_plans, df_usage, users, plans)
+    compact = timed('compact', compact_usage, df_usage, users, plans)
+    cents = timed('billing', compact_bills, compact, plans)
+    df_merged['revenue'] = bill_dollars(cents)['revenue']
+
+    def statistics():
+        cube = compact_cube(compact, cents, plans, users)
+        for plan in ['surf', 'ultimate']:
+            slice_stats(cube, 'revenue', plan=plan)
+        welch_test(cube, 'revenue', {'plan': 'surf'}, {'plan': 'ultimate'})
+        batch_region_test(cube, 'revenue')
+        return cube
+
+    cube = timed('statistics', statistics)
+    with tempfile.TemporaryDirectory() as out_dir, profiler.stage('plotting', rows_in=len(df_merged)) as stage:
+        stage['rows_out'] = len(render_report(report_specs(df_merged, cube), out_dir))
+    return profiler
+
+
+def git_commit():
+    """Short hash of the checked-out commit ('' outside a git checkout)."""
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def benchmark(sizes=SIZES, seed=0, repeats=None, bench_dir=BENCH_DIR, periods=None):
+    """
+    Time every stage at every size (best of repeats; by default 3 runs up to 10,000 users, else 1),
+    billing the periods of run_pipeline.
+
+    Returns one row per size and stage with the wall and CPU seconds of the fastest run.
+    """
+    run = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+    commit = git_commit()
+    rows = []
+    for n_users in sizes:
+        data_dir = synthetic_data(n_users, seed, bench_dir)
+        runs = [run_pipeline(data_dir, n_users, periods=periods).summary()
+                for _ in range(repeats or (3 if n_users <= 10_000 else 1))]
+        for stage in runs[0].index:
+            fastest = min(runs, key=lambda summary: summary.loc[stage, 'wall_seconds'])
+            rows.append({'run': run, 'commit': commit, 'n_users': n_users, 'events': event_count(data_dir),
+                         'seed': seed, 'periods': str(periods), 'stage': stage,
+                         'seconds': fastest.loc[stage, 'wall_seconds'],
+                         'cpu_seconds': fastest.loc[stage, 'cpu_seconds']})
+    return pd.DataFrame(rows)
+
+
+def record(results, history_file=HISTORY_FILE):
+    """Append a benchmark run to the history file."""
+    os.makedirs(os.path.dirname(history_file) or '.', exist_ok=True)
+    if os.path.exists(history_file):
+        history = pd.read_csv(history_file)
+        if list(history.columns) != list(results.columns):
+            #Columns were added since the file was started: rewrite it with all columns
+            pd.concat([history, results], ignore_index=True).to_csv(history_file, index=False)
+            return
+    results.to_csv(history_file, mode='a', header=not os.path.exists(history_file), index=False)
+
+
+def compare_with_history(results, history_file=HISTORY_FILE):
+    """
+    Seconds of every stage next to the best earlier time of the same stage, size and periods
+    (before this run was recorded); ratio > REGRESSION_RATIO marks a regression (unless the stage
+    takes under MIN_SECONDS).
+    """
+    comparison = results.set_index(['n_users', 'periods', 'stage'])[['seconds']]
+    if os.path.exists(history_file):
+        history = pd.read_csv(history_file, dtype={'periods': str})
+        #Runs recorded before periods was a column billed whole calendar months
+        history['periods'] = history.get('periods', pd.Series(index=history.index, dtype=str)).fillna('None')
+        best = history.groupby(['n_users', 'periods', 'stage'])['seconds'].min().rename('best_before')
+        comparison = comparison.join(best)
+    else:
+        comparison['best_before'] = float('nan')
+    comparison['ratio'] = comparison['seconds'] / comparison['best_before']
+    comparison['regression'] = (comparison['ratio'] > REGRESSION_RATIO) & (comparison['seconds'] > MIN_SECONDS)
+    return comparison
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    periods = args.pop(0) if args and args[0] in PERIOD_SCHEMES else None
+    sizes = [int(float(arg)) for arg in args] or SIZES
+    results = benchmark(sizes, periods=periods)
+    comparison = compare_with_history(results)
+    record(results)
+    with pd.option_context('display.max_rows', None, 'display.width', 120):
+        print(comparison.round(3))
+    print(results.pivot_table(index='n_users', columns='stage', values='seconds', sort=False).round(3))
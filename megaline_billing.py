@@ -0,0 +1,96 @@
+"""
+Vectorized Megaline billing.
+
+Computes the same monthly bill as calculate_revenue() in megaline_analysis.py, but over whole
+columns at once instead of calling a Python function for every user-month. Usage tables built
+with the users table (aggregate_usage(..., users)) have the service days of every billing period;
+their first and last (churn) periods are billed a prorated base fee and prorated allowances.
+"""
+import os
+
+import numpy as np
+import pandas as pd
+
+from megaline_periods import prorate_allowance, prorate_fee
+from megaline_usage import USAGE_COLUMNS
+
+# Megaline converts MB to GB with 1 GB = 1024 MB
+MB_PER_GB = 1024
+
+CENTS_PER_USD = 100
+
+# Order in which the charges are added up (same order as calculate_revenue)
+BILL_COMPONENTS = ['base', 'minutes', 'messages', 'data']
+
+# Where the analysis writes the bills (bills.parquet) and the data-quality report of their input
+BILLS_DIR = 'bills'
+
+# Columns kept for every billed user-month by bill_usage
+BILL_COLUMNS = ['user_id', 'month', 'period', 'plan', 'city'] + USAGE_COLUMNS + ['gb_used_billed'] + BILL_COMPONENTS + ['revenue']
+
+
+def bill_components(df):
+    """
+    Bill every row of a usage table joined with the plan terms (like df_merged).
+
+    Returns a DataFrame on the same index with one column per charge (base, minutes, messages,
+    data) and their sum in 'revenue'. With service_days and period_days columns, the base fee is
+    prorated to the nearest cent and the allowances rounded down to whole minutes, messages and MB.
+    """
+    #Start with base monthly fee
+    base = df['usd_monthly_pay'].to_numpy(dtype=float)
+    minutes_included = df['minutes_included'].to_numpy(dtype=float)
+    messages_included = df['messages_included'].to_numpy(dtype=float)
+    mb_included = df['mb_per_month_included'].to_numpy(dtype=float)
+
+    #Partial first and last periods: fee and allowances for the days in service only
+    if 'service_days' in df.columns:
+        served = df['service_days'].to_numpy(dtype=np.int64)
+        length = df['period_days'].to_numpy(dtype=np.int64)
+        base = prorate_fee(np.round(base * CENTS_PER_USD), served, length) / CENTS_PER_USD
+        minutes_included = prorate_allowance(minutes_included, served, length).astype(float)
+        messages_included = prorate_allowance(messages_included, served, length).astype(float)
+        mb_included = prorate_allowance(mb_included, served, length).astype(float)
+
+    #Overage for minutes
+    extra_minutes = np.maximum(0, df['minutes_sum'].to_numpy(dtype=float) - minutes_included)
+    minutes = extra_minutes * df['usd_per_minute'].to_numpy(dtype=float)
+
+    #Overages for messages
+    extra_messages = np.maximum(0, df['messages_count'].to_numpy(dtype=float) - messages_included)
+    messages = extra_messages * df['usd_per_message'].to_numpy(dtype=float)
+
+    #Overage for internet: sum MB -> subtract limit -> convert the overage to GB and round UP
+    extra_mb = np.maximum(0, df['mb_used_total'].to_numpy(dtype=float) - mb_included)
+    data = np.ceil(extra_mb / MB_PER_GB) * df['usd_per_gb'].to_numpy(dtype=float)
+
+    #Add the charges up in the same order as calculate_revenue so the totals match exactly
+    revenue = base + minutes
+    revenue += messages
+    revenue += data
+
+    return pd.DataFrame({'base': base, 'minutes': minutes, 'messages': messages, 'data': data, 'revenue': revenue},
+                        index=df.index)
+
+
+def merge_plans(df_usage, users, plans):
+    """Add each user's plan, city and the plan terms to the usage table (the df_merged step)."""
+    df_merged = df_usage.merge(users[['user_id', 'plan', 'city']], on='user_id', how='left')
+    df_merged = df_merged.merge(plans, on='plan', how='left')
+    return df_merged.fillna(0)
+
+
+def bill_usage(df_usage, users, plans):
+    """Bill a usage table: add the plan terms, then the per-charge breakdown and revenue."""
+    df_merged = merge_plans(df_usage, users, plans)
+    bills = bill_components(df_merged)
+    return pd.concat([df_merged, bills], axis=1)[BILL_COLUMNS]
+
+
+def save_bills(bills, directory=BILLS_DIR):
+    """Write the bills to directory/bills.parquet; returns its path."""
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, 'bills.parquet')
+    bills.to_parquet(path + '.tmp', index=False)
+    os.replace(path + '.tmp', path)
+    return path
@@ -0,0 +1,233 @@
+"""
+Headless chart rendering for the Megaline report.
+
+Every chart of the analysis is first reduced with NumPy to what is actually drawn: histogram
+counts and bin edges, box-plot quartiles, whiskers and a bounded set of outliers, or the bar
+heights. Those small chart specs are then rendered to PNG/SVG files in a process pool with
+matplotlib's object-oriented Figure API, which needs no interactive backend and never blocks on
+plt.show(). Matplotlib never sees the millions of raw points.
+
+Usage:
+    python megaline_charts.py [OUT_DIR]
+"""
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from megaline_cohorts import churn_curve, cohort_adjusted_mean, period_axis, retention_matrix, usage_month_index
+
+BINS = 30
+
+# Outliers drawn per box at most (the most extreme ones are always kept)
+MAX_FLIERS = 500
+
+OUT_DIR = 'charts'
+
+PLAN_COLORS = {'surf': 'orange', 'ultimate': 'skyblue'}
+PLAN_LABELS = {'surf': 'Surf', 'ultimate': 'Ultimate'}
+
+
+def histogram_spec(name, title, xlabel, ylabel, series, bins=BINS):
+    """Histogram chart with one layer per (label, values, color) in series, binned like plt.hist(bins=30)."""
+    layers = []
+    for label, values, color in series:
+        counts, edges = np.histogram(np.asarray(values, dtype=float), bins=bins)
+        layers.append({'label': label, 'color': color, 'counts': counts, 'edges': edges})
+    return {'kind': 'hist', 'name': name, 'title': title, 'xlabel': xlabel, 'ylabel': ylabel, 'layers': layers}
+
+
+def box_stats(values, label):
+    """Quartiles, 1.5 IQR whiskers and outliers of one box, in the format of matplotlib's Axes.bxp."""
+    values = np.asarray(values, dtype=float)
+    q1, median, q3 = np.percentile(values, [25, 50, 75])
+    iqr = q3 - q1
+    inside = values[(values >= q1 - 1.5 * iqr) & (values <= q3 + 1.5 * iqr)]
+    fliers = np.unique(values[(values < q1 - 1.5 * iqr) | (values > q3 + 1.5 * iqr)])
+    if len(fliers) > MAX_FLIERS:
+        #Evenly spaced distinct outliers, including the smallest and the largest
+        fliers = fliers[np.linspace(0, len(fliers) - 1, MAX_FLIERS).round().astype(int)]
+    return {'label': label, 'med': median, 'q1': q1, 'q3': q3, 'whislo': inside.min(), 'whishi': inside.max(),
+            'fliers': fliers}
+
+
+def boxplot_spec(name, title, ylabel, series, grid=False):
+    """Box plot with one box per (label, values) in series."""
+    return {'kind': 'box', 'name': name, 'title': title, 'ylabel': ylabel, 'grid': grid,
+            'boxes': [box_stats(values, label) for label, values in series]}
+
+
+def bar_spec(name, title, xlabel, ylabel, heights, colors, legend=None, rotation=45):
+    """Bar chart of a Series (one bar per index entry) or a DataFrame (one group of bars per row)."""
+    frame = heights.to_frame() if isinstance(heights, pd.Series) else heights
+    return {'kind': 'bar', 'name': name, 'title': title, 'xlabel': xlabel, 'ylabel': ylabel,
+            'labels': [', '.join(map(str, key)) if isinstance(key, tuple) else str(key) for key in frame.index],
+            'heights': frame.to_numpy(dtype=float), 'colors': colors, 'legend': legend, 'rotation': rotation}
+
+
+def line_spec(name, title, xlabel, ylabel, lines, colors, legend=None):
+    """Line chart of a DataFrame: one line per column over the index."""
+    return {'kind': 'line', 'name': name, 'title': title, 'xlabel': xlabel, 'ylabel': ylabel,
+            'x': lines.index.to_numpy(dtype=float), 'ys': lines.to_numpy(dtype=float), 'colors': colors,
+            'legend': legend}
+
+
+def heatmap_spec(name, title, xlabel, ylabel, table):
+    """Heat map of a DataFrame (one cell per row and column), labelled with its index and columns."""
+    return {'kind': 'heatmap', 'name': name, 'title': title, 'xlabel': xlabel, 'ylabel': ylabel,
+            'values': table.to_numpy(dtype=float), 'xlabels': [str(label) for label in table.columns],
+            'ylabels': [str(label) for label in table.index]}
+
+
+def render_chart(spec, out_dir=OUT_DIR, formats=('png',)):
+    """Draw one chart spec and save it in every format; returns the written paths."""
+    from matplotlib.figure import Figure
+
+    fig = Figure(figsize=(12, 6) if spec['kind'] == 'bar' else (10, 6))
+    ax = fig.subplots()
+    if spec['kind'] == 'hist':
+        for layer in spec['layers']:
+            ax.stairs(layer['counts'], layer['edges'], fill=True, alpha=0.5, color=layer['color'], label=layer['label'])
+        ax.legend(loc='upper right')
+    elif spec['kind'] == 'box':
+        ax.bxp(spec['boxes'])
+        if spec['grid']:
+            ax.grid(axis='y', linestyle='--', alpha=0.7)
+    elif spec['kind'] == 'bar':
+        heights = spec['heights']
+        n_bars, n_groups = heights.shape
+        width = 0.8 / n_groups
+        x = np.arange(n_bars)
+        for group in range(n_groups):
+            ax.bar(x + (group - (n_groups - 1) / 2) * width, heights[:, group], width,
+                   color=spec['colors'][group % len(spec['colors'])])
+        ax.set_xticks(x, spec['labels'], rotation=spec['rotation'])
+        if spec['legend']:
+            ax.legend(spec['legend'])
+    elif spec['kind'] == 'line':
+        for line in range(spec['ys'].shape[1]):
+            ax.plot(spec['x'], spec['ys'][:, line], color=spec['colors'][line % len(spec['colors'])])
+        if spec['legend']:
+            ax.legend(spec['legend'])
+    elif spec['kind'] == 'heatmap':
+        image = ax.imshow(spec['values'], aspect='auto', cmap='viridis')
+        ax.set_xticks(np.arange(len(spec['xlabels'])), spec['xlabels'], rotation=90)
+        ax.set_yticks(np.arange(len(spec['ylabels'])), spec['ylabels'])
+        fig.colorbar(image, ax=ax)
+    ax.set_title(spec['title'])
+    ax.set_xlabel(spec.get('xlabel', ''))
+    ax.set_ylabel(spec['ylabel'])
+    fig.tight_layout()
+
+    paths = []
+    for fmt in formats:
+        path = os.path.join(out_dir, f"{spec['name']}.{fmt}")
+        fig.savefig(path)
+        paths.append(path)
+    return paths
+
+
+def render_report(specs, out_dir=OUT_DIR, formats=('png',), n_workers=None):
+    """Render all chart specs to out_dir in a process pool (n_workers=1 renders in this process)."""
+    os.makedirs(out_dir, exist_ok=True)
+    if n_workers == 1:
+        return [path for spec in specs for path in render_chart(spec, out_dir, formats)]
+    with ProcessPoolExecutor(n_workers) as pool:
+        results = pool.map(render_chart, specs, [out_dir] * len(specs), [formats] * len(specs))
+        return [path for paths in results for path in paths]
+
+
+def plan_month_means(cube, metric):
+    """
+    Average of a metric per plan and billing period, from the cube's sums and counts (labelled by
+    month number for one year of data, by 'YYYY-MM' across years).
+    """
+    totals = cube.groupby(['plan', 'period'], observed=True)[[metric + '_sum', 'n']].sum()
+    means = totals[metric + '_sum'] / totals['n']
+    axis = period_axis(means.index.get_level_values('period'))
+    means.index = pd.MultiIndex.from_arrays([means.index.get_level_values('plan'), axis], names=['plan', axis.name])
+    return means
+
+
+def report_specs(df_merged, cube, users=None):
+    """
+    Specs of the full chart set of the analysis (bar charts come from the cube). With the users
+    table, the cohort charts as well: retention by registration month, churn by plan and the
+    cohort-mix-adjusted average revenue.
+    """
+    #Row positions of every plan in one pass
+    positions = df_merged.groupby('plan', observed=True).indices
+    plans = [plan for plan in PLAN_LABELS if plan in positions]
+    by_plan = {plan: df_merged.iloc[positions[plan]] for plan in plans}
+    gb = {plan: np.ceil(by_plan[plan]['mb_used_total'].to_numpy() / 1024) for plan in plans}
+
+    def layers(column, colors):
+        return [(PLAN_LABELS[plan], by_plan[plan][column], colors[i]) for i, plan in enumerate(plans)]
+
+    def boxes(column):
+        return [(PLAN_LABELS[plan], by_plan[plan][column]) for plan in plans]
+
+    specs = [
+        bar_spec('avg_minutes_per_plan_month', 'Average Call Duration per Plan and Month', 'Plan, Month',
+                 'Average Duration (minutes)', plan_month_means(cube, 'minutes_sum'), ['skyblue'], rotation=90),
+        histogram_spec('minutes_distribution', 'Distribution of Monthly Minutes by Plan', 'Minutes',
+                       'Number of Users', layers('minutes_sum', ['green', 'red'])),
+        boxplot_spec('minutes_boxplot', 'Monthly Call Duration Distribution by Plan', 'Minutes', boxes('minutes_sum'),
+                     grid=True),
+        bar_spec('avg_messages_per_plan_month', 'Average Monthly Messages per Plan', 'Plan and Month (1=Jan, 12=Dec)',
+                 'Average Number of Messages', plan_month_means(cube, 'messages_count'), ['lightgreen']),
+        histogram_spec('messages_distribution', 'Distribution of Monthly Messages by Plan', 'Number of Messages',
+                       'Number of Users', layers('messages_count', ['lightgreen', 'blue'])),
+        boxplot_spec('messages_boxplot', 'Distribution of Monthly Messages', 'Number of Messages',
+                     boxes('messages_count')),
+        bar_spec('avg_gb_per_plan_month', 'Average Monthly GB Used per Plan', '', 'Average GB',
+                 plan_month_means(cube, 'gb_used_billed'), ['orange']),
+        histogram_spec('internet_distribution', 'Distribution of Internet Usage', 'GB', 'Number of Users',
+                       [(PLAN_LABELS[plan], gb[plan], color) for plan, color in zip(plans, ['orange', 'blue'])]),
+        boxplot_spec('internet_boxplot', 'Internet Usage Distribution (GB)', 'GB Used',
+                     [(PLAN_LABELS[plan], gb[plan]) for plan in plans]),
+        bar_spec('avg_revenue_per_month', 'Average Monthly Revenue: Surf vs. Ultimate', 'Month', 'Average Revenue ($)',
+                 plan_month_means(cube, 'revenue').unstack(level=0)[plans], ['orange', 'red'],
+                 legend=[PLAN_LABELS[plan] for plan in plans], rotation=0),
+        histogram_spec('revenue_distribution', 'Distribution of Monthly Revenue per User', 'Revenue ($)',
+                       'Number of Users', layers('revenue', [PLAN_COLORS[plan] for plan in plans])),
+        boxplot_spec('revenue_boxplot', 'Revenue Range and Outliers by Plan', 'Revenue ($)', boxes('revenue'),
+                     grid=True),
+    ]
+    if users is None:
+        return specs
+
+    #Last month with usage in the data
+    last_month = int(usage_month_index(df_merged).max())
+    churn = churn_curve(users, last_month)
+    churn_plans = [plan for plan in PLAN_LABELS if plan in churn.columns]
+    return specs + [
+        heatmap_spec('retention', 'Share of Each Registration Cohort Still Active', 'Month', 'Registration Cohort',
+                     retention_matrix(users, last_month, rates=True)),
+        line_spec('churn_curve', 'Cumulative Churn by Plan', 'Months Since Registration', 'Share of Users Churned',
+                  churn[churn_plans], [PLAN_COLORS[plan] for plan in churn_plans],
+                  legend=[PLAN_LABELS[plan] for plan in churn_plans]),
+        bar_spec('adjusted_revenue_per_month', 'Average Monthly Revenue, Adjusted for Cohort Mix: Surf vs. Ultimate',
+                 'Month', 'Average Revenue ($)', cohort_adjusted_mean(df_merged, users)[plans], ['orange', 'red'],
+                 legend=[PLAN_LABELS[plan] for plan in plans], rotation=0),
+    ]
+
+
+if __name__ == '__main__':
+    import time
+
+    from megaline_billing import bill_usage
+    from megaline_cube import build_cube
+    from megaline_io import load_tables
+    from megaline_usage import aggregate_usage
+
+    out_dir = sys.argv[1] if len(sys.argv) > 1 else OUT_DIR
+    calls, internet, messages, plans, users = load_tables()
+    df_merged = bill_usage(aggregate_usage(calls, messages, internet), users, plans)
+    df_merged = df_merged.merge(plans, on='plan', how='left')
+    start = time.perf_counter()
+    specs = report_specs(df_merged, build_cube(df_merged, users), users)
+    paths = render_report(specs, out_dir, formats=('png', 'svg'))
+    print(f'{len(paths)} files written to {out_dir} in {time.perf_counter() - start:.2f} s')
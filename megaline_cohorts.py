@@ -0,0 +1,173 @@
+"""
+Cohort analysis for Megaline: retention, churn and revenue per active user.
+
+Users are grouped by registration month (their cohort). Every date is turned into an integer month
+offset (months since 1970-01), so all tables below come from np.bincount and cumulative sums over
+those integers, with no per-user loops.
+
+The per-month averages in the analysis are distorted by the growing user base: users who
+registered during a month only pay for part of their usage that month. cohort_adjusted_mean
+corrects for that mix by standardizing every month to the same tenure profile.
+"""
+import numpy as np
+import pandas as pd
+
+# The sample covers 2018 only; the year of usage tables with just the month number
+DATA_YEAR = 2018
+
+# Month (or day) index of a missing date: the int64 view of NaT, below every real month, so it
+# never collides with one (-1 is 1969-12)
+NAT = np.iinfo(np.int64).min
+
+
+def month_index(dates):
+    """Months since 1970-01 of every date (NaT becomes NAT)."""
+    return pd.Series(dates).to_numpy().astype('datetime64[M]').astype(np.int64)
+
+
+def usage_month_index(df, year=DATA_YEAR):
+    """
+    Month offset of every row of a usage or billing table: its period key, or for a table with
+    only a month number column, that month of year.
+    """
+    if 'period' in df.columns:
+        return df['period'].to_numpy(dtype=np.int64)
+    return (year - 1970) * 12 + df['month'].to_numpy(dtype=np.int64) - 1
+
+
+def month_labels(first, n):
+    return pd.PeriodIndex.from_ordinals(np.arange(first, first + n), freq='M')
+
+
+def period_axis(periods):
+    """
+    Labels of a month-offset axis: the month numbers (an index named month) while the offsets are
+    all in one year, 'YYYY-MM' (named period) once they span several years, so the same month of
+    two years never shares a label.
+    """
+    periods = np.asarray(periods, dtype=np.int64)
+    if len(periods) and periods.min() // 12 != periods.max() // 12:
+        return pd.Index(pd.PeriodIndex.from_ordinals(periods, freq='M').astype(str), name='period')
+    return pd.Index(periods % 12 + 1, name='month')
+
+
+def user_months(users, last_month):
+    """Registration month, last active month (churn month, or last_month if still active) and churn flag."""
+    reg = month_index(users['reg_date'])
+    churn = month_index(users['churn_date'])
+    churned = churn != NAT
+    end = np.where(churned, np.minimum(churn, last_month), last_month)
+    return reg, end, churned
+
+
+def retention_matrix(users, last_month, rates=False):
+    """
+    Registration month x active month table of active users.
+
+    A user counts as active from the registration month through the churn month (or last_month).
+    Every user adds +1 at its first active month and -1 after its last, and a cumulative sum over
+    the months turns those events into active counts. With rates=True the counts are divided by
+    the cohort size.
+    """
+    reg, end, _ = user_months(users, last_month)
+    #Users without a registration month, or who registered after last_month, are in no cohort
+    in_cohort = (reg != NAT) & (reg <= last_month)
+    reg, end = reg[in_cohort], end[in_cohort]
+    first = int(reg.min())
+    n = last_month - first + 1
+    cohort = reg - first
+    start = cohort * (n + 1) + cohort
+    stop = cohort * (n + 1) + (end - first + 1)
+    events = np.bincount(start, minlength=n * (n + 1)) - np.bincount(stop, minlength=n * (n + 1))
+    active = np.cumsum(events.reshape(n, n + 1), axis=1)[:, :n]
+    labels = month_labels(first, n)
+    matrix = pd.DataFrame(active, index=labels.rename('cohort'), columns=labels.rename('month'))
+    if rates:
+        sizes = np.bincount(cohort, minlength=n)
+        matrix = matrix.div(np.where(sizes > 0, sizes, np.nan), axis=0)
+    return matrix
+
+
+def churn_curve(users, last_month):
+    """
+    Share of each plan's users who have churned within k months of registering (Kaplan-Meier).
+
+    Users still active are censored at last_month, so later cohorts, which have been observed
+    for a shorter time, do not make churn look lower than it is.
+    """
+    reg, end, churned = user_months(users, last_month)
+    #Users without a registration month, or who registered after last_month, have no tenure yet
+    in_cohort = (reg != NAT) & (reg <= last_month)
+    tenure = (end - reg)[in_cohort]
+    churned = churned[in_cohort]
+    plan_codes, plan_names = pd.factorize(users['plan'])
+    plan_codes = plan_codes[in_cohort]
+    k = int(tenure.max()) + 1
+    keys = plan_codes * k + tenure
+    churns = np.bincount(keys[churned], minlength=len(plan_names) * k).reshape(-1, k)
+    leaves = np.bincount(keys, minlength=len(plan_names) * k).reshape(-1, k)
+    #Users at risk in month k: everyone whose observation did not end before k
+    at_risk = leaves.sum(axis=1, keepdims=True) - np.cumsum(leaves, axis=1) + leaves
+    hazard = np.divide(churns, at_risk, out=np.zeros(churns.shape), where=at_risk > 0)
+    survival = np.cumprod(1 - hazard, axis=1)
+    return pd.DataFrame((1 - survival).T, index=pd.RangeIndex(k, name='months_since_registration'),
+                        columns=pd.Index(plan_names, name='plan'))
+
+
+def bill_reg_months(bills, users):
+    """
+    Registration month (months since 1970-01) of the user of every bill; NAT for users missing from
+    the users table or without a registration date.
+    """
+    reg = month_index(users['reg_date'])
+    positions = pd.Index(users['user_id']).get_indexer(bills['user_id'].to_numpy())
+    return np.where(positions >= 0, reg[positions], NAT)
+
+
+def cohort_revenue(bills, users, last_month=None, column='revenue', year=DATA_YEAR):
+    """
+    Registration month x month table of the column total (revenue by default) per active user.
+    """
+    month = usage_month_index(bills, year)
+    last_month = int(month.max()) if last_month is None else last_month
+    active = retention_matrix(users, last_month)
+    first = active.index[0].ordinal
+    n = len(active)
+
+    reg = bill_reg_months(bills, users)
+    #Bills of users with no cohort (reg month NAT, below first) or outside the table are left out
+    inside = (reg >= first) & (reg < first + n) & (month >= first) & (month < first + n)
+    keys = (reg[inside] - first) * n + (month[inside] - first)
+    totals = np.bincount(keys, weights=bills[column].to_numpy(dtype=float)[inside], minlength=n * n).reshape(n, n)
+    per_user = np.divide(totals, active.to_numpy(), out=np.full((n, n), np.nan), where=active.to_numpy() > 0)
+    return pd.DataFrame(per_user, index=active.index, columns=active.columns)
+
+
+def cohort_adjusted_mean(bills, users, column='revenue', year=DATA_YEAR):
+    """
+    Average of a column per plan and month (billing period), standardized for tenure mix.
+
+    Within each month the averages of every tenure (months since registration, 0 = the partial
+    registration month) are weighted by that tenure's share of all user-months of the plan,
+    instead of by how many users of that tenure happened to be around that month.
+    """
+    reg = bill_reg_months(bills, users)
+    #Bills of users with no registration month have no tenure and are left out
+    known = reg != NAT
+    bills = bills[known]
+    month = usage_month_index(bills, year)
+    tenure = np.maximum(month - reg[known], 0)
+    plan_codes, plan_names = pd.factorize(bills['plan'])
+    month_codes, months = pd.factorize(month, sort=True)
+    n_plans, n_months, n_tenures = len(plan_names), len(months), int(tenure.max()) + 1
+
+    keys = (plan_codes * n_months + month_codes) * n_tenures + tenure
+    size = n_plans * n_months * n_tenures
+    counts = np.bincount(keys, minlength=size).reshape(n_plans, n_months, n_tenures)
+    sums = np.bincount(keys, weights=bills[column].to_numpy(dtype=float), minlength=size).reshape(counts.shape)
+
+    #Reference tenure mix of each plan, renormalized over the tenures present in each month
+    weights = counts.sum(axis=1, keepdims=True) * (counts > 0)
+    means = np.divide(sums, counts, out=np.zeros(sums.shape), where=counts > 0)
+    adjusted = (means * weights).sum(axis=2) / weights.sum(axis=2)
+    return pd.DataFrame(adjusted.T, index=period_axis(months), columns=pd.Index(plan_names, name='plan'))
@@ -0,0 +1,242 @@
+"""
+Compact layout of the billed Megaline user-months.
+
+df_merged repeats the plan name, the city and all eight plan terms as Python strings and
+int64/float64 values on every user-month, and bill_components adds up float dollars. The compact
+layout keeps per user-month only:
+
+    user_id, month, period             narrowest integer type that holds them
+    plan, city                         categoricals (int8/int16 codes into one copy of each name)
+    calls_count, minutes_sum,          narrowest integer type
+    messages_count
+    mb_used_centi                      traffic in integer hundredths of a MB (the logs record mb_used
+                                       with 2 decimals, so this is exact)
+    service_days, period_days          only for usage aggregated with the users table: the days of
+                                       the billing period in service, for prorated bills
+
+The plan terms live once per plan in compact_plans, with every price in integer cents. Bills are
+computed from them in integer arithmetic, so revenue is in integer cents and sums over any
+number of bills are exact. bill_dollars turns them back into the dollar columns of
+bill_components, and compact_cube builds the statistics cube straight from the compact layout.
+
+Run this file directly for the memory report on the Megaline data (or on N_USERS synthetic users):
+
+    python megaline_compact.py [N_USERS]
+"""
+import sys
+
+import numpy as np
+import pandas as pd
+
+from megaline_billing import BILL_COMPONENTS, CENTS_PER_USD, MB_PER_GB
+from megaline_cohorts import NAT, month_index, usage_month_index
+from megaline_cube import CUBE_DIMENSIONS, CUBE_METRICS, cube_from_rows, index_cube
+from megaline_periods import prorate_allowance, prorate_fee
+
+# Traffic unit of the compact layout: 1/100 MB
+CENTI_MB_PER_MB = 100
+CENTI_MB_PER_GB = MB_PER_GB * CENTI_MB_PER_MB
+
+# Plan prices (dollars) -> integer cents
+PRICE_COLUMNS = ['usd_monthly_pay', 'usd_per_gb', 'usd_per_message', 'usd_per_minute']
+
+# Columns of a prorated usage table carried into the compact layout
+PRORATION_COLUMNS = ['service_days', 'period_days']
+
+CENT_COLUMNS = [component + '_cents' for component in BILL_COMPONENTS] + ['revenue_cents']
+
+
+def narrow(values):
+    """Values in the narrowest signed integer type that holds all of them."""
+    values = np.asarray(values)
+    if len(values) == 0:
+        return values.astype(np.int8)
+    low, high = values.min(), values.max()
+    for dtype in (np.int8, np.int16, np.int32, np.int64):
+        if np.iinfo(dtype).min <= low and high <= np.iinfo(dtype).max:
+            return values.astype(dtype)
+    raise OverflowError(f'values from {low} to {high} do not fit in int64')
+
+
+def compact_plans(plans):
+    """Cleaned plans table with prices in integer cents and the data allowance in 1/100 MB."""
+    compact = pd.DataFrame({'plan': plans['plan'].to_numpy()})
+    for column in PRICE_COLUMNS:
+        cents = plans[column].to_numpy(dtype=float) * CENTS_PER_USD
+        if not np.allclose(cents, np.round(cents)):
+            raise ValueError(f'{column} has prices that are not whole cents: {plans[column].tolist()}')
+        compact[column.replace('usd_', 'cents_')] = np.round(cents).astype(np.int64)
+    compact['minutes_included'] = plans['minutes_included'].to_numpy(dtype=np.int64)
+    compact['messages_included'] = plans['messages_included'].to_numpy(dtype=np.int64)
+    compact['mb_included_centi'] = plans['mb_per_month_included'].to_numpy(dtype=np.int64) * CENTI_MB_PER_MB
+    return compact
+
+
+def compact_usage(df_usage, users, plans):
+    """
+    Compact layout of a usage table (like df_usage) joined with each user's plan and city.
+
+    Rows stay in the order of df_usage, so bills line up with df_merged. Users missing from the
+    users table or on unknown plans get a missing plan (code -1), which is billed 0 like
+    merge_plans' fillna(0).
+    """
+    positions = pd.Index(users['user_id']).get_indexer(df_usage['user_id'])
+    known = positions >= 0
+    plan = np.where(known, users['plan'].to_numpy(dtype=object)[positions], None)
+    city = np.where(known, users['city'].to_numpy(dtype=object)[positions], None)
+    mb_used = df_usage['mb_used_total'].to_numpy(dtype=float)
+    compact = pd.DataFrame({
+        'user_id': narrow(df_usage['user_id'].to_numpy(dtype=np.int64)),
+        'month': narrow(df_usage['month'].to_numpy(dtype=np.int64)),
+        'period': narrow(df_usage['period'].to_numpy(dtype=np.int64)),
+        'plan': pd.Categorical(plan, categories=plans['plan'].tolist()),
+        'city': pd.Categorical(city, categories=sorted(users['city'].dropna().unique())),
+        'calls_count': narrow(df_usage['calls_count'].to_numpy(dtype=np.int64)),
+        'minutes_sum': narrow(df_usage['minutes_sum'].to_numpy(dtype=np.int64)),
+        'messages_count': narrow(df_usage['messages_count'].to_numpy(dtype=np.int64)),
+        'mb_used_centi': narrow(np.rint(mb_used * CENTI_MB_PER_MB).astype(np.int64)),
+    })
+    for column in PRORATION_COLUMNS:
+        if column in df_usage.columns:
+            compact[column] = narrow(df_usage[column].to_numpy(dtype=np.int64))
+    return compact
+
+
+def plan_terms(compact, plans):
+    """
+    Terms of the plan of every row (all 0 for a missing plan) as int64 arrays. In a prorated
+    layout the base fee and the allowances are those of the row's days in service.
+    """
+    terms = compact_plans(plans).set_index('plan').reindex(compact['plan'].cat.categories)
+    codes = compact['plan'].cat.codes.to_numpy()
+    #Code -1 (missing plan) picks up the trailing row of zeros
+    terms = {column: np.append(terms[column].to_numpy(dtype=np.int64), 0)[codes] for column in terms.columns}
+    if 'service_days' in compact.columns:
+        served = compact['service_days'].to_numpy(dtype=np.int64)
+        length = compact['period_days'].to_numpy(dtype=np.int64)
+        terms['cents_monthly_pay'] = prorate_fee(terms['cents_monthly_pay'], served, length)
+        for column in ('minutes_included', 'messages_included'):
+            terms[column] = prorate_allowance(terms[column], served, length)
+        #Whole MB, like bill_components
+        terms['mb_included_centi'] = prorate_allowance(terms['mb_included_centi'] // CENTI_MB_PER_MB, served,
+                                                       length) * CENTI_MB_PER_MB
+    return terms
+
+
+def compact_bills(compact, plans):
+    """
+    Bill every row of the compact layout in integer cents, with the same rules as bill_components:
+    base fee, per-minute and per-message overage, and data overage rounded UP to whole GB (with
+    the prorated fee and allowances of partial periods).
+    """
+    terms = plan_terms(compact, plans)
+    minutes = np.maximum(0, compact['minutes_sum'].to_numpy(dtype=np.int64) - terms['minutes_included'])
+    messages = np.maximum(0, compact['messages_count'].to_numpy(dtype=np.int64) - terms['messages_included'])
+    extra_centi = np.maximum(0, compact['mb_used_centi'].to_numpy(dtype=np.int64) - terms['mb_included_centi'])
+    charges = {
+        'base_cents': terms['cents_monthly_pay'],
+        'minutes_cents': minutes * terms['cents_per_minute'],
+        'messages_cents': messages * terms['cents_per_message'],
+        #Ceiling division: whole GB of overage
+        'data_cents': -(-extra_centi // CENTI_MB_PER_GB) * terms['cents_per_gb'],
+    }
+    charges['revenue_cents'] = sum(charges.values())
+    return pd.DataFrame({column: narrow(values) for column, values in charges.items()}, index=compact.index)
+
+
+def bill_dollars(bills):
+    """Dollar columns of bill_components (base, minutes, messages, data, revenue) from cent bills."""
+    return pd.DataFrame({column.removesuffix('_cents'): bills[column].to_numpy() / CENTS_PER_USD
+                         for column in CENT_COLUMNS}, index=bills.index)
+
+
+def compact_cube(compact, bills, plans, users):
+    """
+    The statistics cube of build_cube (same cells, columns and units) computed from the compact
+    layout and cent bills. Revenue and traffic are added up as integers and scaled afterwards.
+    """
+    terms = plan_terms(compact, plans)
+    minutes = compact['minutes_sum'].to_numpy(dtype=np.int64)
+    messages = compact['messages_count'].to_numpy(dtype=np.int64)
+    centi_mb = compact['mb_used_centi'].to_numpy(dtype=np.int64)
+    rows = pd.DataFrame({
+        'plan': compact['plan'],
+        'period': usage_month_index(compact),
+        'month': compact['month'],
+        'calls_count': compact['calls_count'],
+        'minutes_sum': compact['minutes_sum'],
+        'messages_count': compact['messages_count'],
+        'mb_used_total': compact['mb_used_centi'],
+        'gb_used_billed': narrow(-(-centi_mb // CENTI_MB_PER_GB)),
+        'revenue': bills['revenue_cents'].to_numpy(),
+        'over_minutes': (minutes > terms['minutes_included']).astype(np.int8),
+        'over_messages': (messages > terms['messages_included']).astype(np.int8),
+        'over_data': (centi_mb > terms['mb_included_centi']).astype(np.int8),
+    })
+    #Region = metro area of the user, cohort = registration month of the user; code -1 (missing)
+    #for users that are not in the users table
+    positions = pd.Index(users['user_id']).get_indexer(compact['user_id'])
+    known = positions >= 0
+    rows['region'] = pd.Categorical.from_codes(np.where(known, users['metro'].cat.codes.to_numpy()[positions], -1),
+                                               dtype=users['metro'].dtype)
+    #Users without a registration date are in no cohort either
+    cohorts = month_index(users['reg_date'])
+    levels = np.unique(cohorts[cohorts != NAT])
+    cohort_codes = np.where(cohorts != NAT, np.searchsorted(levels, cohorts), -1)
+    rows['cohort'] = pd.Categorical.from_codes(
+        np.where(known, cohort_codes[positions], -1),
+        categories=pd.PeriodIndex.from_ordinals(levels, freq='M').astype(str))
+
+    cube = cube_from_rows(rows[CUBE_DIMENSIONS + CUBE_METRICS])
+    for dimension in ('plan', 'region', 'cohort'):
+        cube[dimension] = cube[dimension].to_numpy(dtype=object)
+    for dimension in ('period', 'month'):
+        cube[dimension] = cube[dimension].astype(np.int64)
+    for metric, scale in (('revenue', CENTS_PER_USD), ('mb_used_total', CENTI_MB_PER_MB)):
+        for stat in ('sum', 'min', 'max'):
+            cube[f'{metric}_{stat}'] /= scale
+        cube[f'{metric}_m2'] /= scale * scale
+    return index_cube(cube)
+
+
+def memory_report(df_merged, bills, compact, cents):
+    """
+    Bytes of every column of the float layout (df_merged + bill_components) and of the compact
+    layout (compact_usage + compact_bills), in total and per user-month.
+    """
+    def usage(layout, df):
+        sizes = df.memory_usage(deep=True, index=False)
+        return pd.DataFrame({'layout': layout, 'column': sizes.index, 'dtype': df.dtypes.astype(str).to_numpy(),
+                             'bytes': sizes.to_numpy()})
+
+    report = pd.concat([usage('float', pd.concat([df_merged, bills], axis=1)), usage('compact', compact),
+                        usage('compact', cents)], ignore_index=True)
+    totals = report.groupby('layout', sort=False)['bytes'].sum()
+    report = pd.concat([report, pd.DataFrame({'layout': totals.index, 'column': 'total', 'dtype': '',
+                                              'bytes': totals.to_numpy()})], ignore_index=True)
+    report['bytes_per_user_month'] = report['bytes'] / max(len(compact), 1)
+    return report.set_index(['layout', 'column'])
+
+
+if __name__ == '__main__':
+    from megaline_billing import bill_components, merge_plans
+    from megaline_io import load_tables
+    from megaline_synth import synthetic_tables
+    from megaline_usage import aggregate_usage
+
+    if len(sys.argv) > 1:
+        calls, internet, messages, plans, users = synthetic_tables(int(sys.argv[1]))
+    else:
+        calls, internet, messages, plans, users = load_tables()
+    df_usage = aggregate_usage(calls, messages, internet)
+    df_merged = merge_plans(df_usage, users, plans)
+    bills = bill_components(df_merged)
+    compact = compact_usage(df_usage, users, plans)
+    cents = compact_bills(compact, plans)
+
+    report = memory_report(df_merged, bills, compact, cents)
+    print(report.to_string())
+    print(f"\n{len(compact)} user-months: {report.loc[('float', 'total'), 'bytes_per_user_month']:.0f} -> "
+          f"{report.loc[('compact', 'total'), 'bytes_per_user_month']:.0f} bytes per user-month")
+    print(f"Revenue: {bills['revenue'].sum():.10f} USD summed as floats, "
+          f"{int(cents['revenue_cents'].to_numpy().sum(dtype=np.int64))} cents summed as integers")
@@ -0,0 +1,185 @@
+"""
+Sufficient-statistics cube for the Megaline user-months.
+
+For every plan x billing period x region (metro area) x cohort cell the cube keeps the number of
+user-months and, for every metric, the sum, M2 (sum of squared deviations from the cell mean),
+minimum and maximum. Means, variances, standard deviations, over-limit rates and Welch t-tests
+for any slice then come from pooling the matching cells, which are far fewer than the
+user-months, instead of filtering df_merged again for every number. Cells are pooled with the
+parallel-variance formula of Chan, Golub & LeVeque (pool_cells), which does not cancel like a
+sum of squares minus n * mean^2 does when the mean is large next to the spread.
+The period (months since 1970-01) keeps the same month of different years in different cells; the
+month number is kept next to it as a dimension of its own, for filters like month=[11, 12].
+
+The cube is built in one grouped pass: the cells are encoded as one integer key, the rows are
+sorted once by that key and every statistic is a np.ufunc.reduceat over the sorted rows. The
+cells are indexed by a sorted MultiIndex on CUBE_DIMENSIONS, in which select looks its filters up
+instead of comparing every cell.
+"""
+import os
+
+import numpy as np
+import pandas as pd
+from scipy import stats as st
+
+from megaline_cohorts import NAT, month_index, usage_month_index
+
+CUBE_DIMENSIONS = ['plan', 'period', 'month', 'region', 'cohort']
+
+# Plan limit behind every over-limit flag
+OVER_LIMIT = {
+    'over_minutes': ('minutes_sum', 'minutes_included'),
+    'over_messages': ('messages_count', 'messages_included'),
+    'over_data': ('mb_used_total', 'mb_per_month_included'),
+}
+
+# Usage and revenue metrics, plus 0/1 flags whose mean is the share of user-months over the limit
+USAGE_METRICS = ['calls_count', 'minutes_sum', 'messages_count', 'mb_used_total', 'gb_used_billed', 'revenue']
+CUBE_METRICS = USAGE_METRICS + list(OVER_LIMIT)
+
+# Statistics kept for every metric, next to the cell count n
+CUBE_STATS = ['sum', 'm2', 'min', 'max']
+
+
+def cube_rows(df_merged, users):
+    """Dimensions and metrics of every billed user-month (df_merged with revenue)."""
+    rows = df_merged[['plan', 'month', 'user_id'] + USAGE_METRICS].copy()
+    rows.insert(1, 'period', usage_month_index(df_merged))
+    for flag, (usage, limit) in OVER_LIMIT.items():
+        rows[flag] = (df_merged[usage] > df_merged[limit]).astype(np.int8)
+    #Region = metro area of the user, cohort = registration month of the user (both missing for
+    #users that are not in the users table, the cohort also for users without a registration date)
+    positions = pd.Index(users['user_id']).get_indexer(rows['user_id'])
+    known = positions >= 0
+    rows['region'] = np.where(known, users['metro'].to_numpy(dtype=object)[positions], None)
+    cohort = month_index(users['reg_date'])[positions]
+    known &= cohort != NAT
+    rows['cohort'] = None
+    rows.loc[known, 'cohort'] = pd.PeriodIndex.from_ordinals(cohort[known], freq='M').astype(str).to_numpy(dtype=object)
+    return rows.drop(columns='user_id')
+
+
+def build_cube(df_merged, users):
+    """One row per non-empty plan x period x region x cohort cell with n and the per-metric statistics."""
+    return index_cube(cube_from_rows(cube_rows(df_merged, users)))
+
+
+def index_cube(cube):
+    """The cube's cells indexed by a sorted MultiIndex on CUBE_DIMENSIONS (the layout select expects)."""
+    return cube.set_index(CUBE_DIMENSIONS).sort_index()
+
+
+def cube_from_rows(rows):
+    """
+    Cube of rows holding the CUBE_DIMENSIONS and CUBE_METRICS, with the dimensions as columns
+    (index_cube indexes it). Sums of integer metrics are added up exactly in int64 (then stored as
+    float64 like the other statistics). Rows with a missing dimension value get cells of their own.
+    """
+    if len(rows) == 0:
+        return pd.DataFrame(columns=CUBE_DIMENSIONS + ['n'] + [f'{m}_{s}' for m in CUBE_METRICS for s in CUBE_STATS])
+    key = np.zeros(len(rows), dtype=np.int64)
+    for dimension in CUBE_DIMENSIONS:
+        codes, levels = pd.factorize(rows[dimension], sort=True, use_na_sentinel=False)
+        key = key * len(levels) + codes
+
+    order = np.argsort(key, kind='stable')
+    sorted_key = key[order]
+    starts = np.flatnonzero(np.r_[True, sorted_key[1:] != sorted_key[:-1]])
+
+    cube = rows[CUBE_DIMENSIONS].iloc[order[starts]].reset_index(drop=True)
+    counts = np.diff(np.r_[starts, len(key)])
+    cube['n'] = counts
+    for metric in CUBE_METRICS:
+        values = rows[metric].to_numpy()[order]
+        if np.issubdtype(values.dtype, np.integer):
+            cube[metric + '_sum'] = np.add.reduceat(values.astype(np.int64), starts).astype(float)
+            values = values.astype(float)
+        else:
+            values = values.astype(float)
+            cube[metric + '_sum'] = np.add.reduceat(values, starts)
+        #Squared deviations from the mean of each row's own cell
+        deviations = values - np.repeat(cube[metric + '_sum'].to_numpy() / counts, counts)
+        cube[metric + '_m2'] = np.add.reduceat(deviations * deviations, starts)
+        cube[metric + '_min'] = np.minimum.reduceat(values, starts)
+        cube[metric + '_max'] = np.maximum.reduceat(values, starts)
+    return cube
+
+
+def save_cube(cube, directory):
+    os.makedirs(directory, exist_ok=True)
+    cube.to_parquet(os.path.join(directory, 'cube.parquet'))
+
+
+def load_cube(directory):
+    """The cube saved by save_cube; raises ValueError for a cube saved in another layout."""
+    path = os.path.join(directory, 'cube.parquet')
+    cube = pd.read_parquet(path)
+    columns = ['n'] + [f'{metric}_{stat}' for metric in CUBE_METRICS for stat in CUBE_STATS]
+    if list(cube.index.names) != CUBE_DIMENSIONS or not set(columns) <= set(cube.columns):
+        raise ValueError(f'{path} is not a cube of this version (indexed on {CUBE_DIMENSIONS} with '
+                         f'{CUBE_STATS} per metric); build it again with build_cube')
+    return cube
+
+
+def select(cube, **filters):
+    """
+    Cells of the cube matching every filter, e.g. select(cube, plan='surf', month=[11, 12]). The
+    filter values are looked up in the cube's sorted MultiIndex; values not in the cube match nothing.
+    """
+    unknown = set(filters) - set(CUBE_DIMENSIONS)
+    if unknown:
+        raise ValueError(f'unknown cube dimensions: {sorted(unknown)}')
+    if not filters:
+        return cube
+    keys = []
+    for dimension, levels in zip(CUBE_DIMENSIONS, cube.index.levels):
+        if dimension not in filters:
+            keys.append(slice(None))
+            continue
+        values = pd.Index(np.atleast_1d(filters[dimension]))
+        values = values[levels.get_indexer(values) >= 0]
+        if len(values) == 0:
+            return cube.iloc[:0]
+        keys.append(list(values))
+    return cube.iloc[cube.index.get_locs(keys)]
+
+
+def pool_cells(n, sums, m2, groups=None, n_groups=1):
+    """
+    Count, sum and M2 of groups of cells (groups: the group number of every cell; one group by
+    default). A group's M2 is the M2 of its cells plus n * (cell mean - group mean)^2 summed over
+    them, Chan et al.'s pairwise update applied to all the cells at once.
+    """
+    n, sums, m2 = (np.asarray(values, dtype=float) for values in (n, sums, m2))
+    groups = np.zeros(len(n), dtype=np.intp) if groups is None else groups
+    count = np.bincount(groups, weights=n, minlength=n_groups)
+    total = np.bincount(groups, weights=sums, minlength=n_groups)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        spread = m2 + n * (sums / n - (total / count)[groups]) ** 2
+    return count, total, np.bincount(groups, weights=spread, minlength=n_groups)
+
+
+def slice_stats(cube, metric, **filters):
+    """Count, mean, variance (ddof=1, like pandas), standard deviation, min and max of a metric over a slice."""
+    cells = select(cube, **filters)
+    (n,), (total,), (m2,) = pool_cells(cells['n'], cells[metric + '_sum'], cells[metric + '_m2'])
+    n = int(n)
+    mean = total / n if n else np.nan
+    variance = m2 / (n - 1) if n > 1 else np.nan
+    return pd.Series({'count': n, 'mean': mean, 'var': variance, 'std': np.sqrt(variance),
+                      'min': cells[metric + '_min'].min(), 'max': cells[metric + '_max'].max()})
+
+
+def over_limit_rate(cube, flag, **filters):
+    """Share of user-months in a slice over a plan limit (flag is over_minutes, over_messages or over_data)."""
+    return slice_stats(cube, flag, **filters)['mean']
+
+
+def welch_test(cube, metric, group_a, group_b):
+    """
+    Welch's t-test of equal means between two slices given as filter dicts, e.g.
+    welch_test(cube, 'revenue', {'plan': 'surf'}, {'plan': 'ultimate'}).
+    """
+    a = slice_stats(cube, metric, **group_a)
+    b = slice_stats(cube, metric, **group_b)
+    return st.ttest_ind_from_stats(a['mean'], a['std'], a['count'], b['mean'], b['std'], b['count'], equal_var=False)
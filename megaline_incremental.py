@@ -0,0 +1,315 @@
+"""
+Incremental re-billing for Megaline.
+
+Instead of rebuilding df_usage and df_merged from the full history every night, the per-(user,
+period) usage totals and bills are kept on disk, one Parquet file per billing period (months since
+1970-01, megaline_periods), next to a small plan x billing period summary
+(user-months, revenue mean and M2, the sum of squared deviations from the mean). A new day of
+calls, messages and sessions is aggregated on its own, added to the periods it touches, and only
+the user-months that changed are billed again. Their old bills are taken out of the summary and
+their new ones merged in with Chan et al.'s pairwise update (like the cube and the sketches), so
+the nightly cost depends on the day's traffic, not on the length of the history.
+The distribution sketches of every billing period (megaline_sketch.py) are kept next to the
+summary and updated the same way from the old and new bills; only their KLL quantile sketches are
+rebuilt from the bills of the touched periods.
+
+Like the pipeline's periods parameter, the state bills whole calendar months by default, or the
+billing periods of a scheme of megaline_periods ('calendar' or 'cycle') with every user's first and
+last period prorated. The scheme is chosen when the state is built and kept in its state.json, and
+every day is aggregated and billed with it and the users table.
+
+Usage:
+    python megaline_incremental.py DAY_DIR [STATE_DIR [PERIODS]]
+
+DAY_DIR holds the new megaline_calls.csv, megaline_messages.csv and megaline_internet.csv. On the
+first run the state is built from the full files in /datasets, billed with PERIODS. The day's events are validated
+against the users and plans (megaline_validate.py) before they are billed, and their ids against
+the ids billed before in the month of their event date, kept in the state per month in
+append-only sorted files (IdHistory, ids_<table>/<month>/), so an event sent again on a later day
+is dropped as a duplicate. The report of the last day is written to STATE_DIR next to the bills
+(the report of the full history, to STATE_DIR/history).
+"""
+import json
+import os
+import pickle
+import sys
+
+import numpy as np
+import pandas as pd
+
+from megaline_billing import BILL_COLUMNS, MB_PER_GB, bill_usage
+from megaline_cohorts import month_index
+from megaline_io import DATA_DIR, read_table
+from megaline_periods import PERIOD_SCHEMES, period_month
+from megaline_sketch import apply_changes, sketch_bills
+from megaline_usage import USAGE_COLUMNS, aggregate_usage
+from megaline_validate import EVENT_COLUMNS, encode_ids, load_validated, write_report
+
+STATE_DIR = '.megaline_state'
+
+# Event tables of a day
+EVENT_TABLES = ('calls', 'messages', 'internet')
+
+# Sketches per (plan, period)
+SKETCH_FILE = 'period_sketches.pkl'
+
+# Layout of the state directory, recorded in its state.json; bump when it changes (state of another
+# version is refused, and rebuilt from the full history once the directory is removed)
+STATE_VERSION = 3
+
+# Stored revenue moments of every plan and billing period
+MOMENT_COLUMNS = ['user_months', 'revenue_mean', 'revenue_m2']
+
+
+def write_state_version(state_dir, periods=None):
+    path = os.path.join(state_dir, 'state.json')
+    with open(path + '.tmp', 'w') as f:
+        json.dump({'version': STATE_VERSION, 'periods': periods}, f)
+    os.replace(path + '.tmp', path)
+
+
+def check_state_version(state_dir):
+    """Raise ValueError unless state_dir holds state of STATE_VERSION; returns the period scheme of its bills."""
+    path = os.path.join(state_dir, 'state.json')
+    state = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            state = json.load(f)
+    if state.get('version') != STATE_VERSION:
+        raise ValueError(f"{state_dir} holds billing state of version {state.get('version')}, expected "
+                         f'{STATE_VERSION}; remove it to rebuild the state from the full history')
+    return state.get('periods')
+
+
+def aggregate_periods(calls, messages, internet, users, periods=None):
+    """
+    Usage per user and billing period of the scheme periods (None: whole calendar months, without
+    the days in service), like the pipeline's aggregate stage.
+    """
+    if periods is None:
+        return aggregate_usage(calls, messages, internet)
+    if periods not in PERIOD_SCHEMES:
+        raise ValueError(f'unknown period scheme {periods!r}, expected None or one of {PERIOD_SCHEMES}')
+    return aggregate_usage(calls, messages, internet, users, periods)
+
+
+def partition_path(state_dir, period):
+    return os.path.join(state_dir, f'period_{int(period)}.parquet')
+
+
+def read_partition(state_dir, period):
+    path = partition_path(state_dir, period)
+    if os.path.exists(path):
+        return pd.read_parquet(path)
+    return pd.DataFrame(columns=BILL_COLUMNS)
+
+
+def write_partition(state_dir, period, billed):
+    path = partition_path(state_dir, period)
+    billed.to_parquet(path + '.tmp', index=False)
+    os.replace(path + '.tmp', path)
+
+
+def revenue_moments(billed):
+    """User-months, revenue mean and revenue M2 per plan and billing period."""
+    grouped = billed.groupby(['plan', 'period'])['revenue']
+    moments = grouped.agg(user_months='size', revenue_mean='mean')
+    moments['revenue_m2'] = grouped.var(ddof=0) * moments['user_months']
+    return moments[MOMENT_COLUMNS]
+
+
+def merge_moments(summary, change, sign=1):
+    """
+    Merge the revenue moments of change into summary per plan and period (Chan et al.'s pairwise
+    update), or with sign=-1 take moments merged in earlier back out (the update solved for the
+    rest), like MetricSketch.add_moments and remove_moments. Plans and periods left without
+    user-months are dropped.
+    """
+    index = summary.index.union(change.index)
+    n1, mean1, m2_1 = (summary[column].reindex(index, fill_value=0).to_numpy(dtype=float) for column in MOMENT_COLUMNS)
+    n2, mean2, m2_2 = (change[column].reindex(index, fill_value=0).to_numpy(dtype=float) for column in MOMENT_COLUMNS)
+    n = n1 + sign * n2
+    with np.errstate(invalid='ignore', divide='ignore'):
+        if sign > 0:
+            delta = mean2 - mean1
+            mean = mean1 + delta * n2 / n
+            m2 = m2_1 + m2_2 + delta * delta * n1 * n2 / n
+        else:
+            mean = (n1 * mean1 - n2 * mean2) / n
+            delta = mean2 - mean
+            m2 = np.maximum(m2_1 - m2_2 - delta * delta * n * n2 / n1, 0.0)
+    merged = pd.DataFrame({'user_months': n.astype(np.int64), 'revenue_mean': mean, 'revenue_m2': m2}, index=index)
+    return merged[n > 0]
+
+
+def read_summary(state_dir):
+    """
+    Plan x billing period summary with the number of user-months and the mean and variance of
+    revenue (the numbers behind the average revenue bar chart).
+    """
+    summary = read_moments(state_dir)
+    n = summary['user_months']
+    summary['revenue_var'] = (summary['revenue_m2'] / (n - 1)).where(n > 1)
+    return summary
+
+
+def read_moments(state_dir):
+    """The stored revenue_moments of every plan and period."""
+    return pd.read_parquet(os.path.join(state_dir, 'summary.parquet'))
+
+
+def write_summary(state_dir, summary):
+    path = os.path.join(state_dir, 'summary.parquet')
+    summary.to_parquet(path + '.tmp')
+    os.replace(path + '.tmp', path)
+
+
+def read_sketches(state_dir):
+    """Distribution sketches of the stored bills, {(plan, period): {metric: MetricSketch}}."""
+    with open(os.path.join(state_dir, SKETCH_FILE), 'rb') as f:
+        return pickle.load(f)
+
+
+def write_sketches(state_dir, sketches):
+    path = os.path.join(state_dir, SKETCH_FILE)
+    with open(path + '.tmp', 'wb') as f:
+        pickle.dump(sketches, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(path + '.tmp', path)
+
+
+class IdHistory:
+    """
+    Ids of the billed events of one table, per month of the event date (months since 1970-01): the
+    history of in_history. Every load adds one sorted file to the directory of each month it has
+    events in and never rewrites the earlier ones, so a night reads and writes only the months of
+    its own events. A month that can no longer receive events can be dropped by deleting its
+    directory.
+    """
+
+    def __init__(self, state_dir, name):
+        self.directory = os.path.join(state_dir, f'ids_{name}')
+
+    def month_dir(self, month):
+        return os.path.join(self.directory, str(int(month)))
+
+    def parts(self, month):
+        month_dir = self.month_dir(month)
+        if not os.path.isdir(month_dir):
+            return []
+        return sorted(os.path.join(month_dir, name) for name in os.listdir(month_dir) if name.endswith('.npy'))
+
+    def get(self, month):
+        """Sorted ids (bytes) billed in a month, None if there are none."""
+        parts = self.parts(month)
+        if not parts:
+            return None
+        return np.sort(np.concatenate([np.load(path) for path in parts]))
+
+    def append(self, ids, dates):
+        """Add the ids of a load (Series) with the dates of their events; undated events are in no month."""
+        dated = dates.notna().to_numpy()
+        ids, months = ids[dated], month_index(dates[dated])
+        for month in np.unique(months):
+            os.makedirs(self.month_dir(month), exist_ok=True)
+            path = os.path.join(self.month_dir(month), f'{len(self.parts(month)):05d}.npy')
+            with open(path + '.tmp', 'wb') as f:
+                np.save(f, np.sort(encode_ids(ids[months == month])))
+            os.replace(path + '.tmp', path)
+
+
+def init_state(state_dir, df_usage, users, plans, periods=None):
+    """
+    Bill the full usage table once and store it as the starting state. periods is the scheme
+    df_usage was aggregated with (aggregate_periods); the days are billed with it too.
+    """
+    os.makedirs(state_dir, exist_ok=True)
+    billed = bill_usage(df_usage, users, plans)
+    for period, part in billed.groupby('period'):
+        write_partition(state_dir, period, part.reset_index(drop=True))
+    write_sketches(state_dir, sketch_bills(billed))
+    write_summary(state_dir, revenue_moments(billed))
+    write_state_version(state_dir, periods)
+    return billed
+
+
+def apply_day(state_dir, calls, messages, internet, users, plans):
+    """
+    Add one day of cleaned calls, messages and sessions to the stored state, aggregated and billed
+    with the users table and the period scheme of the state.
+
+    Returns the re-billed user-months (new bills of every user-month the day touched).
+    """
+    periods = check_state_version(state_dir)
+    delta = aggregate_periods(calls, messages, internet, users, periods)
+    rebilled = []
+    summary = read_moments(state_dir)
+    sketches = read_sketches(state_dir)
+    for period, day in delta.groupby('period'):
+        stored = read_partition(state_dir, period).set_index(['user_id', 'period'])
+        day = day.set_index(['user_id', 'period'])
+        touched = day.index
+
+        #Add the day's totals to the stored totals of the touched user-months (new ones start at 0)
+        old = stored.reindex(touched)
+        usage = old[USAGE_COLUMNS].fillna(0) + day[USAGE_COLUMNS]
+        usage['gb_used_billed'] = np.ceil(usage['mb_used_total'] / MB_PER_GB).astype(int)
+        if periods is not None:
+            #Days in service of the touched user-periods (they depend on the users table only)
+            usage[['service_days', 'period_days']] = day[['service_days', 'period_days']]
+        new = bill_usage(usage.reset_index().assign(month=period_month(period)), users, plans)
+
+        #Summary: take the old bills of the touched user-months out, merge their new bills in
+        old = old.dropna(subset=['revenue']).reset_index()
+        if len(old):
+            summary = merge_moments(summary, revenue_moments(old), sign=-1)
+        summary = merge_moments(summary, revenue_moments(new))
+
+        stored = pd.concat([stored.drop(touched, errors='ignore').reset_index()[BILL_COLUMNS], new], ignore_index=True)
+        write_partition(state_dir, period, stored.sort_values('user_id').reset_index(drop=True))
+        apply_changes(sketches, old, new, stored, seed=period)
+        rebilled.append(new)
+
+    write_sketches(state_dir, sketches)
+    write_summary(state_dir, summary)
+    if not rebilled:
+        return pd.DataFrame(columns=BILL_COLUMNS)
+    return pd.concat(rebilled, ignore_index=True)
+
+
+def stored_periods(state_dir):
+    """Billing periods with a partition in the state, in order."""
+    return sorted(int(name[len('period_'):-len('.parquet')]) for name in os.listdir(state_dir)
+                  if name.startswith('period_') and name.endswith('.parquet'))
+
+
+def read_bills(state_dir):
+    """All stored bills (every period)."""
+    check_state_version(state_dir)
+    return pd.concat([read_partition(state_dir, period) for period in stored_periods(state_dir)], ignore_index=True)
+
+
+if __name__ == '__main__':
+    day_dir = sys.argv[1]
+    state_dir = sys.argv[2] if len(sys.argv) > 2 else STATE_DIR
+    if not os.path.exists(os.path.join(state_dir, 'summary.parquet')):
+        print('No stored state yet; billing the full history in', DATA_DIR)
+        periods = sys.argv[3] if len(sys.argv) > 3 else None
+        history, validation = load_validated()
+        users, plans = history['users'], history['plans']
+        init_state(state_dir, aggregate_periods(history['calls'], history['messages'], history['internet'], users,
+                                                periods), users, plans, periods)
+        write_report(validation, os.path.join(state_dir, 'history'))
+        for name in EVENT_TABLES:
+            IdHistory(state_dir, name).append(history[name]['id'], history[name][EVENT_COLUMNS[name][0]])
+    else:
+        users = read_table('users')
+        plans = read_table('plans')
+    seen = {name: IdHistory(state_dir, name) for name in EVENT_TABLES}
+    day, validation = load_validated(EVENT_TABLES, day_dir, users=users, plans=plans, history=seen)
+    rebilled = apply_day(state_dir, day['calls'], day['messages'], day['internet'], users, plans)
+    for name in EVENT_TABLES:
+        seen[name].append(day[name]['id'], day[name][EVENT_COLUMNS[name][0]])
+    write_report(validation, state_dir)
+    print(validation.summary)
+    print(f'Re-billed {len(rebilled)} user-months.')
+    print(read_summary(state_dir))
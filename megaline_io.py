@@ -0,0 +1,241 @@
+"""
+Loading and cleaning the Megaline tables.
+
+Each table is cleaned the same way as in the preprocessing section of megaline_analysis.py
+(dates converted to datetime, call durations rounded UP to whole minutes, plan columns renamed).
+Every table is read with a declared schema: only the columns the analysis uses, with fixed types.
+With pyarrow installed the files are parsed by its multithreaded CSV reader, which also parses
+the ISO dates natively; otherwise pandas' C parser is used and every distinct date string is
+parsed once with a fixed format.
+
+The cleaned tables can be cached as Parquet files: on later runs a table is read straight from the
+cache as long as its source CSV has the same size, modification time and content hash, and is
+rebuilt from the CSV automatically when any of them changed.
+"""
+import hashlib
+import json
+import os
+import time
+import warnings
+
+import numpy as np
+import pandas as pd
+
+from megaline_regions import parse_city
+
+try:
+    import pyarrow
+    from pyarrow import csv as pyarrow_csv
+except ImportError:
+    pyarrow = None
+
+DATA_DIR = '/datasets'
+
+# Source file of every table
+TABLE_FILES = {
+    'calls': 'megaline_calls.csv',
+    'internet': 'megaline_internet.csv',
+    'messages': 'megaline_messages.csv',
+    'plans': 'megaline_plans.csv',
+    'users': 'megaline_users.csv',
+}
+
+# Columns read from every table and their types ('date' columns hold dates like 2018-12-27)
+TABLE_SCHEMAS = {
+    'calls': {'id': 'str', 'user_id': 'int64', 'call_date': 'date', 'duration': 'float64'},
+    'internet': {'id': 'str', 'user_id': 'int64', 'session_date': 'date', 'mb_used': 'float64'},
+    'messages': {'id': 'str', 'user_id': 'int64', 'message_date': 'date'},
+    'plans': {'messages_included': 'int64', 'mb_per_month_included': 'int64', 'minutes_included': 'int64',
+              'usd_monthly_pay': 'int64', 'usd_per_gb': 'int64', 'usd_per_message': 'float64',
+              'usd_per_minute': 'float64', 'plan_name': 'str'},
+    'users': {'user_id': 'int64', 'city': 'str', 'reg_date': 'date', 'plan': 'str', 'churn_date': 'date'},
+}
+
+# All Megaline dates are written as 2018-12-27
+DATE_FORMAT = '%Y-%m-%d'
+
+# Bump when a clean_* function or a schema changes so old cache files are rebuilt
+CACHE_VERSION = 3
+
+
+def to_dates(values, date_format=DATE_FORMAT):
+    """
+    Convert a column of date strings to datetime64.
+
+    A log has far fewer distinct dates than rows, so every distinct string is parsed once with the
+    fixed format and the results are mapped back to the rows. Missing values become NaT.
+    """
+    if pd.api.types.is_datetime64_any_dtype(values):
+        return values
+    codes, uniques = pd.factorize(values)
+    #Parsed dates plus a trailing NaT, which code -1 (missing value) picks up
+    parsed = np.append(pd.to_datetime(uniques, format=date_format).to_numpy(), np.datetime64('NaT', 'ns'))
+    return pd.Series(parsed[codes], index=values.index, name=values.name)
+
+
+def clean_calls(calls):
+    """Convert call_date to datetime and round every call UP to a whole minute (0.0 stays 0)."""
+    calls['call_date'] = to_dates(calls['call_date'])
+    calls['duration'] = np.ceil(calls['duration']).astype(int)
+    return calls
+
+
+def clean_messages(messages):
+    """Convert message_date to datetime."""
+    messages['message_date'] = to_dates(messages['message_date'])
+    return messages
+
+
+def clean_internet(internet):
+    """Convert session_date to datetime. Sessions are not rounded; 0-MB sessions are kept."""
+    internet['session_date'] = to_dates(internet['session_date'])
+    return internet
+
+
+def clean_plans(plans):
+    """Add the allowance in GB and rename plan_name to plan to match the users table."""
+    plans['gb_per_month_included'] = plans['mb_per_month_included'] / 1024
+    return plans.rename(columns={'plan_name': 'plan'})
+
+
+def clean_users(users):
+    """
+    Convert reg_date and churn_date to datetime (churn_date is NaT for active users) and split city
+    into categorical metro and states columns.
+    """
+    users['reg_date'] = to_dates(users['reg_date'])
+    users['churn_date'] = to_dates(users['churn_date'])
+    users[['metro', 'states']] = parse_city(users['city'])
+    return users
+
+
+CLEANERS = {
+    'calls': clean_calls,
+    'internet': clean_internet,
+    'messages': clean_messages,
+    'plans': clean_plans,
+    'users': clean_users,
+}
+
+
+def read_csv_schema(name, path):
+    """Read only the schema columns of one table, with their declared types."""
+    schema = TABLE_SCHEMAS[name]
+    if pyarrow is not None:
+        arrow_types = {'str': pyarrow.string(), 'int64': pyarrow.int64(), 'float64': pyarrow.float64(),
+                       'date': pyarrow.timestamp('ns')}
+        options = pyarrow_csv.ConvertOptions(include_columns=list(schema),
+                                             column_types={column: arrow_types[kind] for column, kind in schema.items()})
+        return pyarrow_csv.read_csv(path, convert_options=options).to_pandas()
+    #Without pyarrow, date columns are read as strings and converted by to_dates in the clean_* functions
+    dtypes = {column: str if kind in ('str', 'date') else kind for column, kind in schema.items()}
+    return pd.read_csv(path, usecols=list(schema), dtype=dtypes)
+
+
+def read_table(name, data_dir=DATA_DIR):
+    """Read one table from its CSV file and clean it."""
+    return CLEANERS[name](read_csv_schema(name, os.path.join(data_dir, TABLE_FILES[name])))
+
+
+def file_fingerprint(path):
+    """Size, modification time and SHA-256 of a file; the cache is valid only while all three match."""
+    stat = os.stat(path)
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': digest.hexdigest(),
+            'version': CACHE_VERSION}
+
+
+def load_cached_table(name, data_dir=DATA_DIR, cache_dir=None):
+    """
+    Return the cleaned table, reading it from cache_dir when the cached copy is still valid.
+
+    Without a cache_dir (or without pyarrow installed) the table is simply read from the CSV.
+    """
+    if cache_dir is None:
+        return read_table(name, data_dir)
+    if pyarrow is None:
+        warnings.warn('pyarrow is not installed; reading the Megaline tables without the cache.')
+        return read_table(name, data_dir)
+
+    source = os.path.join(data_dir, TABLE_FILES[name])
+    data_path = os.path.join(cache_dir, name + '.parquet')
+    manifest_path = os.path.join(cache_dir, name + '.json')
+    fingerprint = file_fingerprint(source)
+
+    if os.path.exists(data_path) and os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            if json.load(f) == fingerprint:
+                return pd.read_parquet(data_path)
+
+    #Cache missing or stale: parse the CSV again and store the cleaned table
+    table = read_table(name, data_dir)
+    os.makedirs(cache_dir, exist_ok=True)
+    table.to_parquet(data_path + '.tmp', index=False)
+    os.replace(data_path + '.tmp', data_path)
+    #The manifest is written last, so an interrupted run never leaves a valid-looking cache
+    with open(manifest_path + '.tmp', 'w') as f:
+        json.dump(fingerprint, f)
+    os.replace(manifest_path + '.tmp', manifest_path)
+    return table
+
+
+def load_tables(data_dir=DATA_DIR, cache_dir=None):
+    """Load the cleaned calls, internet, messages, plans and users tables (in that order)."""
+    return tuple(load_cached_table(name, data_dir, cache_dir) for name in TABLE_FILES)
+
+
+def read_calls_original(path):
+    """The original loading cells for calls: default read_csv, inferred date format, then the duration ceil."""
+    calls = pd.read_csv(path)
+    calls['call_date'] = pd.to_datetime(calls['call_date'])
+    calls['duration'] = np.ceil(calls['duration']).astype(int)
+    return calls
+
+
+def write_sample_calls(path, n_rows, seed=0):
+    """Write a calls file with n_rows random calls in the Megaline layout (for benchmarking only)."""
+    rng = np.random.default_rng(seed)
+    user_ids = rng.integers(1000, 1500, n_rows)
+    dates = np.datetime64('2018-01-01') + rng.integers(0, 365, n_rows).astype('timedelta64[D]')
+    pd.DataFrame({
+        'id': [f'{u}_{i}' for i, u in enumerate(user_ids)],
+        'user_id': user_ids,
+        'call_date': np.datetime_as_string(dates),
+        'duration': np.round(rng.gamma(2, 3.5, n_rows), 2),
+    }).to_csv(path, index=False)
+
+
+def benchmark_ingestion(path, repeats=3):
+    """Best-of-repeats load time of a calls file with the original cells and with read_table."""
+    def best(load):
+        times = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            load()
+            times.append(time.perf_counter() - start)
+        return min(times)
+
+    original = best(lambda: read_calls_original(path))
+    fast = best(lambda: clean_calls(read_csv_schema('calls', path)))
+    pd.testing.assert_frame_equal(read_calls_original(path)[['user_id', 'call_date', 'duration']],
+                                  clean_calls(read_csv_schema('calls', path))[['user_id', 'call_date', 'duration']],
+                                  check_dtype=False)
+    return pd.DataFrame({'seconds': [original, fast]}, index=['original cells', 'read_table']).assign(
+        speedup=lambda df: df['seconds'].iloc[0] / df['seconds'])
+
+
+if __name__ == '__main__':
+    import sys
+    import tempfile
+
+    #Benchmark on a given calls file, or on a generated file with 3 million calls
+    if len(sys.argv) > 1:
+        print(benchmark_ingestion(sys.argv[1]))
+    else:
+        with tempfile.TemporaryDirectory() as tmp:
+            sample = os.path.join(tmp, 'megaline_calls.csv')
+            write_sample_calls(sample, 3_000_000)
+            print(benchmark_ingestion(sample))
@@ -0,0 +1,103 @@
+"""
+Load test for the bill-lookup service (megaline_service.py).
+
+Opens CONCURRENCY keep-alive connections to a running service and sends REQUESTS lookups of
+random existing (user_id, month, year) bills, then reports requests per second and latency
+percentiles. With BATCH > 1 every request is a POST /bills of BATCH bills.
+
+Usage:
+    python megaline_service.py &
+    python megaline_loadtest.py [REQUESTS [CONCURRENCY [BATCH [URL [STATE_DIR]]]]]
+"""
+import asyncio
+import json
+import sys
+import time
+from urllib.parse import urlsplit
+
+import numpy as np
+import pandas as pd
+
+from megaline_incremental import STATE_DIR, read_bills
+from megaline_periods import period_year
+from megaline_service import HOST, PORT
+
+URL = f'http://{HOST}:{PORT}'
+
+
+async def read_response(reader):
+    """Status and body of one HTTP response."""
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        if name.strip().lower() == 'content-length':
+            length = int(value)
+    return status, await reader.readexactly(length)
+
+
+async def client(host, port, requests, latencies, errors):
+    """Send the given requests one after the other over one connection."""
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        for request in requests:
+            start = time.perf_counter()
+            writer.write(request)
+            await writer.drain()
+            status, _ = await read_response(reader)
+            latencies.append(time.perf_counter() - start)
+            if status != 200:
+                errors.append(status)
+    finally:
+        writer.close()
+
+
+def make_requests(keys, n_requests, batch, host, seed=0):
+    """Encoded GET /bill (batch=1) or POST /bills requests for random keys."""
+    rng = np.random.default_rng(seed)
+    picks = keys[rng.integers(0, len(keys), size=(n_requests, batch))]
+    requests = []
+    for pick in picks:
+        if batch == 1:
+            user_id, month, year = pick[0]
+            requests.append(f'GET /bill?user_id={user_id}&month={month}&year={year} HTTP/1.1\r\nHost: {host}\r\n\r\n'
+                            .encode())
+        else:
+            body = json.dumps(pick.tolist()).encode()
+            requests.append(f'POST /bills HTTP/1.1\r\nHost: {host}\r\nContent-Type: application/json\r\n'
+                            f'Content-Length: {len(body)}\r\n\r\n'.encode() + body)
+    return requests
+
+
+async def load_test(keys, n_requests=20_000, concurrency=32, batch=1, url=URL):
+    """Run the load test; returns requests per second, bills per second and latency percentiles (ms)."""
+    parts = urlsplit(url)
+    requests = make_requests(keys, n_requests, batch, parts.hostname)
+    latencies, errors = [], []
+    start = time.perf_counter()
+    await asyncio.gather(*(client(parts.hostname, parts.port, requests[i::concurrency], latencies, errors)
+                           for i in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    latencies = np.array(latencies) * 1000
+    return pd.Series({
+        'requests': n_requests, 'concurrency': concurrency, 'batch': batch, 'errors': len(errors),
+        'seconds': elapsed, 'requests_per_second': n_requests / elapsed,
+        'bills_per_second': n_requests * batch / elapsed,
+        'p50_ms': np.percentile(latencies, 50), 'p99_ms': np.percentile(latencies, 99),
+        'max_ms': latencies.max(),
+    })
+
+
+if __name__ == '__main__':
+    n_requests = int(sys.argv[1]) if len(sys.argv) > 1 else 20_000
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 32
+    batch = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+    url = sys.argv[4] if len(sys.argv) > 4 else URL
+    state_dir = sys.argv[5] if len(sys.argv) > 5 else STATE_DIR
+    bills = read_bills(state_dir)
+    keys = np.column_stack([bills['user_id'].to_numpy(dtype=np.int64), bills['month'].to_numpy(dtype=np.int64),
+                            period_year(bills['period'].to_numpy())])
+    print(asyncio.run(load_test(keys, n_requests, concurrency, batch, url)).round(3))
@@ -0,0 +1,117 @@
+"""
+Multi-core aggregation and billing for Megaline.
+
+Billing is per user, so the call, message and internet events (and the users table) can be
+hash-partitioned by user_id into independent shards. Each shard is aggregated and billed in its
+own worker process and the results are simply concatenated; no cross-shard merge is needed.
+aggregate_and_sketch returns only the mergeable distribution sketches of every shard
+(megaline_sketch.py), merged, so the user-months of the full base are never held in one process.
+
+Run this file directly for a scaling benchmark (1, 2, 4 and 8 workers) on synthetic data.
+"""
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from megaline_billing import bill_usage
+from megaline_sketch import merge_sketches, sketch_bills
+from megaline_synth import synthetic_tables
+from megaline_usage import aggregate_usage
+
+# Shard function and shards handed to forked workers (read by index, so the tables are not pickled)
+_shards = None
+
+
+def shard_of(user_ids, n_shards):
+    """Shard number of every user_id (multiplicative hash, so consecutive ids spread evenly)."""
+    hashed = (np.asarray(user_ids).astype(np.uint64) * np.uint64(2654435761)) % np.uint64(2**32)
+    return (hashed % np.uint64(n_shards)).astype(np.int64)
+
+
+def split_by_user(df, n_shards):
+    """Split a table into n_shards tables by the shard of its user_id."""
+    shard = shard_of(df['user_id'].to_numpy(), n_shards)
+    order = np.argsort(shard, kind='stable')
+    bounds = np.searchsorted(shard[order], np.arange(1, n_shards))
+    return [df.iloc[part] for part in np.split(order, bounds)]
+
+
+def bill_shard(calls, messages, internet, users, plans):
+    """Aggregate and bill one shard (every table holds the same subset of users)."""
+    return bill_usage(aggregate_usage(calls, messages, internet), users, plans)
+
+
+def sketch_shard(calls, messages, internet, users, plans):
+    """Distribution sketches of the billed user-months of one shard."""
+    #The shard's smallest user id seeds its KLL sketches: shards never share it, whatever their number
+    seed = int(users['user_id'].min()) if len(users) else 0
+    return sketch_bills(bill_shard(calls, messages, internet, users, plans), seed=seed)
+
+
+def _run_shard_at(index):
+    function, shards = _shards
+    return function(*shards[index])
+
+
+def map_shards(function, calls, messages, internet, users, plans, n_shards=None, n_workers=None):
+    """
+    Results of function(calls, messages, internet, users, plans) on every shard of users, computed
+    by n_workers processes.
+
+    n_workers defaults to the number of CPUs and n_shards to n_workers. More shards than workers
+    evens out the load when some shards are heavier than others.
+    """
+    global _shards
+    n_workers = n_workers or os.cpu_count()
+    n_shards = n_shards or n_workers
+    shards = list(zip(split_by_user(calls, n_shards), split_by_user(messages, n_shards),
+                      split_by_user(internet, n_shards), split_by_user(users, n_shards),
+                      [plans] * n_shards))
+
+    if n_workers == 1:
+        return [function(*shard) for shard in shards]
+    if 'fork' in multiprocessing.get_all_start_methods():
+        #Forked workers inherit the shards instead of receiving pickled copies
+        _shards = (function, shards)
+        try:
+            with ProcessPoolExecutor(n_workers, mp_context=multiprocessing.get_context('fork')) as pool:
+                return list(pool.map(_run_shard_at, range(n_shards)))
+        finally:
+            _shards = None
+    with ProcessPoolExecutor(n_workers) as pool:
+        return list(pool.map(function, *zip(*shards)))
+
+
+def aggregate_and_bill(calls, messages, internet, users, plans, n_shards=None, n_workers=None):
+    """Build the billed usage table (like bill_usage(aggregate_usage(...))) with n_workers processes."""
+    results = map_shards(bill_shard, calls, messages, internet, users, plans, n_shards, n_workers)
+    return pd.concat(results, ignore_index=True).sort_values(['user_id', 'period'], ignore_index=True)
+
+
+def aggregate_and_sketch(calls, messages, internet, users, plans, n_shards=None, n_workers=None):
+    """Distribution sketches per plan and month of the billed user-months, sketched per shard and merged."""
+    return merge_sketches(*map_shards(sketch_shard, calls, messages, internet, users, plans, n_shards, n_workers))
+
+
+def scaling_benchmark(n_users, workers=(1, 2, 4, 8), seed=0):
+    """Wall time of aggregate_and_bill on synthetic data for every worker count."""
+    calls, internet, messages, plans, users = synthetic_tables(n_users, seed)
+    rows = []
+    for n_workers in workers:
+        start = time.perf_counter()
+        aggregate_and_bill(calls, messages, internet, users, plans, n_workers=n_workers)
+        rows.append({'workers': n_workers, 'seconds': time.perf_counter() - start})
+    result = pd.DataFrame(rows)
+    result['speedup'] = result['seconds'].iloc[0] / result['seconds']
+    return result
+
+
+if __name__ == '__main__':
+    n_users = int(sys.argv[1]) if len(sys.argv) > 1 else 20_000
+    print(f'{os.cpu_count()} CPUs, {n_users} synthetic users')
+    print(scaling_benchmark(n_users))
@@ -0,0 +1,208 @@
+"""
+Billing periods for Megaline.
+
+A billing period is identified by one integer key, the number of months since 1970-01 of the
+month it starts in (the month_index convention of megaline_cohorts, the same ordinals as a
+monthly pd.Period). Unlike the month number alone it keeps January 2018 and January 2019 apart,
+and year, month and label all follow from it.
+
+Two schemes place the period boundaries:
+
+    calendar    every period starts on the 1st of the month
+    cycle       every user's periods start on the day of the month they registered (their anchor
+                day), clamped to the length of shorter months, so a user who registered on the
+                31st is billed from Feb 28 to Mar 30 and from Mar 31 to Apr 29
+
+A date falls in the period of its own month, or in the previous one if it comes before the anchor
+day of its month. Event dates become day indexes (days since 1970-01-01) with one integer
+division, and month, day of the month and month length are looked up in per-day tables of the
+span the dates cover, so the calendar arithmetic runs once per day of the span, not once per event,
+and there are no per-row Python or pandas datetime accessors.
+
+The first period of a user (registration) and the last one (churn) are usually only partly in
+service: service_days counts the days of every period the user was registered and not yet gone
+(the churn day counts as a service day), period_days the length of the period. Fees are prorated
+to the nearest cent and allowances rounded down with integer arithmetic (prorate_fee,
+prorate_allowance). Under the cycle scheme the first period starts on the registration day, so
+only the churn period is partial.
+
+Run this file directly to time period keys against the dt.month accessor on a multi-year history
+of N_EVENTS dates:
+
+    python megaline_periods.py [N_EVENTS]
+"""
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from megaline_cohorts import NAT, month_index
+
+PERIOD_SCHEMES = ('calendar', 'cycle')
+
+# Anchor day of every user under the calendar scheme
+CALENDAR_ANCHOR = 1
+
+# Day index of a missing churn date: later than any period end
+NO_CHURN = np.iinfo(np.int64).max
+
+# datetime64[ns] -> days since 1970-01-01
+NS_PER_DAY = 86_400 * 10**9
+
+
+def as_dates(dates):
+    """datetime64[ns] array of a Series, Index or array of dates."""
+    return np.asarray(pd.Series(dates).to_numpy(), dtype='datetime64[ns]')
+
+
+def day_index(dates):
+    """Days since 1970-01-01 of every date (NaT stays NAT)."""
+    values = as_dates(dates).view(np.int64)
+    index = values // NS_PER_DAY
+    index[values == NAT] = NAT
+    return index
+
+
+def day_tables(first, last):
+    """
+    Month, day of the month (from 0) and days in the month of every day from first to last (day
+    indexes), as direct-address tables: the calendar arithmetic runs once per day of the span
+    instead of once per event.
+    """
+    days = np.arange(first, last + 1, dtype=np.int64)
+    months = days.astype('datetime64[D]').astype('datetime64[M]').astype(np.int64)
+    starts = month_start(months)
+    return months, (days - starts).astype(np.int8), (month_start(months + 1) - starts).astype(np.int8)
+
+
+def month_start(periods):
+    """Day index of the 1st of every month (months since 1970-01)."""
+    return np.asarray(periods, dtype=np.int64).astype('datetime64[M]').astype('datetime64[D]').astype(np.int64)
+
+
+def period_start(periods, anchors=CALENDAR_ANCHOR):
+    """Day index of the first day of every period: its anchor day, clamped to the month's length."""
+    periods = np.asarray(periods, dtype=np.int64)
+    first = month_start(periods)
+    return first + np.minimum(anchors, month_start(periods + 1) - first) - 1
+
+
+def anchor_days(dates):
+    """Day of the month of every date (the cycle anchor of a registration date; NaT becomes 1)."""
+    days = day_index(dates)
+    anchors = days - month_start(month_index(dates)) + 1
+    anchors[days == NAT] = CALENDAR_ANCHOR
+    return anchors
+
+
+def user_anchors(users, scheme='calendar'):
+    """Anchor day of every user in the users table under scheme (all 1 under the calendar scheme)."""
+    if scheme not in PERIOD_SCHEMES:
+        raise ValueError(f'unknown period scheme {scheme!r}, expected one of {PERIOD_SCHEMES}')
+    if scheme == 'calendar':
+        return np.full(len(users), CALENDAR_ANCHOR, dtype=np.int64)
+    return anchor_days(users['reg_date'])
+
+
+def date_periods(dates, anchors=None):
+    """
+    Period key of every date (NaT becomes NAT). anchors gives the anchor day of each date's user
+    (an array aligned with dates); without it the periods are calendar months.
+    """
+    days = day_index(dates)
+    known = days != NAT
+    if not known.any():
+        return np.full(len(days), NAT, dtype=np.int64)
+    first = int(days[known].min())
+    months, day_of_month, month_days = day_tables(first, int(days.max()))
+    #NaT reads the first day of the span and is reset afterwards
+    offsets = np.where(known, days - first, 0)
+    periods = months[offsets]
+    if anchors is not None:
+        #Before the (clamped) anchor day of its month, a date belongs to the previous period
+        periods -= day_of_month[offsets] < np.minimum(anchors, month_days[offsets]) - 1
+    periods[~known] = NAT
+    return periods
+
+
+def period_bounds(periods, anchors=CALENDAR_ANCHOR):
+    """First day and day after the last of every period, as day indexes."""
+    periods = np.asarray(periods, dtype=np.int64)
+    return period_start(periods, anchors), period_start(periods + 1, anchors)
+
+
+def service_days(user_ids, periods, users, scheme='calendar'):
+    """
+    Days in service and length in days of every (user_id, period), from the users' reg_date
+    and churn_date. Users missing from the users table are in service for the whole period.
+    """
+    positions = pd.Index(users['user_id']).get_indexer(np.asarray(user_ids))
+    known = positions >= 0
+    anchors = np.where(known, user_anchors(users, scheme)[positions], CALENDAR_ANCHOR)
+    start, end = period_bounds(periods, anchors)
+
+    reg = day_index(users['reg_date'])
+    churn = day_index(users['churn_date'])
+    #The churn day is the last day in service
+    churn = np.where(churn == NAT, NO_CHURN, churn + 1)
+    first = np.maximum(start, np.where(known, reg[positions], start))
+    last = np.minimum(end, np.where(known, churn[positions], end))
+    return np.maximum(0, last - first), end - start
+
+
+def prorate_fee(cents, served, length):
+    """Fee in cents for served days out of length, rounded to the nearest cent (halves up)."""
+    return (np.asarray(cents, dtype=np.int64) * served * 2 + length) // (2 * length)
+
+
+def prorate_allowance(included, served, length):
+    """Allowance for served days out of length, rounded down to whole units."""
+    return np.asarray(included, dtype=np.int64) * served // length
+
+
+def period_year(periods):
+    return np.asarray(periods, dtype=np.int64) // 12 + 1970
+
+
+def period_month(periods):
+    """Month number (1-12) of the month every period starts in."""
+    return np.asarray(periods, dtype=np.int64) % 12 + 1
+
+
+def period_labels(periods):
+    """'YYYY-MM' label of every period."""
+    return pd.PeriodIndex.from_ordinals(np.asarray(periods, dtype=np.int64), freq='M').astype(str)
+
+
+if __name__ == '__main__':
+    n_events = int(sys.argv[1]) if len(sys.argv) > 1 else 10_000_000
+    rng = np.random.default_rng(0)
+    #Five years of event times with anchor days from 1 to 31
+    dates = pd.Series(np.datetime64('2018-01-01', 'ns') + rng.integers(
+        0, 5 * 365 * 86_400, n_events).astype('timedelta64[s]'))
+    anchors = rng.integers(1, 32, n_events)
+
+    start = time.perf_counter()
+    months = dates.dt.month.to_numpy()
+    accessor = time.perf_counter() - start
+    start = time.perf_counter()
+    keys = dates.dt.year.to_numpy() * 12 + dates.dt.month.to_numpy()
+    accessors = time.perf_counter() - start
+    start = time.perf_counter()
+    calendar = date_periods(dates)
+    calendar_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    cycle = date_periods(dates, anchors)
+    cycle_seconds = time.perf_counter() - start
+
+    assert (calendar == keys - 1970 * 12 - 1).all()
+    assert (period_month(calendar) == months).all()
+    first, after = period_bounds(cycle, anchors)
+    days = day_index(dates)
+    assert ((first <= days) & (days < after)).all()
+    print(f'{n_events} dates over {len(np.unique(calendar))} months')
+    print(f'dt.month:               {accessor:.3f} s')
+    print(f'dt.year * 12 + dt.month: {accessors:.3f} s')
+    print(f'calendar period keys:   {calendar_seconds:.3f} s')
+    print(f'cycle period keys:      {cycle_seconds:.3f} s')
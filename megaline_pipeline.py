@@ -0,0 +1,261 @@
+"""
+The Megaline analysis as a lazy graph of memoized stages.
+
+    load -> validate -> clean -> aggregate -> compact -> bill_cents -> stats -> plan_test / region_test
+                    \\-> quality           \\-> merge     \\-> bill ---------------> plots
+
+Pipeline.get(name) computes only the stages the requested one depends on. Every stage result is
+stored under a key derived from:
+- the stage's parameters (only the ones it uses, so changing alpha re-runs the tests and nothing
+  upstream)
+- the keys of its inputs (for load: the size, modification time and hash of the source files)
+- the source code of the stage function's module and of every megaline_* module it imports,
+  directly or through other megaline_* modules
+
+Results are kept in memory for the life of the Pipeline and pickled to cache_dir, so a new
+process with the same data, code and parameters loads them instead of recomputing. load and
+validate (the raw tables, which clean supersedes), bill (bill_cents in dollars) and plots (files
+on disk) are only memoized in memory; quality keeps the validation report and quarantined rows
+of megaline_validate.py without the tables.
+
+Billing and statistics run on the compact layout of megaline_compact.py (revenue in integer
+cents); merge keeps the full df_merged table for the exploratory part of the analysis.
+"""
+import ast
+import hashlib
+import importlib.util
+import inspect
+import json
+import os
+import pickle
+from collections import namedtuple
+from functools import lru_cache
+
+from megaline_billing import merge_plans
+from megaline_charts import render_report, report_specs
+from megaline_compact import bill_dollars, compact_bills, compact_cube, compact_usage
+from megaline_cube import welch_test
+from megaline_io import CACHE_VERSION, CLEANERS, DATA_DIR, TABLE_FILES, file_fingerprint, read_csv_schema
+from megaline_regions import batch_region_test
+from megaline_usage import aggregate_usage
+from megaline_validate import validate_tables
+
+CACHE_DIR = os.path.join('.megaline_cache', 'stages')
+
+# Default parameters of the stages; periods None bills whole calendar months, 'calendar' or 'cycle'
+# (megaline_periods.PERIOD_SCHEMES) prorates every user's first and last billing period
+PARAMETERS = {'data_dir': DATA_DIR, 'alpha': 0.05, 'metric': 'revenue', 'level': 'metro', 'out_dir': 'charts',
+              'policy': None, 'periods': None}
+
+# inputs: upstream stages, params: parameters used, persist: pickled to the cache directory,
+# sources: extra key material computed from the parameters (the source files of load)
+Stage = namedtuple('Stage', 'function inputs params persist sources', defaults=((), (), True, None))
+
+
+def load(data_dir):
+    """Raw tables as read from the CSV files."""
+    return {name: read_csv_schema(name, os.path.join(data_dir, file)) for name, file in TABLE_FILES.items()}
+
+
+def source_files(data_dir):
+    return {name: file_fingerprint(os.path.join(data_dir, file)) for name, file in TABLE_FILES.items()}
+
+
+def validate(raw, policy):
+    """Data-quality rules of every raw table; bad rows dropped or quarantined by policy."""
+    return validate_tables(raw, policy)
+
+
+def quality(validation):
+    """The validation report and quarantined rows, without the tables."""
+    return validation._replace(tables=None, masks=None)
+
+
+def clean(validation):
+    """Cleaned valid tables, in the load_tables order (calls, internet, messages, plans, users)."""
+    return tuple(CLEANERS[name](validation.tables[name].copy()) for name in TABLE_FILES)
+
+
+def aggregate(tables, periods):
+    """Usage per user and billing period (with the users' days in service unless periods is None)."""
+    calls, internet, messages, plans, users = tables
+    if periods is None:
+        return aggregate_usage(calls, messages, internet)
+    return aggregate_usage(calls, messages, internet, users, periods)
+
+
+def merge(tables, df_usage):
+    calls, internet, messages, plans, users = tables
+    return merge_plans(df_usage, users, plans)
+
+
+def compact(tables, df_usage):
+    """Usage in the compact layout (integer codes and narrow types), in the row order of merge."""
+    calls, internet, messages, plans, users = tables
+    return compact_usage(df_usage, users, plans)
+
+
+def bill_cents(tables, compact_table):
+    """Bills in integer cents, computed on the compact layout."""
+    return compact_bills(compact_table, tables[3])
+
+
+def stats(tables, compact_table, cents):
+    """Statistics cube of the billed user-months, computed on the compact layout."""
+    calls, internet, messages, plans, users = tables
+    return compact_cube(compact_table, cents, plans, users)
+
+
+def plan_test(cube, metric, alpha):
+    """Welch's t-test of the metric between Surf and Ultimate."""
+    result = welch_test(cube, metric, {'plan': 'surf'}, {'plan': 'ultimate'})
+    return {'statistic': result.statistic, 'pvalue': result.pvalue, 'reject': result.pvalue < alpha}
+
+
+def region_test(cube, tables, metric, level, alpha):
+    return batch_region_test(cube, metric, level, tables[4], alpha)
+
+
+def plots(df_merged, bills, cube, tables, out_dir):
+    """Render the full chart set; returns the written files."""
+    return render_report(report_specs(df_merged.assign(revenue=bills['revenue']), cube, tables[4]), out_dir)
+
+
+STAGES = {
+    'load': Stage(load, params=('data_dir',), persist=False, sources=source_files),
+    'validate': Stage(validate, inputs=('load',), params=('policy',), persist=False),
+    'quality': Stage(quality, inputs=('validate',)),
+    'clean': Stage(clean, inputs=('validate',)),
+    'aggregate': Stage(aggregate, inputs=('clean',), params=('periods',)),
+    'merge': Stage(merge, inputs=('clean', 'aggregate')),
+    'compact': Stage(compact, inputs=('clean', 'aggregate')),
+    'bill_cents': Stage(bill_cents, inputs=('clean', 'compact')),
+    'bill': Stage(bill_dollars, inputs=('bill_cents',), persist=False),
+    'stats': Stage(stats, inputs=('clean', 'compact', 'bill_cents')),
+    'plan_test': Stage(plan_test, inputs=('stats',), params=('metric', 'alpha')),
+    'region_test': Stage(region_test, inputs=('stats', 'clean'), params=('metric', 'level', 'alpha')),
+    'plots': Stage(plots, inputs=('merge', 'bill', 'stats', 'clean'), params=('out_dir',), persist=False),
+}
+
+
+@lru_cache(maxsize=None)
+def module_imports(path):
+    """
+    Source of a module and the megaline_* modules it imports anywhere in it (including inside
+    functions), by the name they are bound to.
+    """
+    with open(path, 'rb') as f:
+        source = f.read()
+    imports = {}
+    for node in ast.walk(ast.parse(source)):
+        if isinstance(node, ast.Import):
+            imports.update((alias.asname or alias.name, alias.name) for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.level == 0 and node.module:
+            imports.update((alias.asname or alias.name, node.module) for alias in node.names)
+    return source, {name: module for name, module in imports.items() if module.startswith('megaline_')}
+
+
+def code_names(code):
+    """Global names a code object and the code nested in it (comprehensions, lambdas) refer to."""
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if inspect.iscode(const):
+            names |= code_names(const)
+    return names
+
+
+def called_modules(function, seen):
+    """megaline_* modules a function calls into, following the functions of its own module."""
+    imports = module_imports(inspect.getsourcefile(function))[1]
+    for name in code_names(function.__code__):
+        value = function.__globals__.get(name)
+        if name in imports:
+            yield imports[name]
+        elif inspect.isfunction(value) and value.__module__ == function.__module__ and value not in seen:
+            seen.add(value)
+            yield from called_modules(value, seen)
+
+
+@lru_cache(maxsize=None)
+def code_version(function):
+    """
+    Hash of the module a stage function lives in and of the megaline_* modules it calls into,
+    with every megaline_* module those import in turn.
+    """
+    paths = {inspect.getsourcefile(function)}
+    pending = list(called_modules(function, {function}))
+    while pending:
+        spec = importlib.util.find_spec(pending.pop())
+        if spec is not None and spec.origin and spec.origin not in paths:
+            paths.add(spec.origin)
+            pending.extend(module_imports(spec.origin)[1].values())
+    digest = hashlib.sha256()
+    for path in sorted(paths, key=os.path.basename):
+        digest.update(os.path.basename(path).encode() + b'\0' + module_imports(path)[0])
+    return digest.hexdigest()
+
+
+class Pipeline:
+    """
+    Lazily evaluated, memoized Megaline stages.
+
+    Keyword arguments override PARAMETERS for every stage; get(name, **params) overrides them for
+    one request, e.g. pipeline.get('region_test', alpha=0.01). A StageProfiler, if given, records
+    every stage that is actually computed.
+    """
+
+    def __init__(self, data_dir=DATA_DIR, cache_dir=CACHE_DIR, profiler=None, **params):
+        self.params = {**PARAMETERS, 'data_dir': data_dir, **params}
+        self.cache_dir = cache_dir
+        self.profiler = profiler
+        self.results = {}
+        self.computed = []
+
+    def key(self, name, params, keys):
+        """Key of a stage result: its parameters, its inputs' keys and its code (keys: the keys known so far)."""
+        if name not in keys:
+            stage = STAGES[name]
+            material = {
+                'stage': name,
+                'version': CACHE_VERSION,
+                'code': code_version(stage.function),
+                'params': {param: params[param] for param in stage.params},
+                'inputs': [self.key(upstream, params, keys) for upstream in stage.inputs],
+            }
+            if stage.sources is not None:
+                material['sources'] = stage.sources(*(params[param] for param in stage.params))
+            keys[name] = hashlib.sha256(json.dumps(material, sort_keys=True, default=str).encode()).hexdigest()
+        return keys[name]
+
+    def get(self, name, **overrides):
+        """Result of a stage, computing (only) the stages that are not memoized yet."""
+        params = {**self.params, **overrides}
+        #Source files are fingerprinted once per request
+        return self.evaluate(name, params, {})
+
+    def evaluate(self, name, params, keys):
+        key = self.key(name, params, keys)
+        if key in self.results:
+            return self.results[key]
+
+        stage = STAGES[name]
+        path = os.path.join(self.cache_dir, f'{name}-{key[:20]}.pkl') if stage.persist and self.cache_dir else None
+        if path is not None and os.path.exists(path):
+            with open(path, 'rb') as f:
+                result = pickle.load(f)
+        else:
+            inputs = [self.evaluate(upstream, params, keys) for upstream in stage.inputs]
+            kwargs = {param: params[param] for param in stage.params}
+            if self.profiler is not None:
+                result = self.profiler.run_stage(name, stage.function, *inputs, **kwargs)
+            else:
+                result = stage.function(*inputs, **kwargs)
+            self.computed.append(name)
+            if path is not None:
+                os.makedirs(self.cache_dir, exist_ok=True)
+                with open(path + '.tmp', 'wb') as f:
+                    pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(path + '.tmp', path)
+
+        self.results[key] = result
+        return result
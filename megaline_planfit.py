@@ -0,0 +1,238 @@
+"""
+Per-customer plan fit for Megaline: what every user would have paid on every plan.
+
+The usage of a block of users is laid out as dense users x months matrices (one column per
+billing period; minutes, messages, traffic and whether the user-month was billed at all) and
+broadcast against the terms of every candidate plan at once. The result is the users x months x
+plans bill tensor in integer cents, with the bill_components rules (and, for a layout with the
+users' days in service, the prorated fee and allowances of megaline_compact.plan_terms). Each
+block is reduced right away to:
+
+- every user's total under their own plan and under the cheapest candidate
+  (the optimal-plan assignment)
+- per (segment, current plan, best plan), the number of users and their total under every
+  candidate, which gives the revenue impact of moving a whole segment to any plan
+
+so memory stays bounded by the block size (BLOCK_CELLS tensor cells) however many users and
+plans there are. Candidate plans are rows with the cleaned plans columns, e.g. the Megaline plans
+plus a megaline_whatif.plan_grid with a 'plan' name column.
+
+Run this file directly for the plan fit of the Megaline users (or of N_USERS synthetic users):
+
+    python megaline_planfit.py [N_USERS]
+"""
+import sys
+import time
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+from megaline_compact import CENTI_MB_PER_GB, CENTI_MB_PER_MB, CENTS_PER_USD, compact_plans
+from megaline_periods import prorate_allowance, prorate_fee
+
+# Cells of the users x months x plans tensor computed at a time (8 MB per int64 array)
+BLOCK_CELLS = 1_000_000
+
+# users: one row per user with their own (cost_cents) and their cheapest total; segments: one row
+# per (segment, plan, best_plan) with the number of users, their own total and their total in
+# cents under every candidate (one column per candidate plan)
+PlanFit = namedtuple('PlanFit', 'users segments')
+
+
+def bill_tensor(minutes, messages, centi_mb, billed, terms, served=None, length=None):
+    """
+    Bills in cents of users x months usage matrices under every plan (terms: compact_plans
+    columns as arrays). Returns a users x months x plans int64 array, so plans with huge
+    allowances or prices (an "unlimited" plan of 1e9 MB is 1e11 centi-MB) bill without wrapping;
+    months that were not billed (no usage) are 0. served and length (users x months days in
+    service and period lengths) prorate the fee and allowances of partial periods.
+    """
+    def over(usage, included):
+        return np.maximum(0, usage[:, :, None] - included)
+
+    terms = {column: np.asarray(values, dtype=np.int64) for column, values in terms.items()}
+    fee = terms['cents_monthly_pay']
+    minutes_included, messages_included = terms['minutes_included'], terms['messages_included']
+    mb_included = terms['mb_included_centi']
+    if served is not None:
+        #Same rounding as megaline_compact.plan_terms: fee to the cent, allowances down to whole units
+        served, length = served[:, :, None], length[:, :, None]
+        fee = prorate_fee(fee, served, length)
+        minutes_included = prorate_allowance(minutes_included, served, length)
+        messages_included = prorate_allowance(messages_included, served, length)
+        mb_included = prorate_allowance(mb_included // CENTI_MB_PER_MB, served, length) * CENTI_MB_PER_MB
+    bills = np.broadcast_to(fee, minutes.shape + terms['cents_monthly_pay'].shape).copy()
+    bills += over(minutes, minutes_included) * terms['cents_per_minute']
+    bills += over(messages, messages_included) * terms['cents_per_message']
+    #Ceiling division: whole GB of overage
+    bills += -(-over(centi_mb, mb_included) // CENTI_MB_PER_GB) * terms['cents_per_gb']
+    bills *= billed[:, :, None]
+    return bills
+
+
+def user_blocks(compact, block_users):
+    """
+    Dense usage of consecutive blocks of block_users users (compact layout rows): yields their
+    user ids, plan codes and users x months matrices of minutes, messages, traffic (and days in
+    service and period lengths, for a prorated layout) and billed.
+    """
+    if not compact['user_id'].is_monotonic_increasing:
+        compact = compact.iloc[np.argsort(compact['user_id'].to_numpy(), kind='stable')]
+    user_id = compact['user_id'].to_numpy()
+    month = compact['period'].to_numpy()
+    plan = compact['plan'].cat.codes.to_numpy()
+    columns = {name: compact[name].to_numpy() for name in ('minutes_sum', 'messages_count', 'mb_used_centi',
+                                                          'service_days', 'period_days') if name in compact}
+    months = np.unique(month)
+    starts = np.flatnonzero(np.r_[True, user_id[1:] != user_id[:-1]]) if len(user_id) else np.array([], dtype=int)
+
+    for first in range(0, len(starts), block_users):
+        block_starts = starts[first:first + block_users]
+        stop = starts[first + block_users] if first + block_users < len(starts) else len(user_id)
+        rows = np.repeat(np.arange(len(block_starts)), np.diff(np.r_[block_starts, stop]))
+        cols = np.searchsorted(months, month[block_starts[0]:stop])
+        matrices = {}
+        for name, values in columns.items():
+            #Cells without a bill get a 1-day period, so prorating them never divides by 0
+            matrix = np.full((len(block_starts), len(months)), name == 'period_days', dtype=np.int32)
+            matrix[rows, cols] = values[block_starts[0]:stop]
+            matrices[name] = matrix
+        billed = np.zeros((len(block_starts), len(months)), dtype=np.int32)
+        billed[rows, cols] = 1
+        yield user_id[block_starts].astype(np.int64), plan[block_starts].astype(np.int64), matrices, billed
+
+
+def plan_fit(compact, plans, candidates=None, segment=None, block_cells=BLOCK_CELLS):
+    """
+    Optimal-plan assignment of every user in the compact layout (megaline_compact.compact_usage).
+
+    plans are the cleaned plans the users are on (their current bills), candidates the plans
+    to compare (default: the same plans). segment optionally labels users (a Series indexed by
+    user_id, e.g. metro) to split the segment table further. Users on a missing plan are skipped.
+    Returns a PlanFit.
+    """
+    candidates = plans if candidates is None else candidates
+    names = candidates['plan'].astype(str).tolist()
+    plan_levels = list(compact['plan'].cat.categories)
+    #The users' own plans are billed as extra tensor columns after the candidates
+    own_plans = compact_plans(plans).set_index('plan').reindex(plan_levels).reset_index()
+    if own_plans.drop(columns='plan').isna().any().any():
+        raise ValueError(f'plans is missing some of the users\' plans: {plan_levels}')
+    terms = {column: values.to_numpy(dtype=np.int64) for column, values in
+             pd.concat([compact_plans(candidates), own_plans], ignore_index=True).drop(columns='plan').items()}
+    block_users = max(1, block_cells // (max(compact['period'].nunique(), 1) * len(terms['cents_monthly_pay'])))
+
+    #Candidate position of every current plan (-1 when it is not a candidate)
+    candidate_of = np.array([names.index(plan) if plan in names else -1 for plan in plan_levels], dtype=np.int64)
+    if segment is None:
+        segment_levels = np.array([None])
+    else:
+        segment = pd.Series(segment)
+        segment_codes, segment_levels = pd.factorize(segment)
+        segment_levels = np.append(np.asarray(segment_levels, dtype=object), None)
+        segment_codes = np.where(segment_codes < 0, len(segment_levels) - 1, segment_codes)
+        segment_index = pd.Index(segment.index)
+    n_keys = len(segment_levels) * len(plan_levels) * len(names)
+
+    users = []
+    segment_users = np.zeros(n_keys, dtype=np.int64)
+    segment_cost = np.zeros(n_keys)
+    segment_cents = np.zeros((n_keys, len(names)))
+    known = compact['plan'].cat.codes.to_numpy() >= 0
+    for user_ids, plan_codes, usage, billed in user_blocks(compact if known.all() else compact[known], block_users):
+        totals = bill_tensor(usage['minutes_sum'], usage['messages_count'], usage['mb_used_centi'], billed, terms,
+                             usage.get('service_days'), usage.get('period_days')).sum(axis=1, dtype=np.int64)
+        cost = totals[np.arange(len(totals)), len(names) + plan_codes]
+        totals = totals[:, :len(names)]
+        best = totals.argmin(axis=1)
+        #Users already on a cheapest plan keep it
+        current = candidate_of[plan_codes]
+        best = np.where((current >= 0) & (cost == totals.min(axis=1)), current, best)
+        best_cost = totals[np.arange(len(totals)), best]
+        users.append(pd.DataFrame({
+            'user_id': user_ids,
+            'plan': np.array(plan_levels, dtype=object)[plan_codes],
+            'cost_cents': cost,
+            'best_plan': np.array(names, dtype=object)[best],
+            'best_cost_cents': best_cost,
+            'savings_cents': cost - best_cost,
+        }))
+
+        if segment is None:
+            codes = np.zeros(len(user_ids), dtype=np.int64)
+        else:
+            positions = segment_index.get_indexer(user_ids)
+            codes = np.where(positions >= 0, segment_codes[positions], len(segment_levels) - 1)
+        key = (codes * len(plan_levels) + plan_codes) * len(names) + best
+        segment_users += np.bincount(key, minlength=n_keys)
+        segment_cost += np.bincount(key, weights=cost, minlength=n_keys)
+        for plan in range(len(names)):
+            segment_cents[:, plan] += np.bincount(key, weights=totals[:, plan], minlength=n_keys)
+
+    keys = np.flatnonzero(segment_users)
+    segment_code, rest = np.divmod(keys, len(plan_levels) * len(names))
+    plan_code, best_code = np.divmod(rest, len(names))
+    segments = pd.DataFrame({'segment': segment_levels[segment_code],
+                             'plan': np.array(plan_levels, dtype=object)[plan_code],
+                             'best_plan': np.array(names, dtype=object)[best_code],
+                             'users': segment_users[keys],
+                             'cost_cents': segment_cost[keys].round().astype(np.int64)})
+    segments = pd.concat([segments, pd.DataFrame(segment_cents[keys].round().astype(np.int64), columns=names)],
+                         axis=1)
+    if segment is None:
+        segments = segments.drop(columns='segment')
+    users = pd.concat(users, ignore_index=True) if users else pd.DataFrame(
+        columns=['user_id', 'plan', 'cost_cents', 'best_plan', 'best_cost_cents', 'savings_cents'])
+    return PlanFit(users, segments)
+
+
+def migration_impact(fit, target=None):
+    """
+    Revenue change (dollars) if every segment of a PlanFit moved to target, a candidate plan name
+    (default: each segment to its best plan). One row per segment with its users, revenue now,
+    revenue after the move, the change and the change per user.
+    """
+    segments = fit.segments
+    impact = segments[[column for column in ('segment', 'plan', 'best_plan', 'users') if column in segments]].copy()
+    impact['target'] = segments['best_plan'] if target is None else target
+    impact['revenue'] = segments['cost_cents'] / CENTS_PER_USD
+    moved = segments.drop(columns=impact.columns.intersection(segments.columns).tolist() + ['cost_cents'])
+    impact['revenue_after'] = moved.to_numpy(dtype=float)[np.arange(len(moved)), moved.columns.get_indexer(
+        impact['target'])] / CENTS_PER_USD
+    impact['change'] = impact['revenue_after'] - impact['revenue']
+    impact['change_per_user'] = impact['change'] / impact['users']
+    return impact
+
+
+if __name__ == '__main__':
+    from megaline_compact import compact_usage
+    from megaline_io import load_tables
+    from megaline_synth import synthetic_tables
+    from megaline_usage import aggregate_usage
+    from megaline_whatif import plan_grid
+
+    if len(sys.argv) > 1:
+        calls, internet, messages, plans, users = synthetic_tables(int(sys.argv[1]))
+    else:
+        calls, internet, messages, plans, users = load_tables()
+    compact = compact_usage(aggregate_usage(calls, messages, internet), users, plans)
+
+    start = time.perf_counter()
+    fit = plan_fit(compact, plans)
+    print(f'{len(fit.users)} users x {len(plans)} plans in {time.perf_counter() - start:.2f} s')
+    print(migration_impact(fit).round(2).to_string(index=False))
+    overpaying = fit.users[fit.users['savings_cents'] > 0]
+    print(f"\n{len(overpaying)} users would have paid less on another plan "
+          f"(${overpaying['savings_cents'].sum() / CENTS_PER_USD:,.2f} in total)")
+
+    #Dozens of Surf variants next to the Megaline plans
+    grid = plan_grid(usd_monthly_pay=[20, 30, 40, 50], minutes_included=[500, 1000, 3000],
+                     messages_included=[50, 1000], mb_per_month_included=[15360, 30720],
+                     usd_per_minute=[0.03], usd_per_message=[0.03], usd_per_gb=[10])
+    grid['plan'] = [f'variant_{i}' for i in range(len(grid))]
+    candidates = pd.concat([plans, grid], ignore_index=True)
+    start = time.perf_counter()
+    fit = plan_fit(compact, plans, candidates)
+    print(f'\n{len(fit.users)} users x {len(candidates)} plans in {time.perf_counter() - start:.2f} s')
+    print(fit.users['best_plan'].value_counts().head())
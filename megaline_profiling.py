@@ -0,0 +1,172 @@
+"""
+Per-stage instrumentation for the Megaline pipeline.
+
+A StageProfiler wraps every named stage of a run (load, aggregate, merge, billing, statistics,
+plotting, ...) and records for each one:
+
+    wall_seconds    elapsed time
+    cpu_seconds     user + system CPU time of this process and of worker processes that finished
+                    during the stage (process pools are shut down inside their stage)
+    peak_rss_mb     high-water mark of this process's resident memory after the stage
+    rss_growth_mb   how much the stage raised that high-water mark (what a batch node must add)
+    alloc_peak_mb   peak memory allocated during the stage on top of what was already allocated
+                    (tracemalloc: sees NumPy and pandas buffers, not pyarrow's own memory pool)
+    alloc_net_mb    memory still allocated at the end of the stage minus at its start
+    rows_in         rows of the DataFrames/arrays the stage received
+    rows_out        rows of what it returned
+
+The records are appended to a run log: one JSON object per line (.jsonl/.json) or CSV rows (.csv).
+Stages named in profile (or in the MEGALINE_PROFILE_STAGE environment variable, comma-separated)
+also run under cProfile; their stats are saved next to the log and the top functions printed.
+
+Stages must not be nested: each one resets the tracemalloc peak.
+"""
+import cProfile
+import json
+import os
+import pstats
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+RUN_DIR = '.megaline_runs'
+RUN_LOG = os.path.join(RUN_DIR, 'stages.jsonl')
+
+# Functions printed for every cProfiled stage
+PROFILE_TOP = 20
+
+MB = 1024 * 1024
+
+RECORD_COLUMNS = ['run', 'stage', 'start', 'wall_seconds', 'cpu_seconds', 'peak_rss_mb', 'rss_growth_mb',
+                  'alloc_peak_mb', 'alloc_net_mb', 'rows_in', 'rows_out', 'profile']
+
+
+def row_count(value):
+    """
+    Rows of a DataFrame, Series or array, summed over tuples, lists and dicts of them (None
+    otherwise). A namedtuple counts as its first field (e.g. the tables of a ValidationResult).
+    """
+    if isinstance(value, (pd.DataFrame, pd.Series, np.ndarray)):
+        return len(value)
+    if isinstance(value, tuple) and hasattr(value, '_fields'):
+        return row_count(value[0]) if value else None
+    if isinstance(value, dict):
+        value = list(value.values())
+    if isinstance(value, (tuple, list)):
+        counts = [row_count(item) for item in value]
+        counts = [count for count in counts if count is not None]
+        return sum(counts) if counts else None
+    return None
+
+
+def peak_rss_mb():
+    """High-water mark of this process's resident memory (NaN where the resource module is missing)."""
+    if resource is None:
+        return float('nan')
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    #Linux reports KB, macOS bytes
+    return peak / MB if sys.platform == 'darwin' else peak / 1024
+
+
+def cpu_seconds():
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+class StageProfiler:
+    """
+    Records wall time, CPU time, memory and row counts of every stage of one run.
+
+    trace_memory=False skips tracemalloc (the allocation columns are left empty), which removes
+    its overhead when only timings matter, e.g. in benchmarks.
+    """
+
+    def __init__(self, profile=None, trace_memory=True, log_dir=RUN_DIR):
+        if profile is None:
+            profile = os.environ.get('MEGALINE_PROFILE_STAGE', '')
+        if isinstance(profile, str):
+            profile = [name.strip() for name in profile.split(',') if name.strip()]
+        self.profile = set(profile)
+        self.trace_memory = trace_memory
+        self.log_dir = log_dir
+        self.run = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+        self.records = []
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextmanager
+    def stage(self, name, rows_in=None):
+        """
+        Instrument the block as stage name. Yields the stage's record; set record['rows_out'] in
+        the block when the output rows are known.
+        """
+        record = {'run': self.run, 'stage': name, 'start': datetime.now(timezone.utc).isoformat(),
+                  'rows_in': rows_in, 'rows_out': None, 'profile': ''}
+        rss_before = peak_rss_mb()
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+            allocated_before = tracemalloc.get_traced_memory()[0]
+        profiler = cProfile.Profile() if name in self.profile else None
+        cpu_start = cpu_seconds()
+        wall_start = time.perf_counter()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield record
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            record['wall_seconds'] = time.perf_counter() - wall_start
+            record['cpu_seconds'] = cpu_seconds() - cpu_start
+            record['peak_rss_mb'] = peak_rss_mb()
+            record['rss_growth_mb'] = record['peak_rss_mb'] - rss_before
+            if self.trace_memory:
+                allocated, peak = tracemalloc.get_traced_memory()
+                record['alloc_peak_mb'] = (peak - allocated_before) / MB
+                record['alloc_net_mb'] = (allocated - allocated_before) / MB
+            if profiler is not None:
+                record['profile'] = self.save_profile(profiler, name)
+            self.records.append(record)
+
+    def run_stage(self, name, function, *args, **kwargs):
+        """Call function(*args, **kwargs) as stage name, counting the rows of its arguments and result."""
+        with self.stage(name, rows_in=row_count(list(args) + list(kwargs.values()))) as record:
+            result = function(*args, **kwargs)
+            record['rows_out'] = row_count(result)
+        return result
+
+    def save_profile(self, profiler, name):
+        """Dump the cProfile stats of a stage and print its most expensive functions."""
+        os.makedirs(self.log_dir, exist_ok=True)
+        path = os.path.join(self.log_dir, f"{self.run.replace(':', '')}_{name}.prof")
+        profiler.dump_stats(path)
+        print(f'cProfile of stage {name!r} (saved to {path}):')
+        pstats.Stats(path).sort_stats('cumulative').print_stats(PROFILE_TOP)
+        return path
+
+    def summary(self):
+        """One row per recorded stage."""
+        return pd.DataFrame(self.records).reindex(columns=RECORD_COLUMNS).set_index('stage').drop(
+            columns=['run', 'start', 'profile'])
+
+    def save(self, path=RUN_LOG):
+        """Append the records of this run to a JSON-lines (.jsonl/.json) or CSV (.csv) run log."""
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        if path.endswith('.csv'):
+            pd.DataFrame(self.records).reindex(columns=RECORD_COLUMNS).to_csv(
+                path, mode='a', header=not os.path.exists(path), index=False)
+        else:
+            with open(path, 'a') as f:
+                for record in self.records:
+                    f.write(json.dumps(record) + '\n')
+        return path
@@ -0,0 +1,111 @@
+"""
+Metro-region index and batch hypothesis tests across every metro area.
+
+Megaline cities look like 'New York-Newark-Jersey City, NY-NJ-PA MSA'. parse_city splits every
+distinct city once into a metro name and its states, stored as categorical columns, so region
+filters never have to scan the city strings of every row again.
+
+batch_region_test compares every metro (or state) with the rest of the country in one vectorized
+pass. Each group's count, sum and M2 (sum of squared deviations from its mean) are pooled from
+the cells of the sufficient-statistics cube, the rest of the country is the overall total minus
+the group (the pairwise variance update solved for the rest), and the p-values of all the Welch
+tests are corrected for the false discovery rate (Benjamini-Hochberg).
+"""
+import numpy as np
+import pandas as pd
+from scipy import stats as st
+
+from megaline_cube import pool_cells
+
+
+def parse_city(city):
+    """
+    Metro name and states ('NY-NJ-PA') of every city, as categorical columns.
+
+    Only the distinct cities are parsed; the rows reuse the category codes.
+    """
+    codes, cities = pd.factorize(city)
+    parts = pd.Series(cities).str.rpartition(', ')
+    metros = parts[0].where(parts[1] != '', parts[2])
+    states = parts[2].where(parts[1] != '', '').str.replace(r'\s+MSA$', '', regex=True)
+
+    def categorical(values):
+        value_codes, categories = pd.factorize(values)
+        row_codes = np.where(codes >= 0, value_codes[codes], -1)
+        return pd.Categorical.from_codes(row_codes, categories=categories)
+
+    return pd.DataFrame({'metro': categorical(metros), 'states': categorical(states)}, index=city.index)
+
+
+def primary_state(states):
+    """First state listed for a metro ('NY' for 'NY-NJ-PA')."""
+    return pd.Series(states).astype(str).str.split('-').str[0]
+
+
+def region_stats(cube, metric='revenue', level='metro', users=None):
+    """
+    Count, sum and M2 of a metric per metro (the cube's region) or per primary state.
+
+    level='state' needs users (with the metro and states columns) to map every metro to its state.
+    """
+    region = cube.index.get_level_values('region')
+    #User-months of users missing from the users table have no region
+    known = np.flatnonzero(region.notna())
+    cells = cube.iloc[known]
+    region = region[known].astype(str).to_numpy()
+    if level == 'state':
+        metros = users[['metro', 'states']].drop_duplicates().astype(str)
+        state_of = pd.Series(primary_state(metros['states']).to_numpy(), index=metros['metro'].to_numpy())
+        region = state_of.reindex(region).to_numpy()
+    elif level != 'metro':
+        raise ValueError(f"level must be 'metro' or 'state', not {level!r}")
+    codes, names = pd.factorize(region, sort=True)
+    mapped = codes >= 0
+    n, total, m2 = pool_cells(cells['n'].to_numpy()[mapped], cells[metric + '_sum'].to_numpy()[mapped],
+                              cells[metric + '_m2'].to_numpy()[mapped], codes[mapped], len(names))
+    return pd.DataFrame({'n': n, 'sum': total, 'm2': m2}, index=pd.Index(names, name='region'))
+
+
+def benjamini_hochberg(pvalues):
+    """False-discovery-rate adjusted p-values (q-values) of a set of p-values."""
+    pvalues = np.asarray(pvalues, dtype=float)
+    m = len(pvalues)
+    order = np.argsort(pvalues)
+    ranked = pvalues[order] * m / np.arange(1, m + 1)
+    #Each q-value is the smallest ranked value at or after its rank
+    adjusted = np.minimum.accumulate(ranked[::-1])[::-1]
+    qvalues = np.empty(m)
+    qvalues[order] = np.minimum(adjusted, 1)
+    return qvalues
+
+
+def batch_region_test(cube, metric='revenue', level='metro', users=None, alpha=0.05):
+    """
+    Welch's t-test of every region against all other regions, with FDR correction.
+
+    Returns one row per region ranked by the average of the metric: user-months, region average,
+    average of the rest, difference, t statistic, degrees of freedom, p-value, q-value and whether
+    the difference is significant at the given false discovery rate.
+    """
+    stats = region_stats(cube, metric, level, users)
+    n, total, m2 = (stats[column].to_numpy(dtype=float) for column in ['n', 'sum', 'm2'])
+    (all_n,), (all_total,), (all_m2,) = pool_cells(n, total, m2)
+    rest_n, rest_total = all_n - n, all_total - total
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean, rest_mean = total / n, rest_total / rest_n
+        #M2 of the rest: the pairwise update (all = region + rest + n * rest_n / all_n * (mean - rest_mean)^2) solved for it
+        rest_m2 = np.maximum(all_m2 - m2 - n * rest_n / all_n * (mean - rest_mean) ** 2, 0)
+        var, rest_var = m2 / (n - 1), rest_m2 / (rest_n - 1)
+        se_a, se_b = var / n, rest_var / rest_n
+        t = (mean - rest_mean) / np.sqrt(se_a + se_b)
+        dof = (se_a + se_b) ** 2 / (se_a ** 2 / (n - 1) + se_b ** 2 / (rest_n - 1))
+    pvalue = 2 * st.t.sf(np.abs(t), dof)
+
+    result = pd.DataFrame({'user_months': n.astype(int), 'mean': mean, 'rest_mean': rest_mean,
+                           'difference': mean - rest_mean, 't': t, 'df': dof, 'pvalue': pvalue}, index=stats.index)
+    #Groups too small for a test (fewer than 2 user-months) get no p-value and are left out of the correction
+    tested = result['pvalue'].notna().to_numpy()
+    result['qvalue'] = np.nan
+    result.loc[tested, 'qvalue'] = benjamini_hochberg(result.loc[tested, 'pvalue'])
+    result['significant'] = result['qvalue'] < alpha
+    return result.sort_values('mean', ascending=False)
@@ -0,0 +1,135 @@
+"""
+Bootstrap confidence intervals and permutation tests for differences in means.
+
+The Welch t-test assumes the sample means are close to normal, which is questionable for the
+heavily right-skewed Surf revenue. These resampling tests make no such assumption.
+
+Resamples are generated in blocks as 2-D arrays (one row per resample) and reduced block by block.
+Revenue takes far fewer distinct values than there are user-months, so each sample is first
+reduced to its distinct values and their counts. A bootstrap resample is then a row of
+multinomial counts and a permutation a row of multivariate hypergeometric counts, so one resample
+costs O(distinct values) instead of O(user-months). A sample with more than MAX_DISTINCT distinct
+values (prorated bills, MB totals) is binned into MAX_DISTINCT equal-width bins, each standing
+for the mean of its values: the sample mean is unchanged, and a resample mean of n values moves
+by at most about w / (2 sqrt(n)) (one standard deviation, w the bin width), far inside the
+intervals. The permutation test compares the permuted differences with the observed difference
+of the same binned values, so the statistic and its null distribution come from one
+representation. Blocks get their own child seeds, so results depend only on the seed, not on the
+number of worker processes.
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+N_RESAMPLES = 100_000
+
+# Upper bound on the number of cells in one block of resamples
+BLOCK_CELLS = 4_000_000
+
+# Most distinct values a sample is resampled over; a sample with more is binned
+MAX_DISTINCT = 256
+
+
+def compress(values, return_inverse=False):
+    """
+    Distinct values of a sample and how often each occurs. Beyond MAX_DISTINCT distinct values,
+    the values are binned into MAX_DISTINCT equal-width bins and every occupied bin is represented
+    by the mean of its values. With return_inverse, also the position of every value's
+    representative in the returned values.
+    """
+    distinct, inverse, counts = np.unique(np.asarray(values, dtype=float), return_inverse=True, return_counts=True)
+    if len(distinct) <= MAX_DISTINCT:
+        return (distinct, counts, inverse) if return_inverse else (distinct, counts)
+    edges = np.linspace(distinct[0], distinct[-1], MAX_DISTINCT + 1)
+    bins = np.minimum(np.searchsorted(edges, distinct, side='right') - 1, MAX_DISTINCT - 1)
+    sums = np.bincount(bins, weights=distinct * counts, minlength=MAX_DISTINCT)
+    totals = np.bincount(bins, weights=counts, minlength=MAX_DISTINCT).astype(np.int64)
+    occupied = totals > 0
+    if return_inverse:
+        return sums[occupied] / totals[occupied], totals[occupied], (np.cumsum(occupied) - 1)[bins][inverse]
+    return sums[occupied] / totals[occupied], totals[occupied]
+
+
+def resample_width(values):
+    """Cells one resample of this sample takes (its distinct values or bins)."""
+    return len(compress(values)[0])
+
+
+def block_sizes(n_resamples, width):
+    """Split n_resamples into blocks of at most BLOCK_CELLS cells of the given row width."""
+    rows = max(1, BLOCK_CELLS // max(width, 1))
+    return [min(rows, n_resamples - start) for start in range(0, n_resamples, rows)]
+
+
+def bootstrap_means(values, n_resamples, rng):
+    """Means of n_resamples bootstrap resamples of one sample."""
+    distinct, counts = compress(values)
+    n = counts.sum()
+    return rng.multinomial(n, counts / n, size=n_resamples) @ distinct / n
+
+
+def bootstrap_block(a, b, n_resamples, seed):
+    rng = np.random.default_rng(seed)
+    return bootstrap_means(a, n_resamples, rng) - bootstrap_means(b, n_resamples, rng)
+
+
+def permutation_block(a, b, n_resamples, seed):
+    """Differences in means after randomly reassigning the pooled values to groups of the same sizes."""
+    rng = np.random.default_rng(seed)
+    n_a, n_b = len(a), len(b)
+    distinct, counts = compress(np.concatenate([a, b]))
+    total = distinct @ counts
+    sums_a = rng.multivariate_hypergeometric(counts, n_a, size=n_resamples) @ distinct
+    return sums_a / n_a - (total - sums_a) / n_b
+
+
+def run_blocks(block_function, a, b, n_resamples, seed, n_workers):
+    """Run block_function over all blocks (optionally in worker processes) and join the results."""
+    a = np.asarray(a, dtype=float)
+    b = np.asarray(b, dtype=float)
+    width = max(resample_width(a) + resample_width(b), resample_width(np.concatenate([a, b])))
+    sizes = block_sizes(n_resamples, width)
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    if n_workers == 1 or len(sizes) == 1:
+        results = [block_function(a, b, size, block_seed) for size, block_seed in zip(sizes, seeds)]
+    else:
+        with ProcessPoolExecutor(n_workers or os.cpu_count()) as pool:
+            results = list(pool.map(block_function, [a] * len(sizes), [b] * len(sizes), sizes, seeds))
+    return np.concatenate(results)
+
+
+def bootstrap_diff(a, b, n_resamples=N_RESAMPLES, confidence=0.95, seed=12345, n_workers=1):
+    """
+    Percentile bootstrap confidence interval for mean(a) - mean(b).
+
+    Each group is resampled with replacement independently. n_workers > 1 spreads the blocks over
+    worker processes (None uses every CPU).
+    """
+    diffs = run_blocks(bootstrap_block, a, b, n_resamples, seed, n_workers)
+    tail = (1 - confidence) / 2
+    low, high = np.quantile(diffs, [tail, 1 - tail])
+    return pd.Series({'difference': np.mean(a) - np.mean(b), 'ci_low': low, 'ci_high': high,
+                      'confidence': confidence, 'n_resamples': n_resamples})
+
+
+def permutation_test(a, b, n_resamples=N_RESAMPLES, seed=12345, n_workers=1):
+    """
+    Two-sided permutation test of equal means.
+
+    The p-value is the share of random group reassignments whose difference in means is at least as
+    large (in absolute value) as the observed one, with the usual +1 correction. The observed
+    difference is taken over the pooled values as permutation_block resamples them (binned, for a
+    sample with more than MAX_DISTINCT distinct values); the reported difference is the exact one.
+    """
+    a = np.asarray(a, dtype=float)
+    b = np.asarray(b, dtype=float)
+    distinct, _, inverse = compress(np.concatenate([a, b]), return_inverse=True)
+    represented = distinct[inverse]
+    observed = np.mean(represented[:len(a)]) - np.mean(represented[len(a):])
+    diffs = run_blocks(permutation_block, a, b, n_resamples, seed, n_workers)
+    #Small tolerance so reassignments that reproduce the observed split exactly count as "as large"
+    extreme = np.abs(diffs) >= np.abs(observed) * (1 - 1e-12)
+    pvalue = (extreme.sum() + 1) / (n_resamples + 1)
+    return pd.Series({'difference': np.mean(a) - np.mean(b), 'pvalue': pvalue, 'n_resamples': n_resamples})
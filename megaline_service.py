@@ -0,0 +1,266 @@
+"""
+Bill-lookup service for customer care and the self-service portal.
+
+Serves the monthly bills kept by the incremental billing state (megaline_incremental.py) over a
+small asyncio HTTP/1.1 server (standard library only, keep-alive connections). The bills are held
+in a BillIndex: the columns as NumPy arrays sorted by one integer key per (user_id, billing
+period), so a lookup is a binary search and no DataFrame is touched while serving. A bill is
+asked for by month and year (year defaults to DATA_YEAR) or by its period key (months since
+1970-01, megaline_periods), so the same month of two years are two different bills.
+
+    GET  /bill?user_id=1234&month=11[&year=2018]
+    GET  /bill?user_id=1234&period=586      one bill with its usage breakdown
+    GET  /user?user_id=1234                 every billing period of one user
+    POST /bills   [[1234, 11], [1000, 12]]  batch of bills (missing ones come back as null); the
+                                            rows of a batch are all [user_id, month] or all
+                                            [user_id, month, year]
+    GET  /whatif?user_id=1234&month=11&plan=ultimate&usd_per_gb=8
+                                            the same usage billed under another plan's terms,
+                                            optionally overriding single terms (LRU cached);
+                                            takes year or period like /bill
+    GET  /health                            rows served, load time and what-if cache statistics
+
+The state directory is polled every RELOAD_SECONDS. When a billing run lands (summary.parquet,
+which every run writes last, changes) the new bills are indexed in a worker thread and swapped
+in at once, so requests are never served from a half-loaded index.
+
+Usage:
+    python megaline_service.py [STATE_DIR [PORT]]
+"""
+import asyncio
+import json
+import os
+import sys
+import time
+from functools import lru_cache
+from urllib.parse import parse_qs, urlsplit
+
+import numpy as np
+import pandas as pd
+
+from megaline_billing import BILL_COLUMNS
+from megaline_cohorts import DATA_YEAR
+from megaline_incremental import STATE_DIR, read_bills
+from megaline_io import read_table
+from megaline_usage import PERIOD_KEYS, USAGE_COLUMNS
+from megaline_whatif import PLAN_TERMS, scenario_bills
+
+HOST = '127.0.0.1'
+PORT = 8018
+RELOAD_SECONDS = 2.0
+
+# What-if bills kept per loaded index
+WHATIF_CACHE = 100_000
+
+# Largest batch accepted by POST /bills
+MAX_BATCH = 10_000
+
+STATUS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed'}
+
+
+class RequestError(Exception):
+    """A request that cannot be answered, with the HTTP status to answer it with."""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def bill_key(user_id, period):
+    return np.asarray(user_id, dtype=np.int64) * PERIOD_KEYS + np.asarray(period, dtype=np.int64)
+
+
+def month_period(month, year=DATA_YEAR):
+    """Period key of a month (1-12) of a year."""
+    month = np.asarray(month, dtype=np.int64)
+    if ((month < 1) | (month > 12)).any():
+        raise RequestError(400, 'month must be between 1 and 12')
+    return (np.asarray(year, dtype=np.int64) - 1970) * 12 + month - 1
+
+
+def query_period(query):
+    """Period key of a query with a period, or a month and optionally a year."""
+    if 'period' in query:
+        return int(query['period'])
+    return int(month_period(int(query['month']), int(query.get('year', DATA_YEAR))))
+
+
+class BillIndex:
+    """Bills of the state directory, indexed by (user_id, period)."""
+
+    def __init__(self, state_dir=STATE_DIR, plans=None):
+        bills = read_bills(state_dir).sort_values(['user_id', 'period'], ignore_index=True)
+        self.keys = bill_key(bills['user_id'].to_numpy(), bills['period'].to_numpy())
+        self.columns = {column: bills[column].to_numpy() for column in BILL_COLUMNS}
+        self.plans = (read_table('plans') if plans is None else plans).set_index('plan')
+        self.loaded_at = time.time()
+        self.whatif = lru_cache(maxsize=WHATIF_CACHE)(self.whatif_bill)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def position(self, user_id, period):
+        position = int(np.searchsorted(self.keys, bill_key(user_id, period)))
+        if position < len(self.keys) and self.keys[position] == bill_key(user_id, period):
+            return position
+        return None
+
+    def row(self, position):
+        return {column: values[position].item() if hasattr(values[position], 'item') else values[position]
+                for column, values in self.columns.items()}
+
+    def bill(self, user_id, period):
+        position = self.position(user_id, period)
+        return None if position is None else self.row(position)
+
+    def bills(self, keys):
+        """
+        Bills of many [user_id, month] (DATA_YEAR) or many [user_id, month, year] rows with one
+        vectorized search (None for missing ones).
+        """
+        keys = np.asarray(keys, dtype=np.int64)
+        if keys.size == 0:
+            return []
+        if keys.ndim != 2 or keys.shape[1] not in (2, 3):
+            raise RequestError(400, 'bills are [user_id, month] or [user_id, month, year] rows')
+        year = keys[:, 2] if keys.shape[1] == 3 else DATA_YEAR
+        wanted = bill_key(keys[:, 0], month_period(keys[:, 1], year))
+        positions = np.minimum(np.searchsorted(self.keys, wanted), max(len(self.keys) - 1, 0))
+        found = self.keys[positions] == wanted if len(self.keys) else np.zeros(len(wanted), dtype=bool)
+        return [self.row(position) if hit else None for position, hit in zip(positions.tolist(), found.tolist())]
+
+    def user(self, user_id):
+        start, stop = np.searchsorted(self.keys, [bill_key(user_id, 0), bill_key(user_id + 1, 0)])
+        return [self.row(position) for position in range(start, stop)]
+
+    def whatif_bill(self, user_id, period, terms):
+        """Bill of one user-period under plan terms given as a sorted tuple of (term, value) pairs."""
+        bill = self.bill(user_id, period)
+        if bill is None:
+            return None
+        usage = pd.DataFrame([{column: bill[column] for column in ['user_id', 'month'] + USAGE_COLUMNS}])
+        result = scenario_bills(usage, dict(terms)).iloc[0].to_dict()
+        return {'user_id': user_id, 'month': bill['month'], 'period': period, 'terms': dict(terms),
+                **{column: float(value) for column, value in result.items() if column not in ('user_id', 'month')}}
+
+    def scenario_terms(self, query):
+        """Plan terms of a what-if query: the terms of plan (default: the user's plan) with overrides."""
+        user_id, period = int(query['user_id']), query_period(query)
+        bill = self.bill(user_id, period)
+        if bill is None:
+            raise RequestError(404, f'no bill for user {user_id} in period {period}')
+        plan = query.get('plan', bill['plan'])
+        if plan not in self.plans.index:
+            raise RequestError(400, f'unknown plan {plan!r}')
+        terms = self.plans.loc[plan, PLAN_TERMS].to_dict()
+        for term in PLAN_TERMS:
+            if term in query:
+                terms[term] = float(query[term])
+        return user_id, period, tuple(sorted((term, float(value)) for term, value in terms.items()))
+
+
+class BillService:
+    """HTTP front end of a BillIndex, reloading it when a new billing run lands."""
+
+    def __init__(self, state_dir=STATE_DIR, reload_seconds=RELOAD_SECONDS):
+        self.state_dir = state_dir
+        self.reload_seconds = reload_seconds
+        self.version = self.state_version()
+        self.index = BillIndex(state_dir)
+
+    def state_version(self):
+        path = os.path.join(self.state_dir, 'summary.parquet')
+        return os.stat(path).st_mtime_ns if os.path.exists(path) else None
+
+    async def watch(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.reload_seconds)
+            version = self.state_version()
+            if version != self.version:
+                try:
+                    index = await loop.run_in_executor(None, BillIndex, self.state_dir, self.index.plans.reset_index())
+                except (OSError, ValueError) as error:
+                    print(f'Reload failed, still serving the previous bills: {error}')
+                    continue
+                self.index, self.version = index, version
+                print(f'Reloaded {len(index)} bills')
+
+    def handle(self, method, target, body):
+        """Answer one request; returns (status, JSON-serializable payload)."""
+        url = urlsplit(target)
+        query = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        index = self.index
+        try:
+            if url.path == '/bill' and method == 'GET':
+                bill = index.bill(int(query['user_id']), query_period(query))
+                if bill is None:
+                    raise RequestError(404, 'no such bill')
+                return 200, bill
+            if url.path == '/user' and method == 'GET':
+                return 200, index.user(int(query['user_id']))
+            if url.path == '/bills' and method == 'POST':
+                keys = json.loads(body or b'[]')
+                if len(keys) > MAX_BATCH:
+                    raise RequestError(400, f'at most {MAX_BATCH} bills per batch')
+                return 200, index.bills(keys)
+            if url.path == '/whatif' and method == 'GET':
+                return 200, index.whatif(*index.scenario_terms(query))
+            if url.path == '/health' and method == 'GET':
+                return 200, {'bills': len(index), 'loaded_at': index.loaded_at,
+                             'whatif_cache': index.whatif.cache_info()._asdict()}
+            if url.path in ('/bill', '/user', '/bills', '/whatif', '/health'):
+                raise RequestError(405, f'{method} not allowed on {url.path}')
+            raise RequestError(404, f'unknown path {url.path}')
+        except RequestError as error:
+            return error.status, {'error': str(error)}
+        except (KeyError, ValueError, TypeError) as error:
+            return 400, {'error': f'bad request: {error}'}
+
+    async def serve_connection(self, reader, writer):
+        """Serve the requests of one keep-alive connection."""
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, _ = request_line.decode('latin-1').split(' ', 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get('content-length', 0))
+                body = await reader.readexactly(length) if length else b''
+
+                status, payload = self.handle(method, target, body)
+                data = json.dumps(payload).encode()
+                close = headers.get('connection', '').lower() == 'close'
+                writer.write(f'HTTP/1.1 {status} {STATUS[status]}\r\nContent-Type: application/json\r\n'
+                             f'Content-Length: {len(data)}\r\n{"Connection: close" if close else "Connection: keep-alive"}'
+                             f'\r\n\r\n'.encode() + data)
+                await writer.drain()
+                if close:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host=HOST, port=PORT):
+        server = await asyncio.start_server(self.serve_connection, host, port)
+        watcher = asyncio.create_task(self.watch())
+        print(f'Serving {len(self.index)} bills on http://{host}:{port}')
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            watcher.cancel()
+
+
+if __name__ == '__main__':
+    state_dir = sys.argv[1] if len(sys.argv) > 1 else STATE_DIR
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else PORT
+    asyncio.run(BillService(state_dir).serve(port=port))
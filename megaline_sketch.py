@@ -0,0 +1,403 @@
+"""
+Bounded-memory distribution sketches of the Megaline user-months.
+
+For every plan x billing period and every metric in SKETCH_METRICS (minutes, messages, billed GB and
+revenue of a user-month) a MetricSketch keeps three mergeable summaries:
+
+    moments     n, mean, M2 (sum of squared deviations from the mean), min, max: exact mean,
+                variance, min and max. Parts are merged with the pairwise update of Chan, Golub &
+                LeVeque, which keeps the variance accurate where sum - sum of squares would cancel
+    histogram   counts on fixed bin edges (plus one underflow and one overflow bin): exact counts,
+                so a quantile read off them is within one bin width
+    KLL         a KLL quantile sketch (Karnin, Lang & Liberty, 2016) with k = KLL_K: the true rank
+                of a returned quantile is within about 1.65% of q * n at 99% confidence
+                (k = 200, the error of the Apache DataSketches implementation; it shrinks as 1/k).
+                While no more than k values were added the sketch holds them all and is exact.
+
+A sketch holds about 3k KLL items plus the bins whatever the number of user-months (a few KB),
+and two sketches of disjoint user-months merge into the sketch of their union. Shards of users
+(megaline_parallel.aggregate_and_sketch) merge into the full base, and periods (the incremental
+state keeps one sketch per period, see megaline_incremental.read_sketches) merge into a year.
+Every KLL sketch flips its coins with its own seed, derived from the seed of the shard, the group
+and the metric, so the sketches merged from several shards do not all promote the same offsets.
+
+When a day changes bills of a period (apply_changes), the old bills are taken back out of the
+moments and histograms and the new ones added; only the KLL sketch, min and max, which cannot
+give a value back, are rebuilt from the bills of the period.
+
+Quantiles follow the inverted-CDF definition (np.quantile(..., method='inverted_cdf')).
+
+Run this file directly to compare sketched and exact quantiles on N_USERS synthetic users:
+
+    python megaline_sketch.py [N_USERS]
+"""
+import copy
+import pickle
+import sys
+
+import numpy as np
+import pandas as pd
+
+from megaline_charts import BINS, MAX_FLIERS, PLAN_COLORS, PLAN_LABELS
+
+KLL_K = 200
+
+# Capacity of a KLL level relative to the level above it
+KLL_DECAY = 2 / 3
+
+# Fixed bin edges of every sketched metric (values outside go to the underflow/overflow bins)
+SKETCH_METRICS = {
+    'minutes_sum': np.arange(0, 3001, 10),
+    'messages_count': np.arange(0, 501, 2),
+    'gb_used_billed': np.arange(0, 201, 1),
+    'revenue': np.arange(0, 1001, 5),
+}
+
+# Sketched groups; the period (months since 1970-01) keeps the same month of two years apart
+SKETCH_GROUPS = ['plan', 'period']
+
+QUANTILES = (0.5, 0.9, 0.99)
+
+
+class KLLSketch:
+    """
+    Mergeable quantile sketch. Level h holds values that each stand for 2**h of the values added.
+    A level over its capacity is sorted and every other value (random offset) moves up a level.
+    """
+
+    def __init__(self, k=KLL_K, seed=0):
+        self.k = k
+        self.n = 0
+        self.levels = [np.empty(0)]
+        self.rng = np.random.default_rng(seed)
+
+    def capacity(self, level):
+        return max(int(np.ceil(self.k * KLL_DECAY ** (len(self.levels) - 1 - level))), 2)
+
+    def compress(self):
+        level = 0
+        while level < len(self.levels):
+            items = self.levels[level]
+            if len(items) > self.capacity(level):
+                if level + 1 == len(self.levels):
+                    self.levels.append(np.empty(0))
+                items = np.sort(items)
+                #An odd value out stays on this level
+                odd = len(items) % 2
+                promoted = items[odd + self.rng.integers(2)::2]
+                self.levels[level + 1] = np.concatenate([self.levels[level + 1], promoted])
+                self.levels[level] = items[:odd]
+            level += 1
+
+    def update(self, values):
+        values = np.asarray(values, dtype=float)
+        self.n += len(values)
+        self.levels[0] = np.concatenate([self.levels[0], values])
+        self.compress()
+        return self
+
+    def merge(self, other):
+        self.n += other.n
+        for level, items in enumerate(other.levels):
+            if level == len(self.levels):
+                self.levels.append(np.empty(0))
+            self.levels[level] = np.concatenate([self.levels[level], items])
+        self.compress()
+        return self
+
+    def weighted_items(self):
+        """Retained values in ascending order and their cumulative weights."""
+        items = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(len(level), 2 ** h, dtype=np.int64) for h, level in enumerate(self.levels)])
+        order = np.argsort(items, kind='stable')
+        return items[order], np.cumsum(weights[order])
+
+    def quantile(self, q):
+        items, cumulative = self.weighted_items()
+        if len(items) == 0:
+            return np.full(np.shape(q), np.nan)
+        position = np.searchsorted(cumulative, np.asarray(q, dtype=float) * cumulative[-1], side='left')
+        return items[np.minimum(position, len(items) - 1)]
+
+    def cdf(self, values):
+        """Estimated share of the values that are <= every given value."""
+        items, cumulative = self.weighted_items()
+        if len(items) == 0:
+            return np.full(np.shape(values), np.nan)
+        position = np.searchsorted(items, values, side='right')
+        return np.where(position > 0, cumulative[np.maximum(position - 1, 0)], 0) / cumulative[-1]
+
+
+def known_values(values):
+    values = np.asarray(values, dtype=float)
+    return values[~np.isnan(values)]
+
+
+def moments(values):
+    """n, mean and M2 (sum of squared deviations from the mean) of an array without NaN."""
+    if len(values) == 0:
+        return 0, np.nan, 0.0
+    mean = values.mean()
+    return len(values), mean, ((values - mean) ** 2).sum()
+
+
+class MetricSketch:
+    """Moments, fixed-bin histogram and KLL sketch of one metric."""
+
+    def __init__(self, edges, k=KLL_K, seed=0):
+        self.edges = np.asarray(edges, dtype=float)
+        #counts[0]: below edges[0], counts[i]: [edges[i - 1], edges[i]), counts[-1]: at or above edges[-1]
+        self.counts = np.zeros(len(self.edges) + 1, dtype=np.int64)
+        self.n = 0
+        self.mean = np.nan
+        self.m2 = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+        self.kll = KLLSketch(k, seed)
+
+    def bin_counts(self, values):
+        return np.bincount(np.searchsorted(self.edges, values, side='right'), minlength=len(self.counts))
+
+    def add_moments(self, n, mean, m2):
+        """Merge the moments of other values into the sketch's (Chan et al.'s pairwise update)."""
+        if n == 0:
+            return
+        if self.n == 0:
+            self.n, self.mean, self.m2 = n, mean, m2
+            return
+        total = self.n + n
+        delta = mean - self.mean
+        self.mean += delta * n / total
+        self.m2 += m2 + delta * delta * self.n * n / total
+        self.n = total
+
+    def remove_moments(self, n, mean, m2):
+        """Take the moments of values merged in earlier back out (the pairwise update solved for the rest)."""
+        if n == 0:
+            return
+        rest = self.n - n
+        if rest <= 0:
+            self.n, self.mean, self.m2 = 0, np.nan, 0.0
+            return
+        rest_mean = (self.n * self.mean - n * mean) / rest
+        delta = mean - rest_mean
+        self.m2 = max(self.m2 - m2 - delta * delta * rest * n / self.n, 0.0)
+        self.n, self.mean = rest, rest_mean
+
+    def update(self, values):
+        values = known_values(values)
+        if len(values) == 0:
+            return self
+        self.add_moments(*moments(values))
+        self.min = min(self.min, values.min())
+        self.max = max(self.max, values.max())
+        self.counts += self.bin_counts(values)
+        self.kll.update(values)
+        return self
+
+    def replace(self, old, new, values, seed=0):
+        """
+        Swap old values, added earlier, for new ones: the moments and the histogram change by the
+        difference, while the KLL sketch, min and max, which cannot give a value back, are rebuilt
+        from values (every value the sketch holds after the swap) with a new seed.
+        """
+        old, new, values = known_values(old), known_values(new), known_values(values)
+        self.remove_moments(*moments(old))
+        self.add_moments(*moments(new))
+        self.counts += self.bin_counts(new) - self.bin_counts(old)
+        self.min = values.min() if len(values) else np.inf
+        self.max = values.max() if len(values) else -np.inf
+        self.kll = KLLSketch(self.kll.k, seed).update(values)
+        return self
+
+    def merge(self, other):
+        if not np.array_equal(self.edges, other.edges):
+            raise ValueError('Sketches with different bin edges cannot be merged.')
+        self.add_moments(other.n, other.mean, other.m2)
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.counts += other.counts
+        self.kll.merge(other.kll)
+        return self
+
+    @property
+    def var(self):
+        """Variance with ddof=1, like pandas."""
+        if self.n < 2:
+            return np.nan
+        return self.m2 / (self.n - 1)
+
+    def quantile(self, q):
+        return np.clip(self.kll.quantile(q), self.min, self.max)
+
+    def histogram(self, bins=BINS):
+        """
+        Counts and edges of about `bins` bins over the occupied part of the fixed bins (adjacent
+        bins are added up). Values in the underflow/overflow bins are not included.
+        """
+        inside = self.counts[1:-1]
+        occupied = np.flatnonzero(inside)
+        if len(occupied) == 0:
+            return np.zeros(0, dtype=np.int64), self.edges[:1]
+        first = occupied[0]
+        width = -(-(occupied[-1] + 1 - first) // bins)
+        span = width * -(-(occupied[-1] + 1 - first) // width)
+        #The last coarse bin may run past the fixed bins: continue them at the last bin width
+        counts = np.concatenate([inside, np.zeros(width, dtype=np.int64)])[first:first + span]
+        edges = np.concatenate([self.edges, self.edges[-1] + (self.edges[-1] - self.edges[-2]) * np.arange(1, width + 1)])
+        return counts.reshape(-1, width).sum(axis=1), edges[first:first + span + 1:width]
+
+    def box_stats(self, label):
+        """
+        Box of matplotlib's Axes.bxp from the sketch: sketched quartiles, whiskers at the most
+        extreme retained values within 1.5 IQR and the retained values beyond them as outliers.
+        """
+        q1, median, q3 = self.quantile([0.25, 0.5, 0.75])
+        low, high = q1 - 1.5 * (q3 - q1), q3 + 1.5 * (q3 - q1)
+        items = np.unique(np.concatenate([self.kll.weighted_items()[0], [self.min, self.max]]))
+        inside = items[(items >= low) & (items <= high)]
+        fliers = items[(items < low) | (items > high)]
+        if len(fliers) > MAX_FLIERS:
+            fliers = fliers[np.linspace(0, len(fliers) - 1, MAX_FLIERS).round().astype(int)]
+        return {'label': label, 'med': median, 'q1': q1, 'q3': q3, 'whislo': inside.min(), 'whishi': inside.max(),
+                'fliers': fliers}
+
+
+def kll_seed(seed, group, metric):
+    """Seed of the KLL sketch of one metric of a group, from the seed of the shard (or state)."""
+    return np.random.SeedSequence([seed, group, metric])
+
+
+def sketch_bills(billed, metrics=None, k=KLL_K, seed=0):
+    """
+    Sketches of billed user-months (bill_usage rows or df_merged with revenue): {(plan, period): {metric: MetricSketch}}.
+    Shards sketched separately to be merged should each get their own seed.
+    """
+    metrics = SKETCH_METRICS if metrics is None else metrics
+    sketches = {}
+    for group, (key, rows) in enumerate(billed.groupby(SKETCH_GROUPS, observed=True, sort=True)):
+        sketches[key] = {metric: MetricSketch(edges, k, kll_seed(seed, group, number)).update(
+            rows[metric].to_numpy(dtype=float)) for number, (metric, edges) in enumerate(metrics.items())}
+    return sketches
+
+
+def apply_changes(sketches, removed, added, current, metrics=None, k=KLL_K, seed=0):
+    """
+    Update sketches in place for changed bills: removed are the old bills of the changed
+    user-months, added their new bills and current every bill of the groups they fall in (after
+    the change). Moments and histograms change by the difference; the KLL sketch, min and max of
+    every changed group are rebuilt from current. Returns sketches.
+    """
+    metrics = SKETCH_METRICS if metrics is None else metrics
+    keys = pd.concat([removed[SKETCH_GROUPS], added[SKETCH_GROUPS]]).drop_duplicates()
+    removed_rows = removed.groupby(SKETCH_GROUPS, observed=True).indices
+    added_rows = added.groupby(SKETCH_GROUPS, observed=True).indices
+    current_rows = current.groupby(SKETCH_GROUPS, observed=True).indices
+    empty = np.zeros(0, dtype=np.intp)
+    for group, key in enumerate(keys.itertuples(index=False, name=None)):
+        if key not in sketches:
+            sketches[key] = {metric: MetricSketch(edges, k) for metric, edges in metrics.items()}
+        for number, (metric, sketch) in enumerate(sketches[key].items()):
+            sketch.replace(removed[metric].to_numpy(dtype=float)[removed_rows.get(key, empty)],
+                           added[metric].to_numpy(dtype=float)[added_rows.get(key, empty)],
+                           current[metric].to_numpy(dtype=float)[current_rows.get(key, empty)],
+                           kll_seed(seed, group, number))
+        if all(sketch.n == 0 for sketch in sketches[key].values()):
+            del sketches[key]
+    return sketches
+
+
+def merge_sketches(*parts):
+    """Merge sketch dicts of disjoint user-months (shards, months); the parts are left unchanged."""
+    merged = {}
+    for part in parts:
+        for key, metrics in part.items():
+            if key not in merged:
+                merged[key] = copy.deepcopy(metrics)
+            else:
+                for metric, sketch in metrics.items():
+                    merged[key][metric].merge(sketch)
+    return merged
+
+
+def combine(sketches, **filters):
+    """
+    One sketch per metric over every group matching the filters, e.g. combine(sketches,
+    plan='surf') for a plan's whole year.
+    """
+    combined = {}
+    for key, metrics in sketches.items():
+        if all(key[SKETCH_GROUPS.index(name)] in np.atleast_1d(value) for name, value in filters.items()):
+            combined = merge_sketches(combined, {None: metrics})
+    return combined.get(None, {})
+
+
+def sketch_summary(sketches, quantiles=QUANTILES):
+    """Count, mean, std, min, sketched quantiles, max and out-of-range share per plan, period and metric."""
+    rows = []
+    for (plan, period), metrics in sketches.items():
+        for metric, sketch in metrics.items():
+            row = {'plan': plan, 'period': period, 'metric': metric, 'n': sketch.n, 'mean': sketch.mean,
+                   'std': np.sqrt(sketch.var), 'min': sketch.min}
+            row.update({f'p{round(q * 100):02d}': value for q, value in zip(quantiles, sketch.quantile(quantiles))})
+            row['max'] = sketch.max
+            row['out_of_range'] = (sketch.counts[0] + sketch.counts[-1]) / sketch.n if sketch.n else np.nan
+            rows.append(row)
+    return pd.DataFrame(rows).set_index(['plan', 'period', 'metric']).sort_index()
+
+
+def sketch_report_specs(sketches, plans=('surf', 'ultimate')):
+    """Histogram and box plot chart specs (megaline_charts) of every metric per plan, over all months."""
+    by_plan = {plan: combine(sketches, plan=plan) for plan in plans}
+    specs = []
+    for metric in SKETCH_METRICS:
+        layers = []
+        for plan in plans:
+            if metric in by_plan[plan]:
+                counts, edges = by_plan[plan][metric].histogram()
+                layers.append({'label': PLAN_LABELS.get(plan, plan), 'color': PLAN_COLORS.get(plan),
+                               'counts': counts, 'edges': edges})
+        specs.append({'kind': 'hist', 'name': f'sketch_{metric}_distribution', 'title': f'Distribution of {metric}',
+                      'xlabel': metric, 'ylabel': 'User-months', 'layers': layers})
+        specs.append({'kind': 'box', 'name': f'sketch_{metric}_boxplot', 'title': f'{metric} by Plan', 'ylabel': metric,
+                      'grid': True, 'boxes': [by_plan[plan][metric].box_stats(PLAN_LABELS.get(plan, plan))
+                                              for plan in plans if metric in by_plan[plan]]})
+    return specs
+
+
+def rank_errors(sketch, values, quantiles=QUANTILES):
+    """|rank of the sketched quantile - q| for every q, measured against the exact values."""
+    values = np.sort(np.asarray(values, dtype=float))
+    estimates = sketch.quantile(quantiles)
+    #Any rank between the first and last position of the estimate counts as exact
+    low = np.searchsorted(values, estimates, side='left') / len(values)
+    high = np.searchsorted(values, estimates, side='right') / len(values)
+    q = np.asarray(quantiles)
+    return np.where(q < low, low - q, np.where(q > high, q - high, 0.0))
+
+
+if __name__ == '__main__':
+    from megaline_billing import bill_usage
+    from megaline_synth import synthetic_tables
+    from megaline_usage import aggregate_usage
+
+    n_users = int(sys.argv[1]) if len(sys.argv) > 1 else 50_000
+    calls, internet, messages, plans, users = synthetic_tables(n_users)
+    billed = bill_usage(aggregate_usage(calls, messages, internet), users, plans)
+
+    #Sketch 8 shards of users separately and merge them, as the parallel path does
+    shards = billed['user_id'].to_numpy() % 8
+    sketches = merge_sketches(*(sketch_bills(billed[shards == shard], seed=shard) for shard in range(8)))
+    print(sketch_summary(sketches).round(2).head(8))
+
+    errors = []
+    for plan in ('surf', 'ultimate'):
+        rows = billed[billed['plan'] == plan]
+        for metric, sketch in combine(sketches, plan=plan).items():
+            errors.append(pd.Series(rank_errors(sketch, rows[metric]), index=[f'p{round(q * 100):02d}' for q in QUANTILES],
+                                    name=(plan, metric)))
+    print('\nRank error of the sketched quantiles over a plan-year:')
+    print(pd.DataFrame(errors).round(4))
+    size = len(pickle.dumps(sketches))
+    print(f'\n{len(billed)} user-months: sketches {size / 1024:.0f} KB, '
+          f'sketched columns {billed[list(SKETCH_METRICS)].memory_usage(index=False).sum() / 1024:.0f} KB')
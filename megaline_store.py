@@ -0,0 +1,331 @@
+"""
+On-disk Megaline event store with per-user lookups.
+
+Calls, messages and internet sessions are written as columnar .npy files sorted by (user_id,
+month, date), one file per column, and opened as read-only memory maps. An offset index with one
+entry per (user, month) cell gives the position of every user-month in the sorted columns, so a
+user's history or one of their months is a zero-copy slice of the mapped arrays found in O(1),
+and monthly usage is a segmented sum over the mapped columns that never loads them whole.
+
+The store is built in two passes over the logs, which can be DataFrames or CSV files read in
+chunks. The first pass counts the events of every (user, month) cell and turns the counts into
+offsets. The second scatters each chunk straight to its cells in the output files. Each block of
+cells is then sorted by date in place. Events without a date belong to no cell: both passes leave
+them out, and their number is kept in the store's meta.json (undated). Dates must fall in the
+MONTH_SPAN months from 1970-01.
+
+The cells are calendar months, so usage and bill serve calendar billing periods only: whole months
+by default, or with periods='calendar' the first and last month of every user prorated to the days
+in service like the pipeline's bills. The cycle scheme (megaline_periods) is refused with a
+ValueError; it needs aggregate_usage over the events.
+
+Usage:
+    python megaline_store.py [DATA_DIR [STORE_DIR]]   (build the store from the CSV files)
+"""
+import json
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+from megaline_billing import bill_components, merge_plans
+from megaline_cohorts import DATA_YEAR, month_index
+from megaline_io import CLEANERS, DATA_DIR, TABLE_FILES
+from megaline_periods import service_days
+from megaline_usage import CHUNK_SIZE, usage_frame
+
+STORE_DIR = '.megaline_store'
+
+# Date column and value columns (with their stored types) of every log
+LOGS = {
+    'calls': ('call_date', {'duration': np.int32}),
+    'messages': ('message_date', {}),
+    'internet': ('session_date', {'mb_used': np.float64}),
+}
+
+# Month index (months since 1970-01) combined with a user id into one cell code in the first pass
+MONTH_SPAN = 1 << 12
+
+
+def frame_chunks(df, chunksize=CHUNK_SIZE):
+    """Source of a cleaned log held in memory."""
+    return lambda: (df.iloc[start:start + chunksize] for start in range(0, len(df), chunksize))
+
+
+def csv_chunks(path, log, chunksize=CHUNK_SIZE):
+    """Source of a raw CSV log: chunks are cleaned as they are read (dates parsed, calls rounded UP)."""
+    date_column, values = LOGS[log]
+
+    def chunks():
+        for chunk in pd.read_csv(path, usecols=['user_id', date_column] + list(values), dtype={date_column: str},
+                                 chunksize=chunksize):
+            yield CLEANERS[log](chunk)
+    return chunks
+
+
+def check_periods(periods):
+    """Raise ValueError unless periods is None or 'calendar' (the store's cells are calendar months)."""
+    if periods not in (None, 'calendar'):
+        raise ValueError(f'the event store keeps calendar months and cannot serve {periods!r} billing periods')
+
+
+def day_of(dates):
+    return pd.Series(dates).to_numpy().astype('datetime64[D]')
+
+
+def add_up(codes, counts):
+    """Distinct codes and their total counts."""
+    distinct, inverse = np.unique(codes, return_inverse=True)
+    return distinct, np.bincount(inverse, weights=counts, minlength=len(distinct)).astype(np.int64)
+
+
+def dated_months(chunk, log):
+    """
+    Rows of a chunk that have a date and their month indexes. Raises ValueError for months outside
+    the MONTH_SPAN months a cell code can hold.
+    """
+    dates = chunk[LOGS[log][0]]
+    dated = dates.notna().to_numpy()
+    months = month_index(dates[dated])
+    if len(months) and (months.min() < 0 or months.max() >= MONTH_SPAN):
+        last = pd.Period(ordinal=MONTH_SPAN - 1, freq='M')
+        raise ValueError(f'{log} has dates outside 1970-01 to {last}, which the event store cannot hold')
+    return dated, months
+
+
+def cell_counts(sources):
+    """
+    First pass: distinct (user_id, month index) codes of every log and their number of events, and
+    the number of events without a date of every log.
+    """
+    counts = {}
+    undated = {}
+    for log, chunks in sources.items():
+        codes, totals = np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+        undated[log] = 0
+        pending = []
+        for chunk in chunks():
+            dated, months = dated_months(chunk, log)
+            undated[log] += int((~dated).sum())
+            chunk_codes = chunk['user_id'].to_numpy(dtype=np.int64)[dated] * MONTH_SPAN + months
+            pending.append(np.unique(chunk_codes, return_counts=True))
+            #Fold the pending chunks in once they outgrow the totals, so every code is re-added O(log n) times
+            if sum(len(chunk_codes) for chunk_codes, _ in pending) >= len(codes):
+                codes, totals = add_up(*(np.concatenate(part) for part in zip((codes, totals), *pending)))
+                pending = []
+        if pending:
+            codes, totals = add_up(*(np.concatenate(part) for part in zip((codes, totals), *pending)))
+        counts[log] = (codes, totals)
+    return counts, undated
+
+
+def build_store(sources, store_dir=STORE_DIR, chunksize=CHUNK_SIZE):
+    """
+    Write the event store from sources, a dict mapping a log name to a callable that returns an
+    iterator of cleaned chunks (frame_chunks or csv_chunks). Returns the opened store.
+    """
+    counts, undated = cell_counts(sources)
+    codes = np.concatenate([log_codes for log_codes, _ in counts.values()])
+    if len(codes) == 0:
+        raise ValueError('cannot build an event store without dated events')
+    users, months = codes // MONTH_SPAN, codes % MONTH_SPAN
+    meta = {'first_user': int(users.min()), 'n_users': int(users.max() - users.min() + 1),
+            'first_month': int(months.min()), 'n_months': int(months.max() - months.min() + 1), 'events': {},
+            'undated': undated}
+    n_cells = meta['n_users'] * meta['n_months']
+
+    def cells(user_ids, month_indexes):
+        return (user_ids - meta['first_user']) * meta['n_months'] + (month_indexes - meta['first_month'])
+
+    os.makedirs(store_dir, exist_ok=True)
+    if os.path.exists(os.path.join(store_dir, 'meta.json')):
+        os.remove(os.path.join(store_dir, 'meta.json'))
+    for log, chunks in sources.items():
+        date_column, values = LOGS[log]
+        log_codes, totals = counts[log]
+        per_cell = np.zeros(n_cells, dtype=np.int64)
+        per_cell[cells(log_codes // MONTH_SPAN, log_codes % MONTH_SPAN)] = totals
+        offsets = np.concatenate([[0], np.cumsum(per_cell)])
+        n_events = int(offsets[-1])
+        meta['events'][log] = n_events
+        np.save(os.path.join(store_dir, f'{log}_offsets.npy'), offsets)
+
+        columns = {'date': np.lib.format.open_memmap(os.path.join(store_dir, f'{log}_date.npy'), mode='w+',
+                                                     dtype='datetime64[D]', shape=(n_events,))}
+        for column, dtype in values.items():
+            columns[column] = np.lib.format.open_memmap(os.path.join(store_dir, f'{log}_{column}.npy'), mode='w+',
+                                                        dtype=dtype, shape=(n_events,))
+
+        #Second pass: every event goes to the next free position of its cell
+        cursor = offsets[:-1].copy()
+        for chunk in chunks():
+            dated, months = dated_months(chunk, log)
+            chunk = chunk[dated]
+            cell = cells(chunk['user_id'].to_numpy(dtype=np.int64), months)
+            order = np.argsort(cell, kind='stable')
+            sorted_cell = cell[order]
+            group_start = np.flatnonzero(np.r_[True, sorted_cell[1:] != sorted_cell[:-1]])
+            group_size = np.diff(np.r_[group_start, len(cell)])
+            rank = np.arange(len(cell)) - np.repeat(group_start, group_size)
+            positions = np.empty(len(cell), dtype=np.int64)
+            positions[order] = cursor[sorted_cell] + rank
+            cursor[sorted_cell[group_start]] += group_size
+            columns['date'][positions] = day_of(chunk[date_column])
+            for column in values:
+                columns[column][positions] = chunk[column].to_numpy()
+
+        sort_cells_by_date(columns, offsets, chunksize)
+        for column in columns.values():
+            column.flush()
+        del columns
+
+    #Written last: a store without meta.json is incomplete
+    with open(os.path.join(store_dir, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+    return EventStore(store_dir)
+
+
+def cell_blocks(offsets, events_per_block):
+    """Ranges of whole cells holding about events_per_block events each."""
+    n_cells = len(offsets) - 1
+    first = 0
+    while first < n_cells:
+        last = int(np.searchsorted(offsets, offsets[first] + events_per_block, side='right')) - 1
+        last = min(max(last, first + 1), n_cells)
+        yield first, last
+        first = last
+
+
+def sort_cells_by_date(columns, offsets, chunksize):
+    """Sort the events of every cell by date (stable, so same-day events keep their log order)."""
+    for first, last in cell_blocks(offsets, chunksize):
+        start, stop = offsets[first], offsets[last]
+        if stop - start < 2:
+            continue
+        cell = np.repeat(np.arange(last - first), np.diff(offsets[first:last + 1]))
+        order = np.lexsort((columns['date'][start:stop], cell))
+        for column in columns.values():
+            column[start:stop] = column[start:stop][order]
+
+
+class EventStore:
+    """Read-only view of an event store; the columns are memory maps."""
+
+    def __init__(self, store_dir=STORE_DIR):
+        with open(os.path.join(store_dir, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self.first_user, self.n_users = self.meta['first_user'], self.meta['n_users']
+        self.first_month, self.n_months = self.meta['first_month'], self.meta['n_months']
+        self.offsets = {}
+        self.columns = {}
+        for log, (date_column, values) in LOGS.items():
+            if log not in self.meta['events']:
+                continue
+            self.offsets[log] = np.load(os.path.join(store_dir, f'{log}_offsets.npy'), mmap_mode='r')
+            self.columns[log] = {column: np.load(os.path.join(store_dir, f'{log}_{column}.npy'), mmap_mode='r')
+                                 for column in ['date'] + list(values)}
+
+    def cell_range(self, log, user_id, month=None, year=DATA_YEAR):
+        """Positions of a user's events (or of one month of them, month 1-12 of year) in the columns."""
+        user = user_id - self.first_user
+        if not 0 <= user < self.n_users:
+            return 0, 0
+        first = user * self.n_months
+        last = first + self.n_months
+        if month is not None:
+            offset = (year - 1970) * 12 + month - 1 - self.first_month
+            if not 0 <= offset < self.n_months:
+                return 0, 0
+            first, last = first + offset, first + offset + 1
+        offsets = self.offsets[log]
+        return int(offsets[first]), int(offsets[last])
+
+    def events(self, log, user_id, month=None, year=DATA_YEAR):
+        """A user's events of one log as zero-copy slices of the mapped columns, sorted by date."""
+        start, stop = self.cell_range(log, user_id, month, year)
+        return {column: values[start:stop] for column, values in self.columns[log].items()}
+
+    def history(self, user_id, month=None, year=DATA_YEAR):
+        """A user's calls, messages and sessions as small DataFrames (copies of the slices)."""
+        return {log: pd.DataFrame(self.events(log, user_id, month, year)) for log in self.columns}
+
+    def usage(self, chunksize=CHUNK_SIZE, users=None, periods=None):
+        """
+        df_usage (same layout as aggregate_usage) from the mapped columns: event counts come from the
+        offsets, sums from segmented sums over blocks of whole cells. With periods='calendar' it also
+        gets the service days of every month from users, as aggregate_usage(..., users) does.
+        """
+        check_periods(periods)
+        n_cells = self.n_users * self.n_months
+        totals = {}
+        for log, values in [('calls', 'duration'), ('messages', None), ('internet', 'mb_used')]:
+            offsets = np.asarray(self.offsets.get(log, np.zeros(n_cells + 1, dtype=np.int64)))
+            totals[log] = np.diff(offsets)
+            if values is not None:
+                totals[values] = segment_sums(self.columns[log][values], offsets, chunksize) if log in self.columns \
+                    else np.zeros(n_cells)
+        present = np.flatnonzero((totals['calls'] > 0) | (totals['messages'] > 0) | (totals['internet'] > 0))
+        df_usage = usage_frame(present // self.n_months + self.first_user, present % self.n_months + self.first_month,
+                               totals['calls'][present], totals['duration'][present].astype(np.int64),
+                               totals['messages'][present], totals['mb_used'][present])
+        if periods is not None:
+            df_usage['service_days'], df_usage['period_days'] = service_days(
+                df_usage['user_id'].to_numpy(), df_usage['period'].to_numpy(), users, periods)
+        return df_usage
+
+    def bill(self, user_id, month, users, plans, year=DATA_YEAR, periods=None):
+        """
+        Usage and bill of one user-month, read from the store (prorated to the days in service with
+        periods='calendar').
+        """
+        check_periods(periods)
+        counts = {}
+        for log in LOGS:
+            start, stop = self.cell_range(log, user_id, month, year)
+            counts[log] = stop - start
+        calls, internet = self.events('calls', user_id, month, year), self.events('internet', user_id, month, year)
+        df_usage = usage_frame([user_id], [(year - 1970) * 12 + month - 1], [counts['calls']],
+                               [int(calls['duration'].sum())], [counts['messages']], [float(internet['mb_used'].sum())])
+        if periods is not None:
+            df_usage['service_days'], df_usage['period_days'] = service_days(
+                df_usage['user_id'].to_numpy(), df_usage['period'].to_numpy(), users, periods)
+        df_merged = merge_plans(df_usage, users, plans)
+        return pd.concat([df_merged, bill_components(df_merged)], axis=1)
+
+
+def segment_sums(values, offsets, chunksize=CHUNK_SIZE):
+    """Sum of values over every cell (offsets[i]:offsets[i + 1]), read a block of cells at a time."""
+    sums = np.zeros(len(offsets) - 1)
+    for first, last in cell_blocks(offsets, chunksize):
+        cell_starts = offsets[first:last]
+        nonempty = np.flatnonzero(np.diff(offsets[first:last + 1]) > 0)
+        if len(nonempty) == 0:
+            continue
+        block = np.asarray(values[offsets[first]:offsets[last]], dtype=float)
+        #Empty cells have no events, so every non-empty cell runs up to the next non-empty one
+        sums[first + nonempty] = np.add.reduceat(block, cell_starts[nonempty] - offsets[first])
+    return sums
+
+
+def build_store_from_tables(calls, messages, internet, store_dir=STORE_DIR, chunksize=CHUNK_SIZE):
+    """Event store from the cleaned tables in memory."""
+    sources = {'calls': frame_chunks(calls, chunksize), 'messages': frame_chunks(messages, chunksize),
+               'internet': frame_chunks(internet, chunksize)}
+    return build_store(sources, store_dir, chunksize)
+
+
+def build_store_from_csv(data_dir=DATA_DIR, store_dir=STORE_DIR, chunksize=CHUNK_SIZE):
+    """Event store straight from the raw CSV logs, which are only ever read chunksize rows at a time."""
+    sources = {log: csv_chunks(os.path.join(data_dir, TABLE_FILES[log]), log, chunksize) for log in LOGS}
+    return build_store(sources, store_dir, chunksize)
+
+
+if __name__ == '__main__':
+    import time
+
+    data_dir = sys.argv[1] if len(sys.argv) > 1 else DATA_DIR
+    store_dir = sys.argv[2] if len(sys.argv) > 2 else STORE_DIR
+    start = time.perf_counter()
+    store = build_store_from_csv(data_dir, store_dir)
+    print(f"{sum(store.meta['events'].values())} events written to {store_dir} in {time.perf_counter() - start:.2f} s")
@@ -0,0 +1,212 @@
+"""
+Synthetic Megaline data for benchmarks.
+
+Generates the five Megaline tables for any number of users, either as DataFrames in the cleaned
+form (synthetic_tables) or as CSV files with the same columns and formats as the
+/datasets/megaline_*.csv files (write_synthetic_csv), which the regular loaders read unchanged.
+
+The distributions follow the 500-user sample:
+- registrations through 2018, growing over the year, and about 10% of users churning later on
+- per-user activity is log-normal, so a minority of heavy users makes most of the calls,
+  messages and sessions, spread over the days each user is active
+- about 20% of calls last 0.0 minutes and about 13% of sessions use 0 MB; other call durations and
+  session sizes are gamma distributed like in the sample
+
+Users are generated in blocks of USER_BLOCK users, each with its own child seed, so the output
+depends only on n_users and the seed and large files are written without holding every event
+in memory.
+"""
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+from megaline_io import CLEANERS, TABLE_FILES
+
+try:
+    import pyarrow
+    from pyarrow import csv as pyarrow_csv
+except ImportError:
+    pyarrow = None
+
+# Raw plans table, as in megaline_plans.csv
+PLANS = pd.DataFrame({
+    'messages_included': [50, 1000],
+    'mb_per_month_included': [15360, 30720],
+    'minutes_included': [500, 3000],
+    'usd_monthly_pay': [20, 70],
+    'usd_per_gb': [10, 7],
+    'usd_per_message': [0.03, 0.01],
+    'usd_per_minute': [0.03, 0.01],
+    'plan_name': ['surf', 'ultimate'],
+})
+PLAN_SHARES = [0.7, 0.3]
+
+# Metro areas, most populous first; users are spread over them with Zipf-like weights
+CITIES = ['New York-Newark-Jersey City, NY-NJ-PA MSA', 'Los Angeles-Long Beach-Anaheim, CA MSA',
+          'Chicago-Naperville-Elgin, IL-IN-WI MSA', 'Dallas-Fort Worth-Arlington, TX MSA',
+          'Houston-The Woodlands-Sugar Land, TX MSA', 'Washington-Arlington-Alexandria, DC-VA-MD-WV MSA',
+          'Miami-Fort Lauderdale-West Palm Beach, FL MSA', 'Philadelphia-Camden-Wilmington, PA-NJ-DE-MD MSA',
+          'Atlanta-Sandy Springs-Roswell, GA MSA', 'Boston-Cambridge-Newton, MA-NH MSA',
+          'Phoenix-Mesa-Chandler, AZ MSA', 'San Francisco-Oakland-Berkeley, CA MSA',
+          'Seattle-Tacoma-Bellevue, WA MSA', 'Minneapolis-St. Paul-Bloomington, MN-WI MSA',
+          'Denver-Aurora-Lakewood, CO MSA', 'Albuquerque, NM MSA']
+CITY_WEIGHTS = 1 / np.arange(1, len(CITIES) + 1)
+
+FIRST_USER_ID = 1000
+YEAR_START = np.datetime64('2018-01-01')
+YEAR_DAYS = 365
+
+# Registrations per day grow linearly to (1 + REGISTRATION_GROWTH) times the January rate
+REGISTRATION_GROWTH = 1.0
+CHURN_SHARE = 0.1
+
+# Sigma of the log-normal per-user activity (mean 1)
+ACTIVITY_SIGMA = 0.6
+ZERO_CALL_SHARE = 0.2
+ZERO_SESSION_SHARE = 0.13
+
+USER_BLOCK = 50_000
+
+# Column order of every table in the CSV files ('Unnamed: 0' is the saved index of the internet file)
+CSV_COLUMNS = {
+    'calls': ['id', 'user_id', 'call_date', 'duration'],
+    'internet': ['Unnamed: 0', 'id', 'user_id', 'session_date', 'mb_used'],
+    'messages': ['id', 'user_id', 'message_date'],
+    'plans': list(PLANS.columns),
+    'users': ['user_id', 'first_name', 'last_name', 'age', 'city', 'reg_date', 'plan', 'churn_date'],
+}
+DATE_COLUMNS = ['call_date', 'session_date', 'message_date', 'reg_date', 'churn_date']
+
+
+def registration_days(u):
+    """Registration day (0-364) for uniform numbers u, with a density rising linearly over the year."""
+    g = REGISTRATION_GROWTH
+    t = u if g == 0 else (np.sqrt(1 + 2 * g * (1 + g / 2) * u) - 1) / g
+    return np.minimum((t * YEAR_DAYS).astype(int), YEAR_DAYS - 1)
+
+
+def user_block(first_user, n_users, rng, calls_per_user, messages_per_user, sessions_per_user):
+    """Raw users, calls, messages and internet rows of one block of users (ids are filled in later)."""
+    user_ids = np.arange(first_user, first_user + n_users)
+    reg_day = registration_days(rng.random(n_users))
+    churned = rng.random(n_users) < CHURN_SHARE
+    churn_day = reg_day + (rng.random(n_users) * (YEAR_DAYS - reg_day)).astype(int)
+    end_day = np.where(churned, churn_day, YEAR_DAYS - 1)
+    users = pd.DataFrame({
+        'user_id': user_ids,
+        'first_name': 'A',
+        'last_name': 'B',
+        'age': rng.integers(18, 76, n_users),
+        'city': np.asarray(CITIES, dtype=object)[rng.choice(len(CITIES), n_users, p=CITY_WEIGHTS / CITY_WEIGHTS.sum())],
+        'reg_date': (YEAR_START + reg_day.astype('timedelta64[D]')).astype('datetime64[ns]'),
+        'plan': PLANS['plan_name'].to_numpy()[rng.choice(len(PLANS), n_users, p=PLAN_SHARES)],
+        'churn_date': np.where(churned, YEAR_START + churn_day.astype('timedelta64[D]'),
+                               np.datetime64('NaT', 'D')).astype('datetime64[ns]'),
+    })
+
+    activity = rng.lognormal(-ACTIVITY_SIGMA ** 2 / 2, ACTIVITY_SIGMA, n_users)
+
+    def events(per_user):
+        #Event counts follow the user's activity; each event falls on a day the user is active
+        counts = rng.poisson(per_user * activity)
+        #Shuffled like the Megaline logs, which are not sorted by user
+        owner = rng.permutation(np.repeat(np.arange(n_users), counts))
+        first = reg_day[owner]
+        day = first + (rng.random(len(owner)) * (end_day[owner] - first + 1)).astype(int)
+        return user_ids[owner], (YEAR_START + day.astype('timedelta64[D]')).astype('datetime64[ns]')
+
+    call_users, call_dates = events(calls_per_user)
+    n_calls = len(call_users)
+    duration = np.where(rng.random(n_calls) < ZERO_CALL_SHARE, 0, np.round(rng.gamma(2, 3.5, n_calls), 2))
+    calls = pd.DataFrame({'user_id': call_users, 'call_date': call_dates, 'duration': duration})
+
+    message_users, message_dates = events(messages_per_user)
+    messages = pd.DataFrame({'user_id': message_users, 'message_date': message_dates})
+
+    session_users, session_dates = events(sessions_per_user)
+    n_sessions = len(session_users)
+    mb_used = np.where(rng.random(n_sessions) < ZERO_SESSION_SHARE, 0, np.round(rng.gamma(1.5, 250, n_sessions), 2))
+    internet = pd.DataFrame({'user_id': session_users, 'session_date': session_dates, 'mb_used': mb_used})
+    return users, calls, messages, internet
+
+
+def add_ids(df, first_row):
+    """Event ids like '1398_0': the user id and the row number in the whole file."""
+    rows = np.arange(first_row, first_row + len(df))
+    df.insert(0, 'id', df['user_id'].astype(str) + '_' + pd.Series(rows, index=df.index).astype(str))
+    return df
+
+
+def raw_blocks(n_users, seed=0, calls_per_user=275, messages_per_user=150, sessions_per_user=210):
+    """Yield the raw users, calls, messages and internet tables of every block of users, in order."""
+    n_blocks = -(-n_users // USER_BLOCK)
+    rows = {'calls': 0, 'messages': 0, 'internet': 0}
+    for block, block_seed in enumerate(np.random.SeedSequence(seed).spawn(n_blocks)):
+        first = block * USER_BLOCK
+        users, calls, messages, internet = user_block(FIRST_USER_ID + first, min(USER_BLOCK, n_users - first),
+                                                      np.random.default_rng(block_seed), calls_per_user,
+                                                      messages_per_user, sessions_per_user)
+        tables = {'calls': calls, 'messages': messages, 'internet': internet}
+        for name, df in tables.items():
+            add_ids(df, rows[name])
+            rows[name] += len(df)
+        internet.insert(0, 'Unnamed: 0', np.arange(rows['internet'] - len(internet), rows['internet']))
+        yield users, calls, messages, internet
+
+
+def synthetic_tables(n_users, seed=0, **rates):
+    """Return cleaned calls, internet, messages, plans and users for n_users synthetic subscribers."""
+    blocks = list(zip(*raw_blocks(n_users, seed, **rates)))
+    users, calls, messages, internet = (pd.concat(tables, ignore_index=True) for tables in blocks)
+    tables = {'calls': calls, 'internet': internet.drop(columns='Unnamed: 0'), 'messages': messages,
+              'plans': PLANS.copy(), 'users': users[['user_id', 'city', 'reg_date', 'plan', 'churn_date']]}
+    return tuple(CLEANERS[name](tables[name]) for name in TABLE_FILES)
+
+
+def csv_frame(df):
+    """Dates as 2018-12-27 strings (empty when missing), like the Megaline files."""
+    df = df.copy()
+    for column in DATE_COLUMNS:
+        if column in df.columns:
+            df[column] = pd.Series(np.datetime_as_string(df[column].to_numpy().astype('datetime64[D]')),
+                                   index=df.index).replace('NaT', '')
+    return df
+
+
+def append_csv(df, path, header):
+    if pyarrow is not None:
+        options = pyarrow_csv.WriteOptions(include_header=header, quoting_style='needed')
+        with open(path, 'ab') as f:
+            pyarrow_csv.write_csv(pyarrow.Table.from_pandas(df, preserve_index=False), f, options)
+    else:
+        df.to_csv(path, mode='a', header=header, index=False)
+
+
+def write_synthetic_csv(data_dir, n_users, seed=0, **rates):
+    """
+    Write megaline_calls/internet/messages/plans/users.csv for n_users synthetic subscribers.
+
+    Returns the number of rows written per table.
+    """
+    os.makedirs(data_dir, exist_ok=True)
+    paths = {name: os.path.join(data_dir, file) for name, file in TABLE_FILES.items()}
+    for path in paths.values():
+        if os.path.exists(path):
+            os.remove(path)
+    append_csv(PLANS, paths['plans'], header=True)
+    rows = {name: 0 for name in TABLE_FILES}
+    rows['plans'] = len(PLANS)
+    for block, tables in enumerate(raw_blocks(n_users, seed, **rates)):
+        for name, df in zip(['users', 'calls', 'messages', 'internet'], tables):
+            append_csv(csv_frame(df[CSV_COLUMNS[name]]), paths[name], header=block == 0)
+            rows[name] += len(df)
+    return rows
+
+
+if __name__ == '__main__':
+    #python megaline_synth.py DATA_DIR N_USERS [SEED]
+    data_dir, n_users = sys.argv[1], int(float(sys.argv[2]))
+    seed = int(sys.argv[3]) if len(sys.argv) > 3 else 0
+    print(write_synthetic_csv(data_dir, n_users, seed))
@@ -0,0 +1,362 @@
+"""
+Real-time month-to-date overage tracking for Megaline.
+
+The over-limit rate in megaline_analysis.py only shows after the month has been billed. The
+OverageTracker consumes the live stream of calls, messages and internet sessions instead. It keeps
+month-to-date minutes, messages and MB for every user and emits an alert whenever an event takes
+one of them past a configured fraction of the allowance in the user's plan (by default 80%, 90%
+and 100%), so customers can be warned before they are billed overage.
+
+State is a few flat arrays indexed by a user's slot, which a direct-address table maps from the
+user_id: the current month, three counters and the plan allowances. Events are handled in
+micro-batches (whatever the stream has produced since the last read). Each event is sorted to its
+(user, usage, month) group. Its month-to-date value is the stored counter plus a segmented cumulative
+sum, and it is compared with the thresholds, so each event costs O(1) and no Python code runs per
+event. The counters are integers (whole minutes and messages, MB in hundredths, the precision of the
+raw sessions), so the running sums are exact however long the batch. An event of a later month than
+the user's current one starts the new month at zero. An event of an earlier month than the user's
+latest event so far (stored or earlier in the same batch) is counted as late and skipped, because
+that month is closed.
+
+Months are calendar months by default, whole ones with the full allowance. Like the pipeline's
+periods parameter, periods='calendar' or 'cycle' (megaline_periods.PERIOD_SCHEMES) tracks the
+billing periods of that scheme instead and prorates the allowances of every user's first and last
+period to the days in service, as the bills do, so the alerts fire at the usage that is billed as
+overage.
+
+The stream is a text file with one event per line, which a producer appends to and the tracker
+tails:
+
+    call,1000,2018-12-27,8.52       duration in minutes (rounded UP per call, like the bills)
+    message,1000,2018-12-27,
+    session,1000,2018-12-27,89.86   MB used
+
+Any other transport (a queue, a socket) can hand DataFrames with the same columns to
+OverageTracker.process. The counters and the byte offset in the stream are snapshotted atomically,
+so a restarted tracker resumes from the line after the last snapshotted batch. Alerts of batches
+processed after the last snapshot are emitted again after a crash (at-least-once).
+
+Usage:
+    python megaline_tracker.py STREAM_FILE [TRACKER_DIR [PERIODS]]   (follow a stream; alerts go to alerts.jsonl)
+    python megaline_tracker.py                             (throughput benchmark on synthetic events)
+"""
+import io
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from megaline_io import read_table, to_dates
+from megaline_periods import (CALENDAR_ANCHOR, NAT, PERIOD_SCHEMES, date_periods, prorate_allowance, service_days,
+                              user_anchors)
+
+TRACKER_DIR = '.megaline_tracker'
+
+# Fractions of the allowance at which an alert is emitted
+THRESHOLDS = (0.8, 0.9, 1.0)
+
+# Tracked usage and the plan column holding its allowance
+USAGES = {'minutes': 'minutes_included', 'messages': 'messages_included', 'mb_used': 'mb_per_month_included'}
+
+# Event kind of a stream line -> tracked usage
+EVENT_KINDS = {'call': 0, 'message': 1, 'session': 2}
+
+# Counter units per usage: whole minutes, messages, and hundredths of a MB
+USAGE_SCALE = np.array([1, 1, 100])
+
+STREAM_COLUMNS = ['kind', 'user_id', 'date', 'amount']
+
+ALERT_COLUMNS = ['user_id', 'plan', 'month', 'period', 'date', 'usage', 'fraction', 'used', 'included']
+
+# Bytes read from the stream per micro-batch (about 40,000 events)
+BATCH_BYTES = 1 << 20
+
+POLL_SECONDS = 0.5
+SNAPSHOT_SECONDS = 10.0
+
+# Layout of the snapshot; bump when it changes (snapshots of another version are refused)
+SNAPSHOT_VERSION = 4
+
+
+def parse_events(data):
+    """Events of complete stream lines (bytes) as a DataFrame with the STREAM_COLUMNS."""
+    if not data:
+        return pd.DataFrame({'kind': pd.Series(dtype=str), 'user_id': pd.Series(dtype=np.int64),
+                             'date': pd.Series(dtype='datetime64[ns]'), 'amount': pd.Series(dtype=float)})
+    events = pd.read_csv(io.BytesIO(data), header=None, names=STREAM_COLUMNS,
+                         dtype={'kind': str, 'user_id': np.int64, 'date': str, 'amount': float})
+    events['date'] = to_dates(events['date'])
+    return events
+
+
+def follow(path, offset=0, batch_bytes=BATCH_BYTES, poll_seconds=POLL_SECONDS, stop_at_end=False):
+    """
+    Tail the stream file from byte offset: yields (events, offset after them) for every batch of
+    complete lines. Waits for new lines at the end of the file unless stop_at_end.
+    """
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        while True:
+            data = f.read(batch_bytes)
+            #Keep a partly written last line for the next read
+            end = data.rfind(b'\n') + 1
+            if end < len(data):
+                f.seek(offset + end)
+            if end:
+                offset += end
+                yield parse_events(data[:end]), offset
+            elif stop_at_end:
+                return
+            else:
+                time.sleep(poll_seconds)
+
+
+def write_event_stream(calls, messages, internet, path):
+    """Write cleaned logs as one date-ordered event stream file (the producer side, for tests and benchmarks)."""
+    events = pd.concat([
+        pd.DataFrame({'kind': 'call', 'user_id': calls['user_id'], 'date': calls['call_date'],
+                      'amount': calls['duration']}),
+        pd.DataFrame({'kind': 'message', 'user_id': messages['user_id'], 'date': messages['message_date'],
+                      'amount': np.nan}),
+        pd.DataFrame({'kind': 'session', 'user_id': internet['user_id'], 'date': internet['session_date'],
+                      'amount': internet['mb_used']}),
+    ], ignore_index=True)
+    events = events.sort_values('date', kind='stable')
+    events.to_csv(path, header=False, index=False, date_format='%Y-%m-%d')
+    return len(events)
+
+
+class OverageTracker:
+    """
+    Month-to-date usage of every user, checked against their plan allowances as events arrive.
+
+    users and plans are the cleaned tables; users of unknown plans are tracked without alerts.
+    periods None tracks whole calendar months; 'calendar' or 'cycle' tracks the billing periods of
+    that scheme with the allowances of the first and last period of every user prorated.
+    """
+
+    def __init__(self, users, plans, thresholds=THRESHOLDS, periods=None):
+        if periods is not None and periods not in PERIOD_SCHEMES:
+            raise ValueError(f'unknown period scheme {periods!r}, expected None or one of {PERIOD_SCHEMES}')
+        self.periods = periods
+        #Registration and churn dates for the days in service, anchor days for cycle periods
+        self.users = None if periods is None else users[['user_id', 'reg_date', 'churn_date']]
+        self.anchors = user_anchors(users, periods) if periods == 'cycle' else None
+        self.user_ids = users['user_id'].to_numpy(dtype=np.int64)
+        self.plan = users['plan'].to_numpy()
+        self.thresholds = tuple(sorted(thresholds))
+        included = users[['plan']].merge(plans, on='plan', how='left')[list(USAGES.values())]
+        self.included = included.to_numpy(dtype=float, na_value=np.inf)
+
+        #Direct-address table: user_id - first_id -> slot (-1 for ids that are not users)
+        self.first_id = int(self.user_ids.min()) if len(self.user_ids) else 0
+        span = int(self.user_ids.max()) - self.first_id + 1 if len(self.user_ids) else 0
+        self.slots = np.full(span, -1, dtype=np.int64)
+        self.slots[self.user_ids - self.first_id] = np.arange(len(self.user_ids))
+
+        #Current month (billing period key, months since 1970-01; NAT before the first event) and its
+        #month-to-date usage
+        self.month = np.full(len(self.user_ids), NAT, dtype=np.int64)
+        self.used = np.zeros((len(self.user_ids), len(USAGES)), dtype=np.int64)
+        self.offset = 0
+        self.counts = {'events': 0, 'late': 0, 'unknown': 0, 'alerts': 0}
+
+    def slot_of(self, user_ids):
+        """Slot of every user_id (-1 for unknown users)."""
+        position = np.asarray(user_ids, dtype=np.int64) - self.first_id
+        known = (position >= 0) & (position < len(self.slots))
+        slot = np.full(len(position), -1, dtype=np.int64)
+        slot[known] = self.slots[position[known]]
+        return slot
+
+    def process(self, events):
+        """
+        Add a batch of events (STREAM_COLUMNS, in arrival order) to the counters.
+
+        Returns the threshold crossings of the batch, one row per (event, threshold), in event order.
+        """
+        codes, kinds = pd.factorize(events['kind'])
+        #Code -1 (missing kind) picks up the trailing -1
+        usage = np.append([EVENT_KINDS.get(kind, -1) for kind in kinds], -1).astype(np.int64)[codes]
+        slot = self.slot_of(events['user_id'].to_numpy())
+        anchors = None if self.anchors is None else np.where(slot >= 0, self.anchors[slot], CALENDAR_ANCHOR)
+        month = date_periods(events['date'], anchors)
+        amount = events['amount'].to_numpy(dtype=float)
+        amount = np.where(usage == 0, np.ceil(amount), np.where(usage == 1, 1.0, np.rint(amount * 100)))
+
+        valid = (slot >= 0) & (usage >= 0) & (month != NAT) & ~np.isnan(amount)
+        amount = np.where(valid, amount, 0).astype(np.int64)
+        #Latest month of every user up to each event (its stored month or an earlier event of the
+        #batch): a running maximum per user, taken over the events sorted by user in arrival order
+        latest = self.month[np.maximum(slot, 0)].copy()
+        by_user = np.flatnonzero(valid)
+        by_user = by_user[np.argsort(slot[by_user], kind='stable')]
+        low = int(month[by_user].min()) if len(by_user) else 0
+        span = int(month[by_user].max()) - low + 1 if len(by_user) else 1
+        offsets = slot[by_user] * span - low
+        latest[by_user] = np.maximum(latest[by_user], np.maximum.accumulate(offsets + month[by_user]) - offsets)
+        late = valid & (month < latest)
+        keep = by_user[~late[by_user]]
+        self.counts['events'] += len(events)
+        self.counts['late'] += int(late.sum())
+        self.counts['unknown'] += int((~valid).sum())
+        if len(keep) == 0:
+            return pd.DataFrame(columns=ALERT_COLUMNS)
+
+        #Group the events by (slot, usage, month), keeping arrival order inside each group: without
+        #the late events a user's months only grow in arrival order, so sorting by (slot, usage) will do
+        order = keep[np.argsort(slot[keep] * len(USAGES) + usage[keep], kind='stable')]
+        slot, usage, month, amount = slot[order], usage[order], month[order], amount[order]
+        first = np.concatenate([[True], (slot[1:] != slot[:-1]) | (usage[1:] != usage[:-1])
+                                | (month[1:] != month[:-1])])
+        starts = np.flatnonzero(first)
+        group = np.cumsum(first) - 1
+
+        #Month-to-date value before and after every event: stored counter (same month) + running sum,
+        #all in integer counter units
+        before = np.cumsum(amount) - amount
+        before -= before[starts][group]
+        stored = np.where(month == self.month[slot], self.used[slot, usage], 0)
+        previous = stored + before
+        current = previous + amount
+
+        alerts = []
+        included = self.included[slot, usage]
+        if self.users is not None:
+            #Allowance for the days in service of a user's first and last period, as billed
+            served, length = service_days(self.user_ids[slot], month, self.users, self.periods)
+            finite = np.isfinite(included)
+            included[finite] = prorate_allowance(included[finite], served[finite], length[finite])
+        scale = USAGE_SCALE[usage]
+        for fraction in self.thresholds:
+            threshold = included * scale * fraction
+            crossed = np.flatnonzero((previous < threshold) & (current >= threshold))
+            alerts.append(pd.DataFrame({'event': order[crossed], 'slot': slot[crossed], 'month': month[crossed],
+                                        'usage': usage[crossed], 'fraction': fraction,
+                                        'used': current[crossed] / scale[crossed],
+                                        'included': included[crossed]}))
+
+        #Move users to their latest month (starting it at zero) and store the totals of that month
+        touched = slot[starts]
+        before_month = self.month[touched]
+        np.maximum.at(self.month, touched, month[starts])
+        self.used[touched[self.month[touched] > before_month]] = 0
+        last = np.append(starts[1:], len(order)) - 1
+        latest = month[last] == self.month[slot[last]]
+        self.used[slot[last[latest]], usage[last[latest]]] = current[last[latest]]
+
+        alerts = pd.concat(alerts, ignore_index=True).sort_values(['event', 'fraction'], ignore_index=True)
+        self.counts['alerts'] += len(alerts)
+        return pd.DataFrame({
+            'user_id': self.user_ids[alerts['slot']],
+            'plan': self.plan[alerts['slot']],
+            'month': alerts['month'].to_numpy() % 12 + 1,
+            'period': alerts['month'].to_numpy(),
+            'date': events['date'].to_numpy()[alerts['event']],
+            'usage': np.array(list(USAGES))[alerts['usage']],
+            'fraction': alerts['fraction'].to_numpy(),
+            'used': alerts['used'].to_numpy(),
+            'included': alerts['included'].to_numpy(),
+        })
+
+    def state(self):
+        """
+        Month-to-date usage of every user who has had an event (month is the calendar month, period
+        the months since 1970-01 that tell the years apart).
+        """
+        active = self.month != NAT
+        df = pd.DataFrame(self.used[active] / USAGE_SCALE, columns=list(USAGES))
+        df.insert(0, 'user_id', self.user_ids[active])
+        df.insert(1, 'plan', self.plan[active])
+        df.insert(2, 'month', self.month[active] % 12 + 1)
+        df.insert(3, 'period', self.month[active])
+        return df
+
+    def snapshot(self, path):
+        """Write the counters and the stream offset atomically."""
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path + '.tmp', 'wb') as f:
+            np.savez(f, version=SNAPSHOT_VERSION, periods=str(self.periods), user_ids=self.user_ids,
+                     month=self.month, used=self.used, offset=self.offset,
+                     thresholds=np.array(self.thresholds), counts=json.dumps(self.counts))
+        os.replace(path + '.tmp', path)
+
+    def restore(self, path):
+        """Load a snapshot (users added since then start with no usage); returns the stream offset."""
+        with np.load(path) as saved:
+            version = int(saved['version']) if 'version' in saved.files else None
+            if version != SNAPSHOT_VERSION:
+                raise ValueError(f'{path} is a tracker snapshot of version {version}, expected {SNAPSHOT_VERSION}; '
+                                 'remove it to start tracking from the beginning of the stream')
+            if str(saved['periods']) != str(self.periods):
+                raise ValueError(f"{path} tracks the periods {saved['periods']}, not {self.periods}")
+            slot = self.slot_of(saved['user_ids'])
+            known = slot >= 0
+            self.month[slot[known]] = saved['month'][known]
+            self.used[slot[known]] = saved['used'][known]
+            self.offset = int(saved['offset'])
+            self.counts = json.loads(str(saved['counts']))
+        return self.offset
+
+
+def track(stream_path, users, plans, tracker_dir=TRACKER_DIR, thresholds=THRESHOLDS, stop_at_end=False,
+          snapshot_seconds=SNAPSHOT_SECONDS, periods=None):
+    """
+    Follow a stream file, appending alerts to tracker_dir/alerts.jsonl and snapshotting the
+    tracker to tracker_dir/snapshot.npz. Resumes from an existing snapshot.
+    """
+    tracker = OverageTracker(users, plans, thresholds, periods)
+    snapshot_path = os.path.join(tracker_dir, 'snapshot.npz')
+    if os.path.exists(snapshot_path):
+        tracker.restore(snapshot_path)
+    os.makedirs(tracker_dir, exist_ok=True)
+    last_snapshot = time.monotonic()
+    with open(os.path.join(tracker_dir, 'alerts.jsonl'), 'a') as out:
+        try:
+            for events, offset in follow(stream_path, tracker.offset, stop_at_end=stop_at_end):
+                alerts = tracker.process(events)
+                tracker.offset = offset
+                if len(alerts):
+                    out.write(alerts.to_json(orient='records', lines=True, date_format='iso'))
+                    out.flush()
+                if time.monotonic() - last_snapshot >= snapshot_seconds:
+                    tracker.snapshot(snapshot_path)
+                    last_snapshot = time.monotonic()
+        finally:
+            tracker.snapshot(snapshot_path)
+    return tracker
+
+
+def benchmark_tracker(n_users=20_000, seed=0, batch_bytes=BATCH_BYTES):
+    """Events per second of parsing and tracking a synthetic stream read from disk."""
+    import tempfile
+
+    from megaline_synth import synthetic_tables
+
+    calls, internet, messages, plans, users = synthetic_tables(n_users, seed=seed)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'events.csv')
+        n_events = write_event_stream(calls, messages, internet, path)
+        tracker = OverageTracker(users, plans)
+        start = time.perf_counter()
+        n_alerts = 0
+        for events, offset in follow(path, batch_bytes=batch_bytes, stop_at_end=True):
+            n_alerts += len(tracker.process(events))
+        seconds = time.perf_counter() - start
+    return pd.Series({'users': n_users, 'events': n_events, 'alerts': n_alerts, 'seconds': seconds,
+                      'events_per_second': n_events / seconds})
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        tracker_dir = sys.argv[2] if len(sys.argv) > 2 else TRACKER_DIR
+        periods = sys.argv[3] if len(sys.argv) > 3 else None
+        try:
+            track(sys.argv[1], read_table('users'), read_table('plans'), tracker_dir, periods=periods)
+        except KeyboardInterrupt:
+            pass
+    else:
+        print(benchmark_tracker().round(3))
@@ -0,0 +1,298 @@
+"""
+Monthly usage aggregation for Megaline.
+
+Builds df_usage (calls, minutes, messages and internet traffic per user per billing period) in a
+single pass over each log. Every event gets the integer key of its billing period (megaline_periods:
+months since 1970-01, so the same month of two years stays apart; calendar months by default or
+cycles anchored on each user's registration day), every (user_id, period) pair is encoded as one
+integer key, the keys are factorized to the user-periods that actually occur and the usage columns
+are filled with np.bincount over those, so no groupby or merge is needed and memory follows the
+user-periods with usage, not users x the span of periods.
+df_usage keeps the month number (1-12) of every period next to its key.
+
+For log exports that do not fit in memory, aggregate_usage_chunked reads the CSV files in
+bounded-size chunks and folds each chunk straight into running per-(user, period) totals, so
+memory use depends on the number of user-months, not on the number of events. It takes the same
+users and scheme as aggregate_usage.
+
+Run this file directly to compare wall time and peak memory against the original
+groupby + outer-merge path.
+"""
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from megaline_periods import (CALENDAR_ANCHOR, NAT, PERIOD_SCHEMES, date_periods, period_month, service_days,
+                              user_anchors)
+
+# Megaline converts MB to GB with 1 GB = 1024 MB
+MB_PER_GB = 1024
+
+USAGE_COLUMNS = ['calls_count', 'minutes_sum', 'messages_count', 'mb_used_total']
+
+# Rows read from a log file at a time in streaming mode
+CHUNK_SIZE = 1_000_000
+
+# Streaming key: user_id * PERIOD_KEYS + period (periods from 1970-01 up to year 7431)
+PERIOD_KEYS = 1 << 16
+
+
+def period_of(df, date_column, anchors=None):
+    """Billing period of every event (uses the 'period' column if the table already has one)."""
+    if 'period' in df.columns:
+        return df['period'].to_numpy(dtype=np.int64)
+    return date_periods(df[date_column], anchors)
+
+
+def check_scheme(users, scheme):
+    if scheme not in PERIOD_SCHEMES:
+        raise ValueError(f'unknown period scheme {scheme!r}, expected one of {PERIOD_SCHEMES}')
+    if scheme == 'cycle' and users is None:
+        raise ValueError('the cycle scheme needs the users table for the anchor days')
+
+
+def anchor_lookup(users, scheme):
+    """
+    Function giving the anchor day of every user id under scheme (users missing from the users
+    table get the calendar anchor); None under the calendar scheme, which needs no anchors.
+    """
+    if scheme == 'calendar':
+        return None
+    index = pd.Index(users['user_id'])
+    anchors = user_anchors(users, scheme)
+
+    def lookup(user_ids):
+        positions = index.get_indexer(user_ids)
+        return np.where(positions >= 0, anchors[positions], CALENDAR_ANCHOR)
+    return lookup
+
+
+def add_service_days(df_usage, users, scheme):
+    """Days in service (service_days) and length (period_days) of every period of df_usage."""
+    df_usage['service_days'], df_usage['period_days'] = service_days(
+        df_usage['user_id'].to_numpy(), df_usage['period'].to_numpy(), users, scheme)
+    return df_usage
+
+
+def usage_frame(user_ids, periods, calls_count, minutes_sum, messages_count, mb_used_total):
+    """Put the usage columns together in the layout of the original df_usage, plus the period key."""
+    periods = np.asarray(periods, dtype=np.int64)
+    df_usage = pd.DataFrame({
+        'user_id': user_ids,
+        'month': period_month(periods),
+        'period': periods,
+        'calls_count': calls_count,
+        'minutes_sum': minutes_sum,
+        'messages_count': messages_count,
+        'mb_used_total': mb_used_total,
+    })
+    #Convert total MB to GB and round UP according to Megaline policy
+    df_usage['gb_used_billed'] = np.ceil(df_usage['mb_used_total'] / MB_PER_GB).astype(int)
+    return df_usage
+
+
+def aggregate_usage(calls, messages, internet, users=None, scheme='calendar'):
+    """
+    Calculate calls_count, minutes_sum, messages_count and mb_used_total per user and billing period.
+
+    Expects the cleaned tables (dates converted to datetime, call durations already rounded up).
+    Returns df_usage sorted by user_id and period, with one row for every user-period that has at
+    least one call, message or internet session. Events without a date are left out.
+
+    scheme is 'calendar' (periods are calendar months) or 'cycle' (periods start on each user's
+    registration day; needs users). With the users table, df_usage also gets the days of every
+    period the user was in service (service_days) and the length of the period (period_days), and
+    billing prorates the first and last periods of every user.
+    """
+    check_scheme(users, scheme)
+    user_ids = np.unique(np.concatenate([calls['user_id'].to_numpy(), messages['user_id'].to_numpy(),
+                                         internet['user_id'].to_numpy()]))
+    #Anchor day of every user in user_ids (calendar periods need none)
+    lookup = anchor_lookup(users, scheme)
+    anchors = None if lookup is None else lookup(user_ids)
+
+    def positions_periods(df, date_column):
+        """User positions and periods of the dated events, and which events those are (None: all)."""
+        positions = np.searchsorted(user_ids, df['user_id'].to_numpy())
+        periods = period_of(df, date_column, None if anchors is None else anchors[positions])
+        #Events without a date (period NAT) belong to no billing period
+        dated = periods != NAT
+        if dated.all():
+            return positions, periods, None
+        return positions[dated], periods[dated], dated
+
+    def dated_values(df, column, dated):
+        values = df[column].to_numpy(dtype=float)
+        return values if dated is None else values[dated]
+
+    call_positions, call_periods, dated_calls = positions_periods(calls, 'call_date')
+    message_positions, message_periods, _ = positions_periods(messages, 'message_date')
+    session_positions, session_periods, dated_sessions = positions_periods(internet, 'session_date')
+
+    #Key: position of the user in user_ids * number of periods + period offset
+    all_periods = np.concatenate([call_periods, message_periods, session_periods])
+    if len(all_periods) == 0:
+        return usage_frame([], [], [], [], [], [])
+    first_period = int(all_periods.min())
+    n_periods = int(all_periods.max()) - first_period + 1
+    keys = np.concatenate([call_positions, message_positions, session_positions]) * n_periods + (
+        all_periods - first_period)
+
+    #Cell of every event among the distinct keys (sorted, so df_usage comes out by user and period)
+    cells, present = pd.factorize(keys, sort=True)
+    n_cells = len(present)
+    call_cells, message_cells, session_cells = np.split(cells, np.cumsum([len(call_periods), len(message_periods)]))
+
+    #One reduction per column over the user-periods with usage
+    calls_count = np.bincount(call_cells, minlength=n_cells)
+    minutes_sum = np.bincount(call_cells, weights=dated_values(calls, 'duration', dated_calls), minlength=n_cells)
+    messages_count = np.bincount(message_cells, minlength=n_cells)
+    mb_used_total = np.bincount(session_cells, weights=dated_values(internet, 'mb_used', dated_sessions),
+                                minlength=n_cells)
+    df_usage = usage_frame(user_ids[present // n_periods], present % n_periods + first_period,
+                           calls_count, minutes_sum.astype(np.int64), messages_count, mb_used_total)
+    if users is not None:
+        add_service_days(df_usage, users, scheme)
+    return df_usage
+
+
+def fold_chunk(totals, keys, values):
+    """
+    Add one chunk of events to the running totals.
+
+    keys are the (user_id, period) keys of the events and values maps a column name to the amount
+    each event adds to it. The chunk is first reduced to one row per key, so totals never grows
+    beyond the number of distinct user-months.
+    """
+    chunk_keys, inverse = np.unique(keys, return_inverse=True)
+    partial = pd.DataFrame({column: np.bincount(inverse, weights=weights, minlength=len(chunk_keys))
+                            for column, weights in values.items()}, index=chunk_keys)
+    if totals is None:
+        return partial
+    return totals.add(partial, fill_value=0)
+
+
+def stream_log(path, date_column, value_columns, chunksize, lookup=None):
+    """
+    Read one log in chunks and return its running totals per (user_id, period) key. lookup gives
+    the anchor days of the user ids (anchor_lookup); without it the periods are calendar months.
+    """
+    totals = None
+    for chunk in pd.read_csv(path, usecols=['user_id', date_column] + value_columns, chunksize=chunksize):
+        anchors = None if lookup is None else lookup(chunk['user_id'].to_numpy())
+        periods = date_periods(pd.to_datetime(chunk[date_column]), anchors)
+        #Events without a date (period NAT) belong to no billing period
+        dated = periods != NAT
+        if not dated.all():
+            chunk, periods = chunk[dated], periods[dated]
+        if len(periods) and (periods.min() < 0 or periods.max() >= PERIOD_KEYS):
+            last = pd.Period(ordinal=PERIOD_KEYS - 1, freq='M')
+            raise ValueError(f'{path} has dates outside 1970-01 to {last}, which the streaming keys cannot hold')
+        #Key: user_id * PERIOD_KEYS + period, decoded again at the end
+        keys = chunk['user_id'].to_numpy(dtype=np.int64) * PERIOD_KEYS + periods
+        values = {'events': None}
+        if 'duration' in value_columns:
+            #Megaline rounds every call UP to the nearest minute
+            values['duration'] = np.ceil(chunk['duration'].to_numpy(dtype=float))
+        if 'mb_used' in value_columns:
+            values['mb_used'] = chunk['mb_used'].to_numpy(dtype=float)
+        totals = fold_chunk(totals, keys, values)
+    if totals is None:
+        return pd.DataFrame({'events': []}, index=np.array([], dtype=np.int64))
+    return totals
+
+
+def aggregate_usage_chunked(calls_path, messages_path, internet_path, chunksize=CHUNK_SIZE, users=None,
+                            scheme='calendar'):
+    """
+    Build the same df_usage as aggregate_usage(calls, messages, internet, users, scheme) straight
+    from the raw CSV logs.
+
+    Each log is read chunksize rows at a time and only the running per-user-month totals are
+    kept, so the raw events are never all in memory at once.
+    """
+    check_scheme(users, scheme)
+    lookup = anchor_lookup(users, scheme)
+    calls = stream_log(calls_path, 'call_date', ['duration'], chunksize, lookup)
+    messages = stream_log(messages_path, 'message_date', [], chunksize, lookup)
+    internet = stream_log(internet_path, 'session_date', ['mb_used'], chunksize, lookup)
+
+    #Line the three logs up on the union of their keys; a missing key means no usage of that service
+    keys = calls.index.union(messages.index).union(internet.index)
+    calls = calls.reindex(keys, fill_value=0)
+    messages = messages.reindex(keys, fill_value=0)
+    internet = internet.reindex(keys, fill_value=0)
+
+    keys = keys.to_numpy(dtype=np.int64)
+    df_usage = usage_frame(keys // PERIOD_KEYS, keys % PERIOD_KEYS,
+                           calls['events'].to_numpy(dtype=np.int64), calls['duration'].to_numpy(dtype=np.int64),
+                           messages['events'].to_numpy(dtype=np.int64), internet['mb_used'].to_numpy(dtype=float))
+    if users is not None:
+        add_service_days(df_usage, users, scheme)
+    return df_usage
+
+
+def aggregate_usage_merge(calls, messages, internet):
+    """The original aggregation: four groupbys stitched together with three outer merges."""
+    calls_per_month = calls.groupby(['user_id', 'month'])['id'].count().reset_index()
+    calls_per_month.columns = ['user_id', 'month', 'calls_count']
+    minutes_per_month = calls.groupby(['user_id', 'month'])['duration'].sum().reset_index()
+    minutes_per_month.columns = ['user_id', 'month', 'minutes_sum']
+    messages_per_month = messages.groupby(['user_id', 'month'])['id'].count().reset_index()
+    messages_per_month.columns = ['user_id', 'month', 'messages_count']
+    internet_per_month = internet.groupby(['user_id', 'month'])['mb_used'].sum().reset_index()
+    internet_per_month.columns = ['user_id', 'month', 'mb_used_total']
+    internet_per_month['gb_used_billed'] = np.ceil(internet_per_month['mb_used_total'] / MB_PER_GB).astype(int)
+
+    df_usage = pd.merge(calls_per_month, minutes_per_month, on=['user_id', 'month'], how='outer')
+    df_usage = pd.merge(df_usage, messages_per_month, on=['user_id', 'month'], how='outer')
+    df_usage = pd.merge(df_usage, internet_per_month, on=['user_id', 'month'], how='outer')
+    return df_usage.fillna(0)
+
+
+def assert_same_usage(left, right):
+    """Check that two usage tables hold the same user-months and (up to float rounding) the same totals."""
+    left = left.sort_values(['user_id', 'month']).reset_index(drop=True)
+    right = right.sort_values(['user_id', 'month']).reset_index(drop=True)
+    #The original aggregation has no period column
+    columns = left.columns.intersection(right.columns, sort=False)
+    pd.testing.assert_frame_equal(left[columns], right[columns], check_dtype=False)
+
+
+def measure(function, *args):
+    """Run function(*args) and return its result, wall time in seconds and peak traced memory in MB."""
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = function(*args)
+    seconds = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, seconds, peak / 2**20
+
+
+def compare_aggregation(calls, messages, internet):
+    """Time both aggregation paths on the same tables and check that they agree."""
+    for df, date_column in [(calls, 'call_date'), (messages, 'message_date'), (internet, 'session_date')]:
+        if 'month' not in df.columns:
+            df['month'] = df[date_column].dt.month
+    merged, merge_seconds, merge_peak = measure(aggregate_usage_merge, calls, messages, internet)
+    fused, fused_seconds, fused_peak = measure(aggregate_usage, calls, messages, internet)
+    assert_same_usage(fused, merged)
+    return pd.DataFrame({'wall_time_s': [merge_seconds, fused_seconds], 'peak_memory_mb': [merge_peak, fused_peak]},
+                        index=['groupby + merge', 'fused bincount'])
+
+
+if __name__ == '__main__':
+    calls = pd.read_csv('/datasets/megaline_calls.csv', parse_dates=['call_date'])
+    calls['duration'] = np.ceil(calls['duration']).astype(int)
+    messages = pd.read_csv('/datasets/megaline_messages.csv', parse_dates=['message_date'])
+    internet = pd.read_csv('/datasets/megaline_internet.csv', parse_dates=['session_date'])
+    print(compare_aggregation(calls, messages, internet))
+
+    #Streaming ingestion has to give the same table as loading everything
+    assert_same_usage(aggregate_usage_chunked('/datasets/megaline_calls.csv', '/datasets/megaline_messages.csv',
+                                              '/datasets/megaline_internet.csv', chunksize=100_000),
+                      aggregate_usage(calls, messages, internet))
+    print('Chunked aggregation matches.')
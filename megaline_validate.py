@@ -0,0 +1,384 @@
+"""
+Data-quality validation of the raw Megaline tables at ingestion.
+
+Every table is checked against all of its rules in one vectorized pass: each rule is a boolean
+mask over the rows, and the masks are packed into one uint16 bitmask per row (bit i set = the row
+breaks RULES[table][i]). The policy of a rule decides what happens to the rows that break it:
+
+    drop        the row is removed (e.g. the second copy of a duplicated event id)
+    quarantine  the row is removed from the tables and kept aside with its bitmask
+    keep        the row stays; it is only counted
+
+A row breaking several rules gets the strictest of their policies. Plans are validated first,
+then users against the valid plans, then calls, messages and sessions against the valid users,
+so every event is checked against the users that will actually be billed. The rules run before
+the clean_* functions, which would hide some problems (a negative duration is ceiled to 0).
+
+The report (rows kept, quarantined and dropped per table, rows per rule) is written as
+validation.json, and the quarantined rows as quarantine_<table>.parquet, next to the billing
+output.
+
+Run this file directly to validate the Megaline files (report in REPORT_DIR), or to measure the
+validation overhead on the CSV files of N_USERS synthetic users:
+
+    python megaline_validate.py [N_USERS]
+"""
+import json
+import os
+import sys
+import time
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+from megaline_billing import BILLS_DIR
+from megaline_cohorts import month_index
+from megaline_io import CLEANERS, DATA_DIR, TABLE_FILES, read_csv_schema, to_dates
+
+# Rules of every table, in bit order (at most 16 per table)
+RULES = {
+    'calls': ['duplicate_id', 'unknown_user', 'missing_date', 'before_registration', 'after_churn',
+              'missing_duration', 'negative_duration', 'zero_duration'],
+    'internet': ['duplicate_id', 'unknown_user', 'missing_date', 'before_registration', 'after_churn',
+                 'missing_mb', 'negative_mb', 'zero_mb'],
+    'messages': ['duplicate_id', 'unknown_user', 'missing_date', 'before_registration', 'after_churn'],
+    'plans': ['duplicate_plan', 'missing_terms', 'negative_terms'],
+    'users': ['duplicate_user_id', 'missing_reg_date', 'unknown_plan', 'churn_before_registration'],
+}
+
+# Default policy of every rule. Events after the churn date are billed by the analysis, and
+# zero-duration calls and 0-MB sessions are valid (unconnected calls, idle sessions): flagged only
+POLICY = {
+    'duplicate_id': 'drop',
+    'duplicate_user_id': 'drop',
+    'duplicate_plan': 'drop',
+    'unknown_user': 'quarantine',
+    'unknown_plan': 'quarantine',
+    'missing_date': 'quarantine',
+    'missing_reg_date': 'quarantine',
+    'missing_terms': 'quarantine',
+    'missing_duration': 'quarantine',
+    'missing_mb': 'quarantine',
+    'negative_duration': 'quarantine',
+    'negative_mb': 'quarantine',
+    'negative_terms': 'quarantine',
+    'before_registration': 'quarantine',
+    'churn_before_registration': 'quarantine',
+    'after_churn': 'keep',
+    'zero_duration': 'keep',
+    'zero_mb': 'keep',
+}
+
+POLICIES = ('keep', 'quarantine', 'drop')
+
+# Where the report of the Megaline files goes (next to the analysis' bills)
+REPORT_DIR = BILLS_DIR
+
+# Date column and measured column (with its rule suffix) of every event table
+EVENT_COLUMNS = {
+    'calls': ('call_date', 'duration', 'duration'),
+    'internet': ('session_date', 'mb_used', 'mb'),
+    'messages': ('message_date', None, None),
+}
+
+# Plan terms that must be present and non-negative
+TERM_COLUMNS = ['messages_included', 'mb_per_month_included', 'minutes_included', 'usd_monthly_pay',
+                'usd_per_gb', 'usd_per_message', 'usd_per_minute']
+
+# tables: the valid rows of every table (raw columns, dates converted), masks: the uint16 bitmask
+# of every raw row, rules: rows per (table, rule) with its bit and policy, summary: rows, kept,
+# quarantined and dropped per table, quarantine: the quarantined rows with a dq_mask column
+ValidationResult = namedtuple('ValidationResult', 'tables masks rules summary quarantine')
+
+# Rows checked at a time, so the temporaries of every rule stay in the CPU cache
+BLOCK_ROWS = 1 << 16
+
+# int64 nanoseconds of NaT, and a date after every event
+NAT = np.iinfo(np.int64).min
+NO_DATE = np.iinfo(np.int64).max
+
+# Largest user id range (per user) looked up in a direct-address table instead of a hash index
+MAX_ID_SPAN = 64
+
+
+def encode_ids(values):
+    """UTF-8 bytes of every id of a Series (a missing id is empty)."""
+    return values.fillna('').str.encode('utf-8').to_numpy().astype(bytes)
+
+
+def in_history(values, months, history):
+    """
+    Mask of the ids of a Series already in the history of their event's month. history maps a
+    month index (months since 1970-01) to the sorted ids (encode_ids) of that month; only the
+    months of the rows are looked up, with .get.
+    """
+    seen = np.zeros(len(values), dtype=bool)
+    for month in np.unique(months):
+        ids = history.get(int(month))
+        if ids is None or len(ids) == 0:
+            continue
+        rows = np.flatnonzero(months == month)
+        codes = encode_ids(values.iloc[rows])
+        #Compare at the common width, so a longer id is never cut to match a shorter stored one
+        width = max(ids.dtype.itemsize, codes.dtype.itemsize)
+        ids, codes = ids.astype(f'S{width}'), codes.astype(f'S{width}')
+        at = np.minimum(np.searchsorted(ids, codes), len(ids) - 1)
+        seen[rows[ids[at] == codes]] = True
+    return seen
+
+
+def pack_masks(masks, bits, first_bit=0):
+    """Set bit first_bit + i of bits (uint16) on the rows flagged by the i-th mask."""
+    for bit, mask in enumerate(masks, first_bit):
+        #Most rules flag no row of a block: checking is cheaper than packing
+        if mask.any():
+            bits |= np.left_shift(mask, np.uint16(bit), dtype=np.uint16)
+    return bits
+
+
+def plan_rules(plans):
+    """Bitmask (RULES['plans']) of every row of the raw plans table."""
+    terms = plans[TERM_COLUMNS].to_numpy(dtype=float)
+    masks = [plans['plan_name'].duplicated().to_numpy(), np.isnan(terms).any(axis=1), (terms < 0).any(axis=1)]
+    return plans, pack_masks(masks, np.zeros(len(plans), dtype=np.uint16))
+
+
+def user_rules(users, plan_names):
+    """Bitmask (RULES['users']) of every row of the raw users table (plan_names: the valid plans)."""
+    reg_date = to_dates(users['reg_date'])
+    churn_date = to_dates(users['churn_date'])
+    users = users.assign(reg_date=reg_date, churn_date=churn_date)
+    masks = [users['user_id'].duplicated().to_numpy(), reg_date.isna().to_numpy(),
+             ~users['plan'].isin(plan_names).to_numpy(), (churn_date < reg_date).to_numpy()]
+    return users, pack_masks(masks, np.zeros(len(users), dtype=np.uint16))
+
+
+def user_lookup(users):
+    """
+    Function mapping an array of user ids to positions in users (-1 for unknown ids): a
+    direct-address table when the ids are dense enough, a hash index otherwise.
+    """
+    user_ids = users['user_id'].to_numpy(dtype=np.int64)
+    if len(user_ids) == 0:
+        return lambda ids: np.full(len(ids), -1, dtype=np.int64)
+    first = user_ids.min()
+    span = int(user_ids.max() - first) + 1
+    if span > MAX_ID_SPAN * len(user_ids):
+        return pd.Index(user_ids).get_indexer
+
+    #One slot per id in the range, plus a -1 slot at each end that catches every id outside it
+    slots = np.full(span + 2, -1, dtype=np.int64)
+    slots[user_ids - first + 1] = np.arange(len(user_ids))
+
+    def lookup(ids):
+        return slots[np.clip(ids - (first - 1), 0, span + 1)]
+    return lookup
+
+
+def event_rules(name, events, users, history=None):
+    """
+    Bitmask (RULES[name]) of every row of a raw calls, internet or messages table, checked
+    BLOCK_ROWS rows at a time against the valid users. With the id history of the table (see
+    in_history), an id already loaded in the month of its event is a duplicate as well.
+    """
+    date_column, value_column, _ = EVENT_COLUMNS[name]
+    dates = to_dates(events[date_column])
+    events = events.assign(**{date_column: dates})
+
+    if not users['user_id'].is_unique:
+        #Only possible when duplicate user ids are kept: events are checked against the first copy
+        users = users.drop_duplicates('user_id')
+    lookup = user_lookup(users)
+    #Dates are compared as int64 nanoseconds (NaT is the smallest int64), which is twice as fast as
+    #datetime64. Unknown users (position -1) pick up the trailing sentinels, and a missing
+    #registration or churn date becomes one: no date comes before NaT or after NO_DATE
+    reg_dates = np.append(users['reg_date'].to_numpy(dtype='datetime64[ns]').view(np.int64), NAT)
+    churn_dates = users['churn_date'].to_numpy(dtype='datetime64[ns]').view(np.int64)
+    churn_dates = np.append(np.where(churn_dates == NAT, NO_DATE, churn_dates), NO_DATE)
+
+    user_column = events['user_id']
+    #Missing user ids (NaN in a float column) are unknown users
+    missing_user = user_column.isna().to_numpy() if user_column.hasnans else None
+    user_ids = (user_column if missing_user is None else user_column.fillna(-1)).to_numpy(dtype=np.int64)
+    date = dates.to_numpy(dtype='datetime64[ns]').view(np.int64)
+    values = events[value_column].to_numpy(dtype=float) if value_column is not None else None
+
+    bits = np.zeros(len(events), dtype=np.uint16)
+    for start in range(0, len(events), BLOCK_ROWS):
+        stop = min(start + BLOCK_ROWS, len(events))
+        positions = lookup(user_ids[start:stop])
+        if missing_user is not None:
+            positions[missing_user[start:stop]] = -1
+        block_date = date[start:stop]
+        missing_date = block_date == NAT
+        before = block_date < reg_dates[positions]
+        if missing_date.any():
+            #A missing date is neither before registration nor after churn
+            before &= ~missing_date
+        #duplicate_id (bit 0) is set below, over the whole table
+        masks = [positions < 0, missing_date, before, block_date > churn_dates[positions]]
+        if values is not None:
+            block_values = values[start:stop]
+            masks += [np.isnan(block_values), block_values < 0, block_values == 0]
+        pack_masks(masks, bits[start:stop], first_bit=1)
+
+    duplicate = events['id'].duplicated().to_numpy()
+    if history is not None:
+        #Events without a date are in no month of the history
+        dated = np.flatnonzero(date != NAT)
+        seen = np.zeros(len(events), dtype=bool)
+        seen[dated] = in_history(events['id'].iloc[dated], month_index(dates.iloc[dated]), history)
+        duplicate = duplicate | seen
+    bits[duplicate] |= 1
+    return events, bits
+
+
+def rule_names(table, bits):
+    """Names of the rules set in one bitmask value of a table."""
+    return [rule for bit, rule in enumerate(RULES[table]) if int(bits) >> bit & 1]
+
+
+def validate_tables(raw, policy=None, users=None, plans=None, history=None):
+    """
+    Validate raw tables as read by read_csv_schema ({name: table}, any subset of TABLE_FILES).
+
+    policy overrides POLICY for some rules, e.g. {'after_churn': 'quarantine'}. users and plans
+    are the reference tables for events and users when raw does not include them (e.g. one day
+    of events checked against the cleaned users); cleaned plans name their plans in 'plan'.
+    history gives the id history of some event tables, {name: {month index: sorted ids}} (see
+    in_history): their ids already loaded in the month of their event are duplicate_id rows too. Returns a ValidationResult.
+    """
+    policy = {**POLICY, **(policy or {})}
+    if set(policy) != set(POLICY):
+        raise ValueError(f'unknown rules: {sorted(set(policy) - set(POLICY))}')
+    unknown = {rule: action for rule, action in policy.items() if action not in POLICIES}
+    if unknown:
+        raise ValueError(f'policies must be one of {POLICIES}: {unknown}')
+
+    tables, masks, rule_rows, summary, quarantine = {}, {}, [], [], {}
+
+    def settle(name, table, bits):
+        """Count the rows per rule and split the rows of a table by policy."""
+        rules = RULES[name]
+        #Every distinct bitmask is settled once: its rows, and what its strictest policy does with them
+        patterns = np.arange(1 << len(rules))
+        #Only the flagged rows are counted by pattern: most rows break no rule
+        flagged = bits[bits != 0]
+        pattern_rows = np.bincount(flagged, minlength=len(patterns))
+        pattern_rows[0] = len(bits) - len(flagged)
+        drop_bits = sum(1 << bit for bit, rule in enumerate(rules) if policy[rule] == 'drop')
+        quarantine_bits = sum(1 << bit for bit, rule in enumerate(rules) if policy[rule] == 'quarantine')
+        action = np.where(patterns & drop_bits, 2, np.where(patterns & quarantine_bits, 1, 0)).astype(np.int8)
+        kept, quarantined, dropped = np.bincount(action, weights=pattern_rows, minlength=3).astype(np.int64)
+
+        if kept == len(table):
+            tables[name] = table
+            quarantine[name] = table.iloc[:0].assign(dq_mask=bits[:0])
+        else:
+            row_action = action[bits]
+            tables[name] = table[row_action == 0].reset_index(drop=True)
+            quarantine[name] = table[row_action == 1].assign(dq_mask=bits[row_action == 1]).reset_index(drop=True)
+        masks[name] = bits
+        for bit, rule in enumerate(rules):
+            rule_rows.append({'table': name, 'rule': rule, 'bit': bit, 'policy': policy[rule],
+                              'rows': int(pattern_rows[(patterns >> bit) & 1 == 1].sum())})
+        summary.append({'table': name, 'rows': len(table), 'kept': int(kept), 'quarantined': int(quarantined),
+                        'dropped': int(dropped)})
+
+    if 'plans' in raw:
+        settle('plans', *plan_rules(raw['plans']))
+        plan_names = tables['plans']['plan_name']
+    else:
+        plan_names = plans['plan'] if plans is not None else pd.Series([], dtype=object)
+    if 'users' in raw:
+        settle('users', *user_rules(raw['users'], plan_names))
+        users = tables['users']
+    for name in EVENT_COLUMNS:
+        if name in raw:
+            if users is None:
+                raise ValueError(f'{name} cannot be validated without the users table')
+            settle(name, *event_rules(name, raw[name], users, (history or {}).get(name)))
+
+    order = [name for name in TABLE_FILES if name in tables]
+    rules = pd.DataFrame(rule_rows, columns=['table', 'rule', 'bit', 'policy', 'rows']).set_index(['table', 'rule'])
+    summary = pd.DataFrame(summary, columns=['table', 'rows', 'kept', 'quarantined', 'dropped']).set_index('table')
+    return ValidationResult({name: tables[name] for name in order}, {name: masks[name] for name in order},
+                            rules.loc[order], summary.loc[order], {name: quarantine[name] for name in order})
+
+
+def load_validated(names=tuple(TABLE_FILES), data_dir=DATA_DIR, policy=None, users=None, plans=None, history=None):
+    """
+    Read, validate and clean some of the tables of data_dir. Returns the cleaned tables
+    ({name: table}) and the ValidationResult.
+    """
+    raw = {name: read_csv_schema(name, os.path.join(data_dir, TABLE_FILES[name])) for name in names}
+    result = validate_tables(raw, policy, users, plans, history)
+    #The valid tables are new frames (or the raw tables read here), so they are cleaned in place
+    return {name: CLEANERS[name](table) for name, table in result.tables.items()}, result
+
+
+def write_report(result, out_dir):
+    """
+    Write the report of a ValidationResult (validation.json) and its quarantined rows
+    (quarantine_<table>.parquet) to out_dir; returns the path of the report.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    report = {'tables': {}}
+    for name, counts in result.summary.iterrows():
+        rules = result.rules.loc[name]
+        report['tables'][name] = {
+            **{column: int(value) for column, value in counts.items()},
+            'rules': {rule: {'bit': int(row['bit']), 'policy': row['policy'], 'rows': int(row['rows'])}
+                      for rule, row in rules.iterrows()},
+        }
+        path = os.path.join(out_dir, f'quarantine_{name}.parquet')
+        result.quarantine[name].to_parquet(path + '.tmp', index=False)
+        os.replace(path + '.tmp', path)
+    path = os.path.join(out_dir, 'validation.json')
+    with open(path + '.tmp', 'w') as f:
+        json.dump(report, f, indent=2)
+    os.replace(path + '.tmp', path)
+    return path
+
+
+def benchmark_validation(data_dir, repeats=3):
+    """
+    Best-of-repeats time to read and clean every table of data_dir, without and with validation
+    (the validated run converts the dates before cleaning, so clean does not do it again).
+    """
+    def plain():
+        return {name: CLEANERS[name](read_csv_schema(name, os.path.join(data_dir, file)))
+                for name, file in TABLE_FILES.items()}
+
+    def best(load):
+        times = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            load()
+            times.append(time.perf_counter() - start)
+        return min(times)
+
+    rows = sum(len(table) for table in plain().values())
+    seconds = pd.Series({'read + clean': best(plain), 'read + validate + clean': best(lambda: load_validated(
+        data_dir=data_dir))}, name='seconds').to_frame()
+    seconds['overhead'] = seconds['seconds'] / seconds['seconds'].iloc[0] - 1
+    seconds['rows'] = rows
+    return seconds
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        import tempfile
+
+        from megaline_synth import write_synthetic_csv
+
+        with tempfile.TemporaryDirectory() as tmp:
+            write_synthetic_csv(tmp, int(sys.argv[1]))
+            print(benchmark_validation(tmp).round(3))
+    else:
+        tables, result = load_validated()
+        print(result.summary.to_string())
+        print()
+        print(result.rules[result.rules['rows'] > 0].to_string())
+        print('\nReport written to', write_report(result, REPORT_DIR))
@@ -0,0 +1,132 @@
+"""
+Tariff what-if simulator for Megaline.
+
+Evaluates many candidate plan definitions against the same usage table without billing every
+user-month again. The minutes, messages and MB of all user-months are sorted once, with prefix
+sums. For any allowance L the total overage sum(max(0, x - L)) is then one binary search away:
+(sum of the values above L) - L * (number of values above L).
+
+Data is billed per started GB of overage, ceil((mb - MB) / 1024), which is the number of k >= 0
+with mb > MB + 1024 * k. Its total is a sum of counts over those GB steps, so a scenario costs
+O(number of GB steps * log n) instead of O(n).
+
+Run this file directly to sweep a grid of Surf-like tariffs over the Megaline usage.
+"""
+import itertools
+import time
+
+import numpy as np
+import pandas as pd
+
+from megaline_billing import MB_PER_GB, bill_components
+
+# Plan terms that define a scenario (same names as the plans table)
+PLAN_TERMS = ['usd_monthly_pay', 'minutes_included', 'messages_included', 'mb_per_month_included',
+              'usd_per_minute', 'usd_per_message', 'usd_per_gb']
+
+# Scenarios evaluated at a time (bounds the size of the threshold matrix for data)
+SCENARIO_BLOCK = 2_000
+
+
+def plan_grid(**terms):
+    """Every combination of the given plan terms, e.g. plan_grid(usd_monthly_pay=[15, 20], ...)."""
+    missing = set(PLAN_TERMS) - set(terms)
+    if missing:
+        raise ValueError(f'Missing plan terms: {sorted(missing)}')
+    values = [np.atleast_1d(terms[name]) for name in PLAN_TERMS]
+    return pd.DataFrame(list(itertools.product(*values)), columns=PLAN_TERMS)
+
+
+class TariffSimulator:
+    """
+    Precomputed usage distribution of a set of user-months.
+
+    Build it once from df_usage (or the user-months of one plan) and call revenue() with any
+    number of scenarios.
+    """
+
+    def __init__(self, df_usage):
+        self.n_user_months = len(df_usage)
+        self.n_users = df_usage['user_id'].nunique()
+        self.minutes = np.sort(df_usage['minutes_sum'].to_numpy(dtype=np.int64))
+        self.messages = np.sort(df_usage['messages_count'].to_numpy(dtype=np.int64))
+        self.mb = np.sort(df_usage['mb_used_total'].to_numpy(dtype=float))
+        #Prefix sums with a leading 0: values above position i add up to prefix[-1] - prefix[i]
+        self.minutes_prefix = np.concatenate([[0], np.cumsum(self.minutes)])
+        self.messages_prefix = np.concatenate([[0], np.cumsum(self.messages)])
+
+    @staticmethod
+    def excess(sorted_values, prefix, limits):
+        """sum(max(0, x - limit)) over all x, for every limit."""
+        first_above = np.searchsorted(sorted_values, limits, side='right')
+        n_above = len(sorted_values) - first_above
+        return (prefix[-1] - prefix[first_above]) - limits * n_above
+
+    def gb_over(self, mb_limits):
+        """Total billed overage GB, sum(ceil(max(0, mb - limit) / 1024)), for every limit."""
+        if len(self.mb) == 0:
+            return np.zeros(len(mb_limits))
+        n_steps = int(np.ceil(max(self.mb[-1] - mb_limits.min(), 0) / MB_PER_GB)) + 1
+        thresholds = mb_limits[:, None] + MB_PER_GB * np.arange(n_steps)
+        above = len(self.mb) - np.searchsorted(self.mb, thresholds, side='right')
+        return above.sum(axis=1)
+
+    def revenue(self, scenarios):
+        """
+        Revenue of every scenario (one row per candidate plan, with the PLAN_TERMS columns).
+
+        Returns the scenarios with the total overage volumes, the revenue split by charge, the
+        total revenue and the average revenue per user-month and per user.
+        """
+        blocks = []
+        for start in range(0, len(scenarios), SCENARIO_BLOCK):
+            block = scenarios.iloc[start:start + SCENARIO_BLOCK]
+            terms = {name: block[name].to_numpy(dtype=float) for name in PLAN_TERMS}
+            extra_minutes = self.excess(self.minutes, self.minutes_prefix, terms['minutes_included'])
+            extra_messages = self.excess(self.messages, self.messages_prefix, terms['messages_included'])
+            extra_gb = self.gb_over(terms['mb_per_month_included'])
+            blocks.append(pd.DataFrame({
+                'extra_minutes': extra_minutes,
+                'extra_messages': extra_messages,
+                'extra_gb': extra_gb,
+                'base': terms['usd_monthly_pay'] * self.n_user_months,
+                'minutes': extra_minutes * terms['usd_per_minute'],
+                'messages': extra_messages * terms['usd_per_message'],
+                'data': extra_gb * terms['usd_per_gb'],
+            }, index=block.index))
+        if not blocks:
+            raise ValueError('No scenarios to evaluate.')
+        result = pd.concat([scenarios, pd.concat(blocks)], axis=1)
+        result['revenue'] = result[['base', 'minutes', 'messages', 'data']].sum(axis=1)
+        result['revenue_per_user_month'] = result['revenue'] / self.n_user_months
+        result['revenue_per_user'] = result['revenue'] / self.n_users
+        return result
+
+
+def scenario_bills(df_usage, scenario):
+    """Per-user-month bills of one scenario (a row of the grid), with the usual per-charge breakdown."""
+    df = df_usage.assign(**{name: scenario[name] for name in PLAN_TERMS})
+    return pd.concat([df_usage[['user_id', 'month']], bill_components(df)], axis=1)
+
+
+def per_user_revenue(df_usage, scenario):
+    """Total revenue of every user over all months under one scenario."""
+    return scenario_bills(df_usage, scenario).groupby('user_id')['revenue'].sum()
+
+
+if __name__ == '__main__':
+    from megaline_io import load_tables
+    from megaline_usage import aggregate_usage
+
+    calls, internet, messages, plans, users = load_tables()
+    df_usage = aggregate_usage(calls, messages, internet)
+    surf_usage = df_usage[df_usage['user_id'].isin(users.loc[users['plan'] == 'surf', 'user_id'])]
+
+    #Surf-like tariffs around today's terms: 10 x 10 x 5 x 10 x 2 x 2 x 5 = 100,000 scenarios
+    grid = plan_grid(usd_monthly_pay=np.arange(15, 25), minutes_included=np.arange(300, 800, 50),
+                     messages_included=[25, 50, 75, 100, 150], mb_per_month_included=np.arange(10, 20) * 1024,
+                     usd_per_minute=[0.02, 0.03], usd_per_message=[0.02, 0.03], usd_per_gb=[6, 8, 10, 12, 14])
+    start = time.perf_counter()
+    result = TariffSimulator(surf_usage).revenue(grid)
+    print(f'{len(grid)} scenarios in {time.perf_counter() - start:.2f} s')
+    print(result.nlargest(5, 'revenue')[PLAN_TERMS + ['revenue', 'revenue_per_user']])
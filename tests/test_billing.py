@@ -0,0 +1,62 @@
+"""
+The vectorized bills against calculate_revenue, the row-by-row billing function of
+megaline_analysis.py: every user-month must come to the same amount in cents, on the Megaline
+files (skipped when they are not in DATA_DIR) and on synthetic users.
+"""
+import os
+
+import numpy as np
+import pytest
+
+from megaline_billing import CENTS_PER_USD, bill_components, merge_plans
+from megaline_compact import compact_bills, compact_usage
+from megaline_io import DATA_DIR, TABLE_FILES, load_tables
+from megaline_synth import synthetic_tables
+from megaline_usage import aggregate_usage
+
+# Synthetic users billed next to the Megaline sample
+N_SYNTHETIC_USERS = 2_000
+
+
+def calculate_revenue(row):
+    """calculate_revenue of megaline_analysis.py (importing the analysis would run it)."""
+    total_bill = row['usd_monthly_pay']
+    extra_minutes = max(0, row['minutes_sum'] - row['minutes_included'])
+    total_bill += extra_minutes * row['usd_per_minute']
+    extra_messages = max(0, row['messages_count'] - row['messages_included'])
+    total_bill += extra_messages * row['usd_per_message']
+    extra_mb = max(0, row['mb_used_total'] - row['mb_per_month_included'])
+    if extra_mb > 0:
+        extra_gb = np.ceil(extra_mb / 1024)
+        total_bill += extra_gb * row['usd_per_gb']
+    return total_bill
+
+
+def cents(dollars):
+    return np.round(np.asarray(dollars, dtype=float) * CENTS_PER_USD).astype(np.int64)
+
+
+@pytest.fixture(scope='module', params=['megaline', 'synthetic'])
+def billed(request):
+    """Usage table, df_merged and the calculate_revenue bill in cents of every user-month."""
+    if request.param == 'megaline':
+        if not all(os.path.exists(os.path.join(DATA_DIR, file)) for file in TABLE_FILES.values()):
+            pytest.skip(f'the Megaline files are not in {DATA_DIR}')
+        tables = load_tables()
+    else:
+        tables = synthetic_tables(N_SYNTHETIC_USERS, seed=1)
+    calls, internet, messages, plans, users = tables
+    df_usage = aggregate_usage(calls, messages, internet)
+    df_merged = merge_plans(df_usage, users, plans)
+    return tables, df_usage, df_merged, cents(df_merged.apply(calculate_revenue, axis=1))
+
+
+def test_bill_components_match_calculate_revenue(billed):
+    _, _, df_merged, expected = billed
+    np.testing.assert_array_equal(cents(bill_components(df_merged)['revenue']), expected)
+
+
+def test_compact_bills_match_calculate_revenue(billed):
+    (calls, internet, messages, plans, users), df_usage, _, expected = billed
+    bills = compact_bills(compact_usage(df_usage, users, plans), plans)
+    np.testing.assert_array_equal(bills['revenue_cents'].to_numpy(dtype=np.int64), expected)